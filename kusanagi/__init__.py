@@ -1,10 +1,10 @@
-from . import base
-from . import diagnosis_tools
-from . import ghost
-from . import shell
-from . import utils
-# from . import server
 import os
 
+from .utils.lazy import lazy_module
+
 install_path = os.path.dirname(os.path.dirname(__file__))
 
+# subpackages are imported when first accessed, e.g. kusanagi.ghost
+lazy_module(
+    __name__, submodules=['base', 'diagnosis_tools', 'ghost', 'shell',
+                          'utils'])
@@ -1,18 +1,156 @@
-import theano
+import io
 import numpy as np
+import uuid
 from kusanagi import utils
-from kusanagi.base.Loadable import Loadable
+from kusanagi.base.Loadable import Loadable, cached_array
+
+
+class GrowableArray(object):
+    ''' Preallocated numpy array that grows along its first axis. Appending
+    a row is amortized O(1), and the stored rows can be accessed without
+    copies via the data property. When pickled, the rows are split in blocks
+    of block_size rows at fixed offsets, so that checkpoints in the array
+    format (see Loadable.save) only need to write the blocks that changed
+    since the last save. Full blocks are only hashed once, until they are
+    truncated; rows should not be modified in place'''
+    block_size = 4096
+
+    def __init__(self, capacity=256):
+        self.buffer = None
+        self.blocks = None
+        self.n = 0
+        self.capacity = capacity
+        # cache keys of the full blocks, by block index
+        self.block_keys = {}
+
+    @property
+    def data(self):
+        if self.blocks is not None:
+            if len(self.blocks) == 1:
+                # (possibly memory mapped) loaded block, no need to copy it
+                return self.blocks[0][:self.n]
+            self.materialize()
+        if self.buffer is None:
+            return np.empty((0,))
+        return self.buffer[:self.n]
+
+    def materialize(self):
+        ''' Copies the blocks loaded from disk into a writable buffer'''
+        if self.blocks is None:
+            return
+        blocks, self.blocks = self.blocks, None
+        if len(blocks) == 0:
+            return
+        self.buffer = np.empty(
+            (max(self.capacity, 2*self.n),) + blocks[0].shape[1:],
+            dtype=blocks[0].dtype)
+        # the blocks may have more rows than n, if truncated after loading
+        i = 0
+        for block in blocks:
+            if i >= self.n:
+                break
+            m = min(block.shape[0], self.n - i)
+            self.buffer[i:i+m] = block[:m]
+            i += m
+
+    def allocate(self, value):
+        value = np.asarray(value)
+        dtype = value.dtype if value.dtype.kind in 'biufc' else object
+        shape = value.shape if dtype is not object else ()
+        self.buffer = np.empty((self.capacity,)+shape, dtype=dtype)
+
+    def as_object(self):
+        ''' Converts the storage to an object array (used when the rows
+        have heterogeneous types or shapes)'''
+        buffer = np.empty((self.buffer.shape[0],), dtype=object)
+        for i in range(self.n):
+            buffer[i] = self.buffer[i]
+        self.buffer = buffer
+        self.block_keys = {}
+
+    def append(self, value):
+        self.materialize()
+        if self.buffer is None:
+            self.allocate(value)
+        if self.n == self.buffer.shape[0]:
+            # double the capacity
+            self.buffer = np.concatenate(
+                [self.buffer, np.empty_like(self.buffer)])
+        try:
+            if value is None and self.buffer.dtype != object:
+                raise TypeError()
+            self.buffer[self.n] = value
+        except (ValueError, TypeError):
+            self.as_object()
+            self.buffer[self.n] = value
+        self.n += 1
+
+    def truncate(self, n):
+        self.n = min(n, self.n)
+        B = self.block_size
+        self.block_keys = dict((k, key) for k, key in self.block_keys.items()
+                               if (k+1)*B <= self.n)
+
+    def __len__(self):
+        return self.n
+
+    def __getstate__(self):
+        # avoid saving the unused part of the buffer
+        state = dict(self.__dict__)
+        data = self.data
+        B = self.block_size
+        state['buffer'] = None
+        state['blocks'] = []
+        for k, i in enumerate(range(0, self.n, B)):
+            block = data[i:i+B]
+            if block.shape[0] == B and block.dtype != object:
+                # full blocks don't change until truncated
+                if k not in self.block_keys:
+                    self.block_keys[k] = uuid.uuid4().hex
+                block = cached_array(block, self.block_keys[k])
+            state['blocks'].append(block)
+        state['block_keys'] = {}
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('block_keys', {})
+        self.__dict__.update(state)
+        if self.blocks is not None and len(self.blocks) == 0:
+            self.blocks = None
+
+
+class EpisodeList(object):
+    ''' Read-only list of episodes, where every episode is a view of the
+    corresponding rows of a GrowableArray'''
+    def __init__(self, column, offsets, n_samples):
+        self.data = column.data
+        self.bounds = list(offsets) + [n_samples]
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('episode index out of range')
+        return self.data[self.bounds[i]:self.bounds[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
 
 class ExperienceDataset(Loadable):
-    ''' Class used to store data from runs with a learning agent'''
+    ''' Class used to store data from runs with a learning agent. Every field
+    is stored as a single growable array, with the offsets of each episode
+    stored in episode_offsets. The states, actions, costs, info and
+    time_stamps properties return the per-episode data.'''
     def __init__(self, name='Experience', filename_prefix=None, filename=None):
         self.name = name
-        self.time_stamps = []
-        self.states = []
-        self.actions = []
-        self.costs = []
-        self.info = []
+        self.init_columns()
         self.policy_parameters = []
         self.curr_episode = -1
         self.state_changed = True
@@ -32,20 +170,79 @@ class ExperienceDataset(Loadable):
             self.load()
 
         self.register_types([list])
-        self.register(['curr_episode'])
+        self.register(['curr_episode', 'columns', 'info_columns',
+                       'episode_offsets'])
+
+    def init_columns(self):
+        ''' Initializes the (empty) storage for every field '''
+        self.columns = dict((k, GrowableArray()) for k in
+                            ['states', 'actions', 'costs', 'time_stamps'])
+        self.info_columns = {}
+        self.episode_offsets = []
+        self.dynmodel_cache = {}
+
+    def episodes(self, field):
+        ''' Returns the data for the given field, split by episode'''
+        return EpisodeList(self.columns[field], self.episode_offsets,
+                           self.n_samples())
+
+    @property
+    def states(self):
+        return self.episodes('states')
+
+    @property
+    def actions(self):
+        return self.episodes('actions')
+
+    @property
+    def costs(self):
+        return self.episodes('costs')
+
+    @property
+    def time_stamps(self):
+        return self.episodes('time_stamps')
+
+    @property
+    def info(self):
+        ''' Returns the info dictionaries, as a list per episode. Keys that
+        were missing at a given step are not included'''
+        cols = [(k, c.data) for k, c in self.info_columns.items()]
+        infos = []
+        for i in range(self.n_samples()):
+            infos.append(dict((k, d[i]) for k, d in cols
+                              if not (d.dtype == object and d[i] is None)))
+        bounds = self.episode_offsets + [self.n_samples()]
+        return [infos[bounds[i]:bounds[i+1]]
+                for i in range(self.n_episodes())]
 
     def load(self, output_folder=None, output_filename=None):
         ''' Loads the state from file, and initializes additional variables'''
         # load state
         ret = super(ExperienceDataset, self).load(
             output_folder, output_filename)
+        self.clear_dynmodel_cache()
+
+        # convert datasets saved with the list based format
+        legacy_keys = ['states', 'actions', 'costs', 'info', 'time_stamps']
+        if any([k in self.__dict__ for k in legacy_keys]):
+            legacy = dict((k, self.__dict__.pop(k, [])) for k in legacy_keys)
+            self.unregister(legacy_keys)
+            policy_parameters = self.policy_parameters
+            self.init_columns()
+            self.policy_parameters = []
+            for i in range(len(legacy['states'])):
+                ep = dict((k, legacy[k][i] if i < len(legacy[k]) else None)
+                          for k in legacy_keys)
+                self.append_episode(ep['states'], ep['actions'], ep['costs'],
+                                    infos=ep['info'], ts=ep['time_stamps'])
+            self.policy_parameters = policy_parameters
 
         # if the policy parameters were saved as shared variables
         for i in range(len(self.policy_parameters)):
             pi = self.policy_parameters[i]
             for j in range(len(pi)):
                 pij = self.policy_parameters[i][j]
-                if isinstance(pij, theano.tensor.sharedvar.SharedVariable):
+                if hasattr(pij, 'get_value'):
                     self.policy_parameters[i][j] = pij.get_value()
         return ret
 
@@ -53,25 +250,33 @@ class ExperienceDataset(Loadable):
         '''
             Adds new set of observations to the current episode
         '''
-        curr_episode = self.curr_episode
-        if curr_episode < 0:
+        if self.curr_episode < 0:
             self.new_episode()
-        self.states[curr_episode].append(x_t)
-        self.actions[curr_episode].append(u_t)
-        self.costs[curr_episode].append(c_t)
-        self.info[curr_episode].append(info)
-        self.time_stamps[curr_episode].append(t)
+        n = self.n_samples()
+        self.columns['states'].append(x_t)
+        self.columns['actions'].append(u_t)
+        self.columns['costs'].append(c_t)
+        self.columns['time_stamps'].append(np.nan if t is None else t)
+
+        # info dictionaries are stored as one column per key
+        info = info or {}
+        for key, value in info.items():
+            if key not in self.info_columns:
+                column = GrowableArray()
+                for i in range(n):
+                    column.append(None)
+                self.info_columns[key] = column
+            self.info_columns[key].append(value)
+        for key, column in self.info_columns.items():
+            if key not in info:
+                column.append(None)
         self.state_changed = True
 
     def new_episode(self, policy_params=None):
         '''
             Adds new episode to the experience dataset
         '''
-        self.time_stamps.append([])
-        self.states.append([])
-        self.actions.append([])
-        self.costs.append([])
-        self.info.append([])
+        self.episode_offsets.append(self.n_samples())
         if policy_params:
             self.policy_parameters.append(policy_params)
         else:
@@ -81,35 +286,118 @@ class ExperienceDataset(Loadable):
         self.state_changed = True
 
     def append_episode(self, states, actions, costs,
-                        infos=None, policy_params=None, ts=None):
-        if policy_params is not None:
-            self.policy_parameters.append(policy_params)
-        if infos is not None:
-            self.info.append(infos)
-        if ts is not None:
-            self.time_stamps.append(ts)
-        self.states.append(states)
-        self.actions.append(actions)
-        self.costs.append(costs)
+                       infos=None, policy_params=None, ts=None):
+        '''
+            Adds a new episode with the given data
+        '''
+        self.new_episode(policy_params)
+        for i in range(len(states)):
+            self.add_sample(states[i], actions[i], costs[i],
+                            infos[i] if infos is not None else None,
+                            ts[i] if ts is not None else None)
+
+    def episodes_to_bytes(self, start=0):
+        '''
+            Serializes the episodes from the given index onwards as a
+            compressed npz archive, which can be appended to another dataset
+            with append_episodes_from_bytes. The index of the first episode is
+            stored as the sequence number of the upload. Info fields that are
+            not numeric are not included.
+        '''
+        n_episodes = max(self.n_episodes() - start, 0)
+        arrays = dict(first_seq=np.array(start), n_episodes=np.array(
+            n_episodes))
+        bounds = self.episode_offsets + [self.n_samples()]
+        numeric_info = [(k, c.data) for k, c in self.info_columns.items()
+                        if c.data.dtype != object]
+        for i in range(n_episodes):
+            a, b = bounds[start+i], bounds[start+i+1]
+            for k, column in self.columns.items():
+                arrays['%s_%d' % (k, i)] = column.data[a:b]
+            for k, data in numeric_info:
+                arrays['info>%s_%d' % (k, i)] = data[a:b]
+            for j, p in enumerate(self.policy_parameters[start+i]):
+                arrays['policy_params_%d_%d' % (i, j)] = np.asarray(p)
+        buf = io.BytesIO()
+        np.savez_compressed(buf, **arrays)
+        return buf.getvalue()
+
+    def append_episodes_from_bytes(self, data):
+        '''
+            Appends the episodes serialized with episodes_to_bytes. Episodes
+            whose sequence number is lower than the number of episodes in this
+            dataset have already been appended: they are skipped if they have
+            the same number of samples (so retried uploads are idempotent) or
+            fewer, and the last episode is replaced if the upload has more
+            samples (i.e. it was uploaded while still being recorded). Returns
+            the number of appended or replaced episodes.
+        '''
+        with np.load(io.BytesIO(data), allow_pickle=False) as f:
+            arrays = dict(f.items())
+        first_seq = int(arrays['first_seq'])
+        n_episodes = int(arrays['n_episodes'])
+        if first_seq > self.n_episodes():
+            raise ValueError(
+                'Missing episodes: expected sequence number %d, got %d' % (
+                    self.n_episodes(), first_seq))
+        n_appended = 0
+        for i in range(n_episodes):
+            seq = first_seq + i
+            T = len(arrays['states_%d' % (i)])
+            if seq < self.n_episodes():
+                n_stored = len(self.states[seq])
+                is_last = seq == self.n_episodes() - 1
+                if T == n_stored or (is_last and T < n_stored):
+                    continue
+                if not is_last:
+                    raise ValueError(
+                        'Episode %d has %d samples, but %d were uploaded' % (
+                            seq, n_stored, T))
+                # the last episode was uploaded before it was finished
+                self.drop_last_episode()
+            infos = [{} for t in range(T)]
+            for key in arrays:
+                if key.startswith('info>') and key.endswith('_%d' % (i)):
+                    k = key[len('info>'):key.rindex('_')]
+                    for t, v in enumerate(arrays[key]):
+                        infos[t][k] = v
+            policy_params = []
+            while 'policy_params_%d_%d' % (i, len(policy_params)) in arrays:
+                policy_params.append(
+                    arrays['policy_params_%d_%d' % (i, len(policy_params))])
+            self.append_episode(
+                arrays['states_%d' % (i)], arrays['actions_%d' % (i)],
+                arrays['costs_%d' % (i)], infos=infos,
+                policy_params=policy_params,
+                ts=arrays['time_stamps_%d' % (i)])
+            n_appended += 1
+        return n_appended
+
+    def drop_last_episode(self):
+        ''' Removes the last episode'''
+        n = self.episode_offsets.pop()
+        for column in list(self.columns.values()) + list(
+                self.info_columns.values()):
+            column.truncate(n)
+        self.policy_parameters.pop()
+        self.curr_episode -= 1
+        self.clear_dynmodel_cache()
+        self.state_changed = True
 
     def n_samples(self):
         ''' Returns the total number of samples in this dataset '''
-        return sum([len(s) for s in self.states])
+        return len(self.columns['states'])
 
     def n_episodes(self):
         ''' Returns the total number of episodes in this dataset '''
-        return len(self.states)
+        return len(self.episode_offsets)
 
     def reset(self):
         ''' Empties the internal data structures'''
         fmt = 'Resetting experience dataset'
         fmt += '(WARNING: data from %s will be overwritten)'
         utils.print_with_stamp(fmt % (self.filename), self.name)
-        self.time_stamps = []
-        self.states = []
-        self.actions = []
-        self.costs = []
-        self.info = []
+        self.init_columns()
         self.policy_parameters = []
         self.curr_episode = -1
         # Let's give people a last chance of recovering their data. Also, we
@@ -124,13 +412,14 @@ class ExperienceDataset(Loadable):
             fmt = 'Resetting experience dataset to episode %d'
             fmt += ' (WARNING: data from %s will be overwritten)'
             utils.print_with_stamp(fmt % (episode, self.filename), self.name)
-            self.curr_episode = episode
-            self.time_stamps = self.time_stamps[:episode]
-            self.states = self.states[:episode]
-            self.actions = self.actions[:episode]
-            self.costs = self.costs[:episode]
-            self.info = self.info[:episode]
+            n = self.episode_offsets[episode]
+            for column in list(self.columns.values()) + list(
+                    self.info_columns.values()):
+                column.truncate(n)
+            self.episode_offsets = self.episode_offsets[:episode]
             self.policy_parameters = self.policy_parameters[:episode]
+            self.curr_episode = episode - 1
+            self.clear_dynmodel_cache()
             self.state_changed = True
 
     def get_dynmodel_dataset(self, deltas=True, filter_episodes=None,
@@ -167,8 +456,6 @@ class ExperienceDataset(Loadable):
         '''
         filter_episodes = filter_episodes or []
         angle_dims = angle_dims or []
-        inputs, targets = [], []
-        join = np.stack if stack else np.concatenate
         if stack:
             # ignore the u_steps parameter
             u_steps = x_steps
@@ -180,64 +467,105 @@ class ExperienceDataset(Loadable):
         if len(filter_episodes) < 1:
             # use all data
             filter_episodes = list(range(self.n_episodes()))
-        for epi in filter_episodes:
-            if len(self.states[epi]) == 0:
-                continue
-            # get state action pairs for current episode
-            states, actions = np.array(
-                self.states[epi]), np.array(self.actions[epi])
-            # convert input angle dimensions to complex representation
-            states_ = utils.gTrig_np(np.array(states), angle_dims)
-            # pad with initial state for the first x_steps timesteps
-            states_ = np.concatenate([states_[[0]*(x_steps-1)], states_])
-            # get input states up to x_steps in the past.
-
-            states_ = join(
-                [states_[i:i-x_steps-(output_steps-1), :]
-                 for i in range(x_steps)],
-                axis=1)
-            # same for actions (u_steps in the past, pad with zeros for the
-            # first u_steps)
-            actions_ = np.concatenate(
-                [np.zeros((u_steps-1, actions.shape[1])), actions])
-            actions_ = join(
-                [actions_[i:i-u_steps-(output_steps-1), :]
-                 for i in range(u_steps)],
-                axis=1)
-
-            # create input vector
-            inp = np.concatenate([states_, actions_], axis=-1)
-
-            # get output states up to output_steps in the future
-            H = states.shape[0]
-            ostates = join(
-                [states[i:H-(output_steps-i-1), :]
-                 for i in range(output_steps)],
-                axis=1)
-
-            #  create output vector
-            tgt = (ostates[1:, :] - ostates[:-1, :]
-                   if deltas else ostates[1:, :])
-
-            # append costs if requested
-            if return_costs:
-                costs = np.array(self.costs[epi])
-                ocosts = join(
-                    [costs[i:H-(output_steps-i-1), :]
-                     for i in range(output_steps)],
-                    axis=1)
-
-                tgt = np.concatenate([tgt, ocosts[:-1, :]], axis=-1)
-
-            inputs.append(inp)
-            targets.append(tgt)
-
-        ret = np.concatenate(inputs), np.concatenate(targets)
-        return ret
+        episodes = [e + self.n_episodes() if e < 0 else e
+                    for e in filter_episodes]
+
+        # the transformed data is cached per episode, for every combination
+        # of parameters. An entry is valid as long as the episode bounds
+        # have not changed
+        key = (deltas, tuple(angle_dims), x_steps, u_steps, output_steps,
+               return_costs, stack)
+        cache = self.dynmodel_cache.setdefault(key, {})
+        bounds = self.episode_offsets + [self.n_samples()]
+        new_episodes = [e for e in episodes
+                        if cache.get(e, (None,))[0] != bounds[e:e+2]]
+        if len(new_episodes) > 0:
+            inp, tgt, n = self.transform_episodes(
+                new_episodes, deltas, angle_dims, x_steps, u_steps,
+                output_steps, return_costs, stack)
+            splits = np.cumsum(n)[:-1]
+            for e, inp_e, tgt_e in zip(new_episodes, np.split(inp, splits),
+                                       np.split(tgt, splits)):
+                cache[e] = (bounds[e:e+2], inp_e, tgt_e)
+
+        inp = np.concatenate([cache[e][1] for e in episodes])
+        tgt = np.concatenate([cache[e][2] for e in episodes])
+        return inp, tgt
+
+    def transform_episodes(self, episodes, deltas, angle_dims, x_steps,
+                           u_steps, output_steps, return_costs, stack):
+        '''
+        Computes the dynamics model dataset for the given episodes (see
+        get_dynmodel_dataset). Returns the inputs, targets and the number of
+        data pairs that correspond to each episode
+        '''
+        join = np.stack if stack else np.concatenate
+
+        # start and length of every selected episode
+        bounds = np.array(self.episode_offsets + [self.n_samples()])
+        episodes = np.array(episodes, dtype=np.int64)
+        starts = bounds[episodes]
+        lengths = bounds[episodes + 1] - starts
+        # number of (input, target) pairs per episode
+        n = np.maximum(lengths - output_steps, 0)
+
+        # global index of the first step of the corresponding episode, and
+        # the time step within the episode, for every data pair
+        ep_start = np.repeat(starts, n)
+        t = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+
+        states = self.columns['states'].data
+        actions = self.columns['actions'].data
+
+        # get input states up to x_steps in the past (padding with the initial
+        # state for the first x_steps timesteps), and convert input angle
+        # dimensions to complex representation
+        states_ = join(
+            [utils.gTrig_np(
+                states[ep_start + np.maximum(t + i - (x_steps-1), 0)],
+                angle_dims)
+             for i in range(x_steps)],
+            axis=1)
+        # same for actions (u_steps in the past, pad with zeros for the
+        # first u_steps)
+        actions_ = []
+        for i in range(u_steps):
+            k = t + i - (u_steps-1)
+            a_i = actions[ep_start + np.maximum(k, 0)]*(k >= 0)[:, None]
+            actions_.append(a_i)
+        actions_ = join(actions_, axis=1)
+
+        # create input vector
+        inp = np.concatenate([states_, actions_], axis=-1)
+
+        # get output states up to output_steps in the future
+        ostates0 = join([states[ep_start + t + i]
+                         for i in range(output_steps)], axis=1)
+        ostates1 = join([states[ep_start + t + i + 1]
+                         for i in range(output_steps)], axis=1)
+
+        #  create output vector
+        tgt = ostates1 - ostates0 if deltas else ostates1
+
+        # append costs if requested
+        if return_costs:
+            costs = self.columns['costs'].data
+            if costs.ndim == 1:
+                costs = costs[:, None]
+            ocosts = join([costs[ep_start + t + i]
+                           for i in range(output_steps)], axis=1)
+            tgt = np.concatenate([tgt, ocosts], axis=-1)
+
+        return inp, tgt, n
+
+    def clear_dynmodel_cache(self):
+        ''' Removes the cached dynamics model datasets'''
+        self.dynmodel_cache = {}
 
     def sample_states(self, n_samples=1, timestep=0):
         # collect initial states
-        x0 = [ep[timestep] for ep in self.states]
+        idx = np.array(self.episode_offsets) + timestep
+        x0 = self.columns['states'].data[idx]
         # sample indices
         idx = np.random.choice(range(len(x0)), n_samples)
-        return np.array(x0)[idx]
+        return x0[idx]
@@ -1,8 +1,141 @@
+import hashlib
+import json
+import numpy as np
 import os
+import pickle
 import sys
-from theano.misc.pkl_utils import dump as t_dump, load as t_load
+import time
 from kusanagi import utils
 
+# digests of the arrays that were marked as unchanged with cached_array, by
+# their cache key
+_digest_cache = {}
+
+
+class CachedArray(np.ndarray):
+    ''' View of an array whose contents don't change while its cache_key
+    stays the same, so that ArrayPickler can reuse its digest'''
+    cache_key = None
+
+    def __reduce__(self):
+        # pickled as a plain array by other picklers
+        return self.view(np.ndarray).__reduce__()
+
+
+def cached_array(arr, cache_key):
+    ''' Returns a view of arr that ArrayPickler only hashes once per
+    cache_key. The caller must use a new key whenever the contents change'''
+    view = arr.view(CachedArray)
+    view.cache_key = cache_key
+    return view
+
+
+class ArrayPickler(pickle.Pickler):
+    ''' Pickler that stores numpy arrays as .npy files in a content addressed
+    folder. Arrays that were already saved (e.g. in a previous checkpoint)
+    are not written again. The names of the files used by the pickled object
+    are collected in self.names'''
+    def __init__(self, f, array_dir, protocol=2):
+        pickle.Pickler.__init__(self, f, protocol)
+        self.array_dir = array_dir
+        self.names = set()
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject:
+            return None
+        cache_key = getattr(obj, 'cache_key', None)
+        arr = np.ascontiguousarray(obj).view(np.ndarray)
+        name = _digest_cache.get(cache_key)
+        if name is None:
+            digest = hashlib.sha1(
+                ('%s%s' % (arr.dtype.str, arr.shape)).encode('utf-8'))
+            digest.update(memoryview(arr.reshape(-1)).cast('B'))
+            name = '%s.npy' % (digest.hexdigest())
+            if cache_key is not None:
+                _digest_cache[cache_key] = name
+        path = os.path.join(self.array_dir, name)
+        if not os.path.isfile(path):
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, arr)
+            os.rename(tmp_path, path)
+        self.names.add(name)
+        return ('npy', name)
+
+
+class ArrayUnpickler(pickle.Unpickler):
+    ''' Unpickler for checkpoints written with ArrayPickler. Arrays are
+    memory mapped (copy-on-write by default), so they are only read from
+    disk when accessed'''
+    def __init__(self, f, array_dir, mmap_mode='c'):
+        pickle.Unpickler.__init__(self, f)
+        self.array_dir = array_dir
+        self.mmap_mode = mmap_mode
+
+    def persistent_load(self, pid):
+        kind, name = pid
+        path = os.path.join(self.array_dir, name)
+        try:
+            return np.load(path, mmap_mode=self.mmap_mode)
+        except ValueError:
+            # empty arrays can't be memory mapped
+            return np.load(path)
+
+
+def save_checkpoint(state, path):
+    ''' Saves the state dictionary in the array-native checkpoint format. The
+    arrays are stored in the arrays folder next to the checkpoint file, and
+    their names are listed in a .refs file next to the checkpoint. Arrays
+    that are no longer used by any checkpoint in the folder are removed'''
+    start_time = time.time()
+    array_dir = os.path.join(os.path.dirname(path), 'arrays')
+    if not os.path.isdir(array_dir):
+        os.makedirs(array_dir)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickler = ArrayPickler(f, array_dir)
+        pickler.dump(state)
+    tmp_refs = '%s.refs.%d.tmp' % (path, os.getpid())
+    with open(tmp_refs, 'w') as f:
+        json.dump(sorted(pickler.names), f)
+    os.rename(tmp_path, path)
+    os.rename(tmp_refs, path+'.refs')
+    prune_arrays(os.path.dirname(path), start_time)
+
+
+def prune_arrays(folder, before=None):
+    ''' Removes the files in the arrays folder that are not referenced by
+    any checkpoint in folder. Only files modified before the given time are
+    removed, so arrays written by a concurrent save are kept. Nothing is
+    removed if a checkpoint has no .refs file (i.e. it was written by an
+    older version)'''
+    array_dir = os.path.join(folder, 'arrays')
+    referenced = set()
+    for name in os.listdir(folder):
+        if not name.endswith('.ckpt'):
+            continue
+        refs_path = os.path.join(folder, name+'.refs')
+        if not os.path.isfile(refs_path):
+            return
+        with open(refs_path, 'r') as f:
+            referenced.update(json.load(f))
+    for name in os.listdir(array_dir):
+        path = os.path.join(array_dir, name)
+        if not name.endswith('.npy') or name in referenced:
+            continue
+        try:
+            if before is None or os.path.getmtime(path) < before:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def load_checkpoint(path, mmap_mode='c'):
+    ''' Loads a state dictionary saved with save_checkpoint'''
+    array_dir = os.path.join(os.path.dirname(path), 'arrays')
+    with open(path, 'rb') as f:
+        return ArrayUnpickler(f, array_dir, mmap_mode).load()
+
 class Loadable(object):
     def __init__(self, name, filename, *args, **kwargs):
         # here we will store the registered
@@ -96,11 +229,22 @@ class Loadable(object):
         # append the zip extension
         if not path.endswith('.zip'):
             path = path+'.zip'
+        # use the array-native checkpoint, if available and more recent
+        ckpt_path = path[:-len('.zip')]+'.ckpt'
+        use_ckpt = os.path.isfile(ckpt_path) and (
+            not os.path.isfile(path) or
+            os.path.getmtime(ckpt_path) >= os.path.getmtime(path))
         try:
-            with open(path, 'rb') as f:
-                utils.print_with_stamp('Loading state from %s'%(path), self.name)
-                state = t_load(f)
+            if use_ckpt:
+                utils.print_with_stamp('Loading state from %s'%(ckpt_path), self.name)
+                state = load_checkpoint(ckpt_path)
                 self.set_instance_state(state)
+            else:
+                from theano.misc.pkl_utils import load as t_load
+                with open(path, 'rb') as f:
+                    utils.print_with_stamp('Loading state from %s'%(path), self.name)
+                    state = t_load(f)
+                    self.set_instance_state(state)
             self.state_changed = False
         except IOError as err:
             utils.print_with_stamp('Unable to load state from %s'%(path), self.name)
@@ -108,36 +252,49 @@ class Loadable(object):
             return False
         return True
 
-    def save(self, output_folder=None, output_filename=None):
+    def save(self, output_folder=None, output_filename=None, fmt=None):
         '''
-        Serializes the class using the theano pickling utility function, and saves it to disk
+        Serializes the class using the theano pickling utility function, and saves it to disk.
+        If fmt is 'npy' (see utils.get_checkpoint_format), the arrays in the state are saved as
+        .npy files that can be memory mapped on load, and only new arrays are written to disk
         '''
+        fmt = utils.get_checkpoint_format() if fmt is None else fmt
         sys.setrecursionlimit(100000)
         output_folder = utils.get_output_dir() if output_folder is None else output_folder
         [output_filename, self.filename] = utils.sync_output_filename(output_filename,
                                                                       self.filename,
                                                                       '.zip')
 
-        if self.state_changed or output_folder is not None or output_filename is not None:
-            # check if output_folder exists, create it if necessary.
-            if not os.path.exists(output_folder):
-                try:
-                    utils.print_with_stamp('creating the directory: %s'%(output_folder),
-                                           self.name)
-                    os.makedirs(output_folder)
-                except OSError:
-                    utils.print_with_stamp('Unable to create the directory: %s'%(output_folder),
-                                           self.name)
-                    raise
-
-            # construct file path
-            path = os.path.join(output_folder, output_filename)
-            # append the zip extension
-            if not path.endswith('.zip'):
-                path = path+'.zip'
-
-            with open(path, 'wb') as f:
-                utils.print_with_stamp('Saving state to %s'%(path), self.name)
-                t_dump(self.get_instance_state(), f, 2)
-            os.system('chmod 666 %s'%(path))
-            self.state_changed = False
+        with utils.timing_span('checkpoint', obj=self.name, format=fmt):
+            if self.state_changed or output_folder is not None or output_filename is not None:
+                # check if output_folder exists, create it if necessary.
+                if not os.path.exists(output_folder):
+                    try:
+                        utils.print_with_stamp('creating the directory: %s'%(output_folder),
+                                               self.name)
+                        os.makedirs(output_folder)
+                    except OSError:
+                        utils.print_with_stamp('Unable to create the directory: %s'%(output_folder),
+                                               self.name)
+                        raise
+
+                # construct file path
+                path = os.path.join(output_folder, output_filename)
+                # append the zip extension
+                if not path.endswith('.zip'):
+                    path = path+'.zip'
+
+                if fmt == 'npy':
+                    path = path[:-len('.zip')]+'.ckpt'
+                    utils.print_with_stamp('Saving state to %s'%(path), self.name)
+                    save_checkpoint(self.get_instance_state(), path)
+                    os.system('chmod 666 %s'%(path))
+                    self.state_changed = False
+                    return
+
+                from theano.misc.pkl_utils import dump as t_dump
+                with open(path, 'wb') as f:
+                    utils.print_with_stamp('Saving state to %s'%(path), self.name)
+                    t_dump(self.get_instance_state(), f, 2)
+                os.system('chmod 666 %s'%(path))
+                self.state_changed = False
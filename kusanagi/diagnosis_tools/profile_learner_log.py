@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
+import numpy as np
 import os
 import sys
+from collections import OrderedDict
 from datetime import datetime
 
+from kusanagi.diagnosis_tools.summarize_timings import plot_stacked
+
 # Print comma-separated timings: dt_all, dt_dyn, dt_pol, dt_end, dt_nxt, t_ini, t_dyn, t_pol, t_end
 def analyse_log(logpath):
   filename = os.path.basename(logpath)
@@ -64,9 +68,10 @@ def analyse_log(logpath):
   print('- Wrote %d lines to %s' % (csvlines, csvpath))
   
   print('- Generating plot: %s' % (pngpath))
-  plot_cmd = 'matlab -nosplash -nodesktop -r "plot_learner_profile(\'%s\', \'%s\', 1, \'%s\'); exit"' % (basename, csvpath, pngpath)
-  print('> ' + plot_cmd)
-  os.system(plot_cmd)
+  data = np.atleast_2d(np.loadtxt(csvpath, delimiter=',', comments='%'))
+  labels = ['Dynamics', 'Policy', 'Save', 'Wait till next']
+  columns = OrderedDict(zip(labels, data[:, 1:5].T))
+  plot_stacked(list(range(1, data.shape[0]+1)), columns, basename, pngpath)
   if os.path.isfile(pngpath):
     print('- Wrote to %s' % pngpath)
   else:
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+Summarizes the timing spans recorded by kusanagi.utils.timing_span (see
+$KUSANAGI_TIMINGS). Prints the time spent per learning iteration in each
+phase of the experiment, totals per span name and, optionally, plots the
+per-iteration timings as a stacked bar chart.
+Usage: summarize_timings.py TIMINGS_FILE [-o PNGPATH]
+'''
+import argparse
+import csv
+import json
+import os
+import sys
+
+from collections import OrderedDict
+
+PHASES = ['dynamics_fit', 'policy_optimization', 'rollout', 'checkpoint']
+
+
+def parse_value(v):
+    for cast in (int, float):
+        try:
+            return cast(v)
+        except (TypeError, ValueError):
+            pass
+    return None if v in ('', 'None') else v
+
+
+def load_timings(path):
+    ''' Loads the timing records from a JSONL or CSV file'''
+    records = []
+    with open(path, 'r') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                counters = row.pop('counters', '') or ''
+                record = dict((k, parse_value(v)) for k, v in row.items())
+                for kv in counters.split(';'):
+                    if '=' in kv:
+                        k, v = kv.split('=', 1)
+                        record[k] = parse_value(v)
+                records.append(record)
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return records
+
+
+def summarize(records, phases=PHASES):
+    ''' Returns the total duration of each phase per iteration, and the
+    number of calls and total duration per span name. Note that the duration
+    of a span includes the duration of any spans nested in it.'''
+    per_iteration = OrderedDict()
+    per_name = OrderedDict()
+    for r in sorted(records, key=lambda r: r['start']):
+        name, duration = r['name'], r['duration']
+        stats = per_name.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        it = r.get('iteration')
+        if it is None:
+            continue
+        it_phases = per_iteration.setdefault(
+            it, OrderedDict((p, 0.0) for p in list(phases)+['compile']))
+        if name in it_phases:
+            it_phases[name] += duration
+    return per_iteration, per_name
+
+
+def print_summary(per_iteration, per_name, out=sys.stdout):
+    if per_iteration:
+        names = list(next(iter(per_iteration.values())).keys())
+        out.write(('%10s' + ' %20s'*len(names) + '\n') % (
+            ('iteration',) + tuple(names)))
+        for it, phases in per_iteration.items():
+            out.write(('%10s' + ' %20.3f'*len(names) + '\n') % (
+                (it,) + tuple(phases.values())))
+        out.write('\n')
+    out.write('%30s %10s %15s %15s\n' % ('span', 'calls', 'total (s)',
+                                         'mean (s)'))
+    for name, (count, total) in per_name.items():
+        out.write('%30s %10d %15.3f %15.6f\n' % (name, count, total,
+                                                 total/count))
+
+
+def plot_stacked(iterations, columns, title, pngpath=None):
+    ''' Plots a stacked bar chart with the durations (in seconds) in columns,
+    an ordered dictionary of label -> list of durations per iteration'''
+    import matplotlib
+    if pngpath is not None:
+        matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+
+    fig = plt.figure(title)
+    fig.clf()
+    bottom = [0.0]*len(iterations)
+    for label, values in columns.items():
+        values = [v/60.0 for v in values]
+        plt.bar(iterations, values, 0.5, bottom=bottom, label=label)
+        bottom = [b + v for b, v in zip(bottom, values)]
+    plt.title('Timings for %s' % (title))
+    plt.xlabel('Episode')
+    plt.ylabel('Duration (min)')
+    plt.legend(loc='upper left')
+    plt.grid(True)
+    if pngpath is not None:
+        fig.savefig(pngpath)
+    else:
+        plt.show()
+    return fig
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('timings_file', type=str,
+                        help='JSONL or CSV file with timing spans')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='where to save the plot of the timings')
+    parser.add_argument('-p', '--plot', action='store_true',
+                        help='whether to show the plot of the timings')
+    args = parser.parse_args()
+
+    records = load_timings(args.timings_file)
+    per_iteration, per_name = summarize(records)
+    print_summary(per_iteration, per_name)
+    if (args.plot or args.output) and per_iteration:
+        iterations = list(per_iteration.keys())
+        columns = OrderedDict(
+            (p, [per_iteration[it][p] for it in iterations]) for p in PHASES)
+        title = os.path.basename(args.timings_file)
+        plot_stacked(iterations, columns, title, args.output)
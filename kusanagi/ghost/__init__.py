@@ -1,5 +1,6 @@
-from . import algorithms
-from . import control
-from . import optimizers
-from . import regression
-from . import transfer
+from kusanagi.utils.lazy import lazy_module
+
+# subpackages are imported when first accessed, e.g. kusanagi.ghost.control
+lazy_module(
+    __name__, submodules=['algorithms', 'control', 'optimizers', 'regression',
+                          'transfer'])
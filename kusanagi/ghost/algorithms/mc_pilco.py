@@ -1,7 +1,11 @@
+import functools
+import lasagne
 import numpy as np
 import theano
 import theano.tensor as tt
 
+from theano.sandbox.rng_mrg import MRG_RandomStreams
+
 from kusanagi import utils
 
 m_rng = utils.get_mrng()
@@ -37,17 +41,111 @@ def propagate_particles(latent_x, measured_x, pol, dyn, angle_dims=[],
     return x_next, sn_x
 
 
+def masked_step(step, n_recurrent, n_non_sequences):
+    '''
+        Wraps a rollout step function, so that it takes a boolean mask as its
+        second argument. On masked steps, the (non recurrent) cost output is
+        set to zero and the recurrent outputs are kept unchanged.
+    '''
+    def step_fn(t_next, valid, *args):
+        outs = step(t_next, *args)
+        n_args = n_recurrent + n_non_sequences
+        prev = args[len(args)-n_args:][:n_recurrent]
+        return [tt.switch(valid, outs[0], tt.zeros_like(outs[0]))] +\
+            [tt.switch(valid, o, p) for o, p in zip(outs[1:], prev)]
+    return step_fn
+
+
+def checkpointed_scan(step, start_idx, end_idx, sequences, outputs_info,
+                      non_sequences, every=True, truncate_gradient=-1,
+                      horizon=None, name=None, mode=None):
+    '''
+        Runs the rollout step function from start_idx to end_idx as a scan
+        over blocks of every steps, where each block is an inner scan. Only
+        the recurrent outputs at the block boundaries are stored for the
+        backward pass; the steps inside each block are recomputed when
+        computing the gradients, so the gradients are exact but the memory
+        used grows as O(H/every + every) instead of O(H). If every is True,
+        the block size is ceil(sqrt(H)). The sequences are padded with zeros
+        to a multiple of the block size; the padded steps leave the recurrent
+        outputs unchanged and their outputs are discarded. If horizon is
+        given, the steps after it are masked in the same way.
+        @param step function with the same signature as the step function of
+                    mc_pilco.rollout
+        @param sequences list of sequences, other than the time index
+        @param outputs_info initial values of the recurrent outputs
+        @return Returns a tuple of (outputs, updts), where outputs are the
+                per step costs and states
+    '''
+    n_steps = end_idx - start_idx
+    if every is True:
+        every = tt.ceil(tt.sqrt(n_steps)).astype('int32')
+    n_blocks = tt.ceil(n_steps*1.0/every).astype('int32')
+    n_padded = n_blocks*every
+
+    def blocks(seq):
+        rest = tuple(seq.shape[i] for i in range(1, seq.ndim))
+        padding = tt.zeros((n_padded - seq.shape[0],) + rest, dtype=seq.dtype)
+        seq = tt.concatenate([seq, padding])
+        return seq.reshape((n_blocks, every) + rest, ndim=seq.ndim+1)
+
+    t = tt.arange(start_idx, start_idx + n_padded)
+    valid = tt.lt(t, end_idx)
+    if horizon is not None:
+        valid = tt.and_(valid, tt.le(t, horizon))
+    sequences = [blocks(t), blocks(valid)] +\
+        [blocks(seq) for seq in sequences]
+    block_step_fn = masked_step(step, len(outputs_info), len(non_sequences))
+
+    def block_step(*args):
+        n_seqs = len(sequences)
+        n_outs = len(outputs_info)
+        block_seqs = list(args[:n_seqs])
+        prev = list(args[n_seqs:n_seqs+n_outs])
+        nseq = list(args[n_seqs+n_outs:])
+        block_output, block_updts = theano.scan(
+            fn=block_step_fn, sequences=block_seqs,
+            outputs_info=[None] + prev, non_sequences=nseq, strict=True,
+            allow_gc=False, name=name+'_block' if name else None, mode=mode)
+        # return the per step costs and states, and the recurrent outputs
+        # at the end of the block
+        costs, states = block_output[:2]
+        return [costs, states] + [o[-1] for o in block_output[1:]],\
+            block_updts
+
+    if truncate_gradient != -1:
+        # truncation is rounded up to whole blocks
+        truncate_gradient = tt.ceil(
+            (n_steps-truncate_gradient)*1.0/every).astype('int32')
+    output, updts = theano.scan(
+        fn=block_step, sequences=sequences,
+        outputs_info=[None, None] + list(outputs_info),
+        non_sequences=non_sequences, strict=True,
+        truncate_gradient=truncate_gradient, name=name, mode=mode)
+
+    def unblock(out):
+        rest = tuple(out.shape[i] for i in range(2, out.ndim))
+        return out.reshape((n_padded,) + rest, ndim=out.ndim-1)[:n_steps]
+
+    costs, states = output[:2]
+    return [unblock(costs), unblock(states)], updts
+
+
 def rollout(x0, H, gamma0,
             pol, dyn, cost,
             z=None, mm_state=True, mm_cost=True,
             noisy_policy_input=True, noisy_cost_input=True,
             time_varying_cost=False, grad_clip=None, infer_noise_mm=False,
             truncate_gradient=-1, extra_shared=[],
-            split_H=1, **kwargs):
+            split_H=1, checkpoint_every=None, max_H=None, **kwargs):
     ''' Given some initial state particles x0, and a prediction horizon H
     (number of timesteps), returns a set of trajectories sampled from the
     dynamics model and the discounted costs for each step in the
-    trajectory.
+    trajectory. If checkpoint_every is set, the rollout is computed with
+    checkpointed_scan, storing the state only every checkpoint_every steps
+    (or about every sqrt(H) steps, if True) for the backward pass. If max_H
+    is set, the rollout always runs for max_H steps, and the steps after H
+    are masked; i.e. the states stay constant and the costs are zero.
     '''
     msg = 'Building computation graph for rollout'
     utils.print_with_stamp(msg, 'mc_pilco.rollout')
@@ -143,22 +241,44 @@ def rollout(x0, H, gamma0,
     # loop over the planning horizon
     mode = theano.compile.mode.get_mode('FAST_RUN')
     costs, trajectories = [], [x0[None, :, :]]
+    horizon = None
+    if max_H is not None:
+        # the graph doesn't depend on the actual horizon, so it can be used
+        # for any H <= max_H
+        horizon, H = H, max_H
     # if split_H > 1, this results in truncated BPTT
     H_ = tt.ceil(H*1.0/split_H).astype('int32')
     for i in range(1, split_H+1):
         start_idx = (i-1)*H_ + 1
         end_idx = start_idx + H_
 
-        output = theano.scan(
-            fn=step_rollout, sequences=[tt.arange(start_idx, end_idx),
-                                        z[0, start_idx:end_idx],
-                                        z[1, start_idx:end_idx],
-                                        z[1, -end_idx:-start_idx]],
-            outputs_info=[None, x0, 1e-4*tt.ones_like(x0), gamma0],
-            non_sequences=nseq, strict=True, allow_gc=False,
-            truncate_gradient=H_-truncate_gradient,
-            name="mc_pilco>rollout_scan_%d" % i,
-            mode=mode)
+        t = tt.arange(start_idx, end_idx)
+        seqs = [z[0, start_idx:end_idx], z[1, start_idx:end_idx],
+                z[1, -end_idx:-start_idx]]
+        outputs_info = [x0, 1e-4*tt.ones_like(x0), gamma0]
+        if checkpoint_every:
+            output = checkpointed_scan(
+                step_rollout, start_idx, end_idx, seqs, outputs_info, nseq,
+                every=checkpoint_every, truncate_gradient=truncate_gradient,
+                horizon=horizon, name="mc_pilco>rollout_scan_%d" % i,
+                mode=mode)
+        elif horizon is not None:
+            output = theano.scan(
+                fn=masked_step(step_rollout, len(outputs_info), len(nseq)),
+                sequences=[t, tt.le(t, horizon)] + seqs,
+                outputs_info=[None] + outputs_info,
+                non_sequences=nseq, strict=True, allow_gc=False,
+                truncate_gradient=H_-truncate_gradient,
+                name="mc_pilco>rollout_scan_%d" % i,
+                mode=mode)
+        else:
+            output = theano.scan(
+                fn=step_rollout, sequences=[t] + seqs,
+                outputs_info=[None] + outputs_info,
+                non_sequences=nseq, strict=True, allow_gc=False,
+                truncate_gradient=H_-truncate_gradient,
+                name="mc_pilco>rollout_scan_%d" % i,
+                mode=mode)
 
         rollout_output, rollout_updts = output
         costs_i, trajectories_i = rollout_output[:2]
@@ -180,12 +300,44 @@ def rollout(x0, H, gamma0,
     return [costs, trajectories], rollout_updts
 
 
+def common_random_numbers(size, n_evals, period=500, seed=None):
+    '''
+        Returns standard normal samples of the given (symbolic) size, that
+        are the same on every evaluation until they are resampled, every
+        period evaluations. The samples are not stored: they are regenerated
+        on every evaluation from the state of a dedicated random stream,
+        which is only advanced when resampling. This keeps the memory used
+        proportional to the size of the samples for the current evaluation.
+        @param size shape of the samples, e.g. (2, H+1, n_samples, D)
+        @param n_evals shared variable with the number of evaluations so far
+        @param period number of evaluations between resampling
+        @param seed seed for the random stream
+        @return Returns a tuple of (z, rng, updts). These correspond to the
+                samples, the random stream (which can be reseeded) and the
+                updates that advance the random stream state.
+    '''
+    if seed is None:
+        seed = np.random.randint(1, 2147462579)
+    rng = MRG_RandomStreams(seed)
+    z = rng.normal(size)
+    updates = theano.updates.OrderedUpdates()
+    for state_update in rng.state_updates:
+        rstate, new_rstate = state_update[:2]
+        # the state is updated explicitly, only when resampling
+        if hasattr(rstate, 'default_update'):
+            del rstate.default_update
+        updates[rstate] = theano.ifelse.ifelse(
+            tt.eq((n_evals + 1) % period, 0), new_rstate, rstate)
+    return z, rng, updates
+
+
 def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
              intermediate_outs=False, mm_state=True, mm_cost=True,
              noisy_policy_input=True, noisy_cost_input=False,
              time_varying_cost=False, resample_dyn=False, crn=True,
              average=True, minmax=False, grad_clip=None, truncate_gradient=-1,
              split_H=1, extra_shared=[], extra_updts_init=None,
+             crn_seed=None, n_shards=1, adaptive_samples=None, max_H=None,
              **kwargs):
     '''
         Constructs the computation graph for the value function according to
@@ -218,7 +370,35 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
                            If True, the cost function will be called as
                            cost(t, x); i.e. the first argument will be the
                            timestep index t.
-        @param crn wheter to use common random numbers.
+        @param crn wheter to use common random numbers. If an int, the
+                   number of evaluations after which the common random
+                   numbers are resampled (500 by default)
+        @param crn_seed seed for the stream of common random numbers
+        @param checkpoint_every if set, only the states every
+                                checkpoint_every steps (about every sqrt(H)
+                                steps, if True) are stored for computing
+                                the gradients. The rest are recomputed, see
+                                checkpointed_scan.
+        @param n_shards number of processes the particles will be split
+                        across. The graph is built for a single shard (i.e.
+                        with ceil(n_samples/n_shards) particles), and the
+                        loss is tagged so that the SGDOptimizer evaluates it
+                        on n_shards forked processes, averaging the losses
+                        and gradients. Since the loss is an average over
+                        particles, this is exact when mm_state, mm_cost and
+                        minmax are False; otherwise the moment matching is
+                        done over the particles of each shard.
+        @param adaptive_samples if set (True, or a dictionary of options for
+                                ParticleController), the number of particles
+                                is stored in a shared variable and the loss
+                                is tagged with a ParticleController, which
+                                adapts it between optimizer updates from the
+                                per particle costs. Requires mm_cost=False
+                                and n_shards=1.
+        @param max_H if set, the rollout is built for a maximum horizon of
+                     max_H steps, with the steps after the horizon H masked,
+                     so the compiled loss can be reused for any H <= max_H.
+                     The costs are still averaged over the first H steps.
         @return Returns a tuple of (outs, inps, updts). These correspond to the
                 output variables, input variables and updates dictionary, if
                 any.
@@ -227,6 +407,16 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
     # get angle dims from policy, if any
     if len(angle_dims) == 0 and hasattr(pol, 'angle_dims'):
         angle_dims = pol.angle_dims
+    if adaptive_samples and n_shards > 1:
+        # the number of particles of each shard is a shared variable in
+        # its own process, which the controller in this one can't update
+        raise ValueError(
+            'Adapting the number of particles is not supported with shards')
+    if n_shards > 1:
+        n_samples = int(np.ceil(float(n_samples)/n_shards))
+        utils.print_with_stamp(
+            "Splitting particles into %d shards of %d samples" % (
+                n_shards, n_samples), 'mc_pilco.rollout')
     # make sure that the dynamics model has the same number of samples
     if hasattr(dyn, 'update'):
         dyn.update(n_samples)
@@ -243,11 +433,18 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
     gamma = tt.scalar('gamma')
     # how many times we've done a forward pass
     n_evals = theano.shared(0)
-    # new samples with every rollout
-    z = m_rng.normal((2, H+1, n_samples, mx0.shape[0]))
-
-    # sample random numbers to be used in the rollout
+    if adaptive_samples:
+        if mm_cost:
+            raise ValueError(
+                'Adapting the number of particles requires mm_cost=False')
+        # the number of particles can change without recompiling
+        n_samples = theano.shared(np.array(n_samples, dtype='int32'),
+                                  name='mc_pilco>n_samples')
+
+    # random numbers used in the rollout
+    z_size = (2, (H if max_H is None else max_H)+1, n_samples, mx0.shape[0])
     updates = theano.updates.OrderedUpdates()
+    crn_rng = None
     if crn:
         utils.print_with_stamp(
             "Using common random numbers for moment matching",
@@ -259,20 +456,13 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
         utils.print_with_stamp(
             "CRNs will be resampled every %d rollouts" % crn,
             "mc_pilco.rollout")
-        z_resampled = z
-        z_init = np.random.normal(
-            size=(2, 1000, n_samples, dyn.E)).astype(theano.config.floatX)
-        z = theano.shared(z_init)
-        updates[z] = theano.ifelse.ifelse(
-            tt.eq(n_evals % crn, 0), z_resampled, z)
+        z, crn_rng, crn_updts = common_random_numbers(
+            z_size, n_evals, crn, crn_seed)
+        updates += crn_updts
         updates[n_evals] = n_evals + 1
-
-        # now we will make sure that z is has the correct shape
-        z = theano.ifelse.ifelse(
-            z.shape[1] < H,
-            tt.tile(z, (1, tt.ceil(H/z.shape[0]).astype('int64'), 1, 1)),
-            z
-        )[:H+1]
+    else:
+        # new samples with every rollout
+        z = m_rng.normal(z_size)
 
     # draw initial set of particles
     z0 = m_rng.normal((n_samples, mx0.shape[0]))
@@ -303,10 +493,14 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
                             noisy_policy_input=noisy_policy_input,
                             noisy_cost_input=noisy_cost_input,
                             time_varying_cost=time_varying_cost,
-                            extra_shared=extra_shared, **kwargs)
+                            extra_shared=extra_shared, max_H=max_H,
+                            **kwargs)
 
     costs, trajectories = r_outs
-    acc_costs = costs.mean(-1, keepdims=True) if average\
+    # number of steps to average over (the masked steps have zero cost)
+    T = costs.shape[-1] if max_H is None else H
+    T = T.astype(theano.config.floatX)
+    acc_costs = costs.sum(-1, keepdims=True)/T if average\
         else costs.sum(-1, keepdims=True)
     if minmax and not mm_cost:
         temp = acc_costs.std()
@@ -315,7 +509,7 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
         weights = tt.nnet.softmax((acc_costs - acc_costs.mean(0)).T/temp).T
         weights_ = theano.gradient.disconnected_grad(weights)
         wcosts = costs*weights_
-        loss = wcosts.sum(0).mean() if average else wcosts.sum(0).sum()
+        loss = wcosts.sum(0).sum()/T if average else wcosts.sum(0).sum()
         entropy = -(weights*tt.log(weights)).sum()
         reg_weight = -1e-3
         loss += reg_weight*entropy
@@ -328,12 +522,126 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
     updates += updts
     if callable(extra_updts_init):
         updates += extra_updts_init(loss, costs, trajectories)
+    if adaptive_samples:
+        opts = adaptive_samples if isinstance(adaptive_samples, dict) else {}
+        loss.tag.particle_controller = ParticleController(
+            n_samples, [pol, dyn], acc_costs.flatten(), **opts)
+    if n_shards > 1:
+        loss.tag.n_shards = n_shards
+        loss.tag.init_shard = functools.partial(
+            init_shard, [pol, dyn], crn_rng)
     if intermediate_outs:
         return [loss, costs, trajectories], inps, updates
     else:
         return loss, inps, updates
 
 
+def init_shard(models, crn_rng=None, seed=None):
+    '''
+        Prepares the random numbers of a particle shard. If a seed is given,
+        the random number generators of the particles, the models' noise
+        layers and the common random numbers are reseeded, so that
+        every shard draws different particles. The fixed dropout masks of the
+        models are always resampled.
+    '''
+    if seed is not None:
+        rng = np.random.RandomState(seed)
+        m_rng.seed(rng.randint(1, 2147462579))
+        for model in models:
+            network = getattr(model, 'network', None)
+            if network is None:
+                continue
+            for layer in lasagne.layers.get_all_layers(network):
+                if hasattr(layer, '_srng'):
+                    layer._srng.seed(rng.randint(1, 2147462579))
+        if crn_rng is not None:
+            crn_rng.seed(rng.randint(1, 2147462579))
+    for model in models:
+        if hasattr(model, 'update'):
+            model.update()
+
+
+class ParticleController(object):
+    '''
+        Adapts the number of particles used by the mc_pilco loss between
+        optimizer updates, without recompiling it. After every update, the
+        standard error of the value estimate is computed from the per
+        particle costs, and compared with the change of the loss between
+        updates. Every interval updates, the number of particles is scaled
+        so that the (smoothed) standard error is about theta times the
+        (smoothed) change of the loss: few particles early in the
+        optimization, when the loss changes quickly, and more particles
+        close to convergence, when the noise dominates. The number of
+        particles changes by at most a factor of 2 each time.
+    '''
+    def __init__(self, n_samples, models, costs, min_samples=10,
+                 max_samples=1000, theta=1.0, interval=10, smoothing=0.9,
+                 name='ParticleController'):
+        '''
+            @param n_samples shared variable with the number of particles
+            @param models models whose dropout masks need to be resized
+                          when the number of particles changes
+            @param costs symbolic per particle costs. Their values should be
+                         passed to update
+        '''
+        self.n_samples = n_samples
+        self.models = models
+        self.costs = costs
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.theta = theta
+        self.interval = interval
+        self.smoothing = smoothing
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        ''' Clears the statistics, e.g. before starting a new optimization'''
+        self.prev_loss = None
+        self.noise = None
+        self.signal = None
+        self.n_updates = 0
+
+    def smooth(self, avg, value):
+        if avg is None:
+            return value
+        return self.smoothing*avg + (1 - self.smoothing)*value
+
+    def set_n_samples(self, n_samples):
+        self.n_samples.set_value(np.array(n_samples, dtype='int32'))
+        for model in self.models:
+            if hasattr(model, 'update'):
+                model.update(n_samples)
+
+    def update(self, loss, costs):
+        '''
+            Updates the statistics with the loss and per particle costs of
+            the last evaluation, and adapts the number of particles every
+            interval calls. Returns the number of particles.
+        '''
+        costs = np.asarray(costs).flatten()
+        n = costs.size
+        self.noise = self.smooth(self.noise, costs.std(ddof=1)/np.sqrt(n))
+        if self.prev_loss is not None:
+            self.signal = self.smooth(
+                self.signal, abs(float(loss) - self.prev_loss))
+        self.prev_loss = float(loss)
+        self.n_updates += 1
+        if self.n_updates % self.interval != 0 or not self.signal:
+            return n
+
+        target = n*(self.noise/(self.theta*self.signal))**2
+        new_n = int(np.clip(target, n/2.0, 2.0*n))
+        new_n = int(np.clip(new_n, self.min_samples, self.max_samples))
+        if abs(new_n - n) > 0.1*n:
+            utils.print_with_stamp(
+                'Changing the number of particles from %d to %d' % (
+                    n, new_n), self.name)
+            self.set_n_samples(new_n)
+            n = new_n
+        return n
+
+
 def build_rollout(*args, **kwargs):
     kwargs['intermediate_outs'] = True
     outs, inps, updts = get_loss(*args, **kwargs)
@@ -1,9 +1,12 @@
+import lasagne
 import numpy as np
 import theano
 import theano.tensor as tt
 
-from kusanagi.ghost.regression import BNN
-from kusanagi.ghost.control.saturation import sfunc, tanhSat as sat
+from kusanagi.ghost.regression import BNN, layers
+from kusanagi.ghost.control.saturation import (sfunc, tanhSat as sat,
+                                               sat_func_spec)
+from kusanagi.ghost.control.numpy_policy import NumpyNNPolicy, NONLINEARITIES
 from functools import partial
 
 
@@ -81,3 +84,47 @@ class NNPolicy(BNN):
 
     def __call__(self, m, s=None, t=None, **kwargs):
         return super(NNPolicy, self).__call__(m, s, **kwargs)
+
+    def export_numpy(self, filename=None):
+        ''' Returns a NumpyNNPolicy that evaluates this policy with
+        deterministic=True (i.e. without dropout noise). If filename is given,
+        it is also saved there (see numpy_policy.load_numpy_policy)'''
+        if self.network is None:
+            params = self.network_params\
+                     if self.network_params is not None\
+                     else {}
+            self.build_network(self.network_spec, params=params,
+                               name=self.name)
+        # these layers are the identity when deterministic=True
+        noise_layers = (lasagne.layers.DropoutLayer,
+                        lasagne.layers.GaussianNoiseLayer,
+                        layers.GaussianDropoutLayer)
+        dense_layers = []
+        for l in lasagne.layers.get_all_layers(self.network)[1:]:
+            if isinstance(l, noise_layers):
+                continue
+            if not isinstance(l, lasagne.layers.DenseLayer):
+                msg = 'Cannot export layer %s of type %s'
+                raise ValueError(msg % (l.name, type(l).__name__))
+            f, a = l.nonlinearity, None
+            if isinstance(f, lasagne.nonlinearities.LeakyRectify):
+                f, a = 'leaky_rectify', float(f.leakiness)
+            else:
+                f = f.__name__
+            if f not in NONLINEARITIES:
+                msg = 'Cannot export layer %s with nonlinearity %s'
+                raise ValueError(msg % (l.name, f))
+            b = l.b.get_value() if l.b is not None else None
+            dense_layers.append((l.W.get_value(), b, f, a))
+
+        whitening = {}
+        for k in ['Xm', 'iXs', 'Ym', 'Ys']:
+            v = getattr(self, k, None)
+            whitening[k] = v.get_value() if v is not None else None
+        sat_type, scale, offset = sat_func_spec(self.sat_func)
+        pol = NumpyNNPolicy(dense_layers, sat_type=sat_type, scale=scale,
+                            offset=offset, maxU=self.maxU, minU=self.minU,
+                            name=self.name+'_numpy', **whitening)
+        if filename is not None:
+            pol.save(filename)
+        return pol
@@ -1,2 +1,14 @@
-from .control_ import *
-from .NNPolicy import *
+from kusanagi.utils.lazy import lazy_module
+
+# the policies are imported when first accessed, so that numpy_policy can be
+# used without importing theano
+lazy_module(
+    __name__,
+    submodules=['control_', 'numpy_policy', 'saturation'],
+    attributes={'RBFPolicy': 'control_', 'RandPolicy': 'control_',
+                'LocalLinearPolicy': 'control_', 'AdjustedPolicy': 'control_',
+                'NNPolicy': 'NNPolicy',
+                'NumpyPolicy': 'numpy_policy',
+                'NumpyRBFPolicy': 'numpy_policy',
+                'NumpyNNPolicy': 'numpy_policy',
+                'load_numpy_policy': 'numpy_policy'})
@@ -5,7 +5,8 @@ import theano.tensor as tt
 
 from kusanagi import utils
 from kusanagi.ghost.regression import RBFGP, SSGP_UI
-from kusanagi.ghost.control.saturation import sfunc, gSat
+from kusanagi.ghost.control.saturation import sfunc, gSat, sat_func_spec
+from kusanagi.ghost.control.numpy_policy import NumpyRBFPolicy
 
 from kusanagi.base.Loadable import Loadable
 from functools import partial
@@ -115,6 +116,22 @@ class RBFPolicy(RBFGP):
     def __call__(self, m, s=None, t=None, **kwargs):
         return super(RBFPolicy, self).__call__(m, s, **kwargs)
 
+    def export_numpy(self, filename=None):
+        ''' Returns a NumpyRBFPolicy that evaluates the mean of this policy
+        for deterministic inputs. If filename is given, it is also saved there
+        (see numpy_policy.load_numpy_policy)'''
+        hyp, beta = [v if isinstance(v, np.ndarray) else v.eval()
+                     for v in [self.hyp, self.beta]]
+        X = self.X.get_value()
+        sat_type, scale, offset = sat_func_spec(self.sat_func)
+        pol = NumpyRBFPolicy(X, beta, hyp[:, :self.D], hyp[:, self.D]**2,
+                             sat_type=sat_type, scale=scale, offset=offset,
+                             maxU=self.maxU, minU=self.minU,
+                             name=self.name+'_numpy')
+        if filename is not None:
+            pol.save(filename)
+        return pol
+
 
 # random controller
 class RandPolicy:
@@ -0,0 +1,209 @@
+'''
+Lightweight NumPy evaluators for trained policies. Policies are exported with
+RBFPolicy.export_numpy or NNPolicy.export_numpy to a .npz file, which can be
+loaded with load_numpy_policy. This module only depends on numpy, so it can be
+used in control loops without importing theano.
+'''
+import json
+import numpy as np
+
+
+def _softplus(x):
+    return np.logaddexp(0, x)
+
+
+def _sigmoid(x):
+    return 1.0/(1.0 + np.exp(-x))
+
+
+def _phi(x):
+    from scipy.special import erfc
+    return 0.5*erfc(-x/np.sqrt(2))
+
+
+NONLINEARITIES = {
+    'linear': lambda x, a=None: x,
+    'identity': lambda x, a=None: x,
+    'rectify': lambda x, a=None: np.maximum(x, 0, out=x),
+    'leaky_rectify': lambda x, a: np.maximum(x, a*x, out=x),
+    'tanh': lambda x, a=None: np.tanh(x, out=x),
+    'sigmoid': lambda x, a=None: _sigmoid(x),
+    'softplus': lambda x, a=None: _softplus(x),
+    'elu': lambda x, a=None: np.where(x > 0, x, np.expm1(x)),
+    'silu': lambda x, a=None: x*_sigmoid(x),
+    'gelu': lambda x, a=None: x*_phi(x),
+    'rbf': lambda x, a=None: np.exp(-x**2),
+}
+
+
+def saturate(u, sat_type, scale, offset):
+    ''' NumPy version of the deterministic saturating functions in
+    kusanagi.ghost.control.saturation'''
+    if sat_type is None:
+        return u
+    if sat_type == 'gSat':
+        u = scale*(9*np.sin(u) + np.sin(3*u))/8
+    elif sat_type == 'tanhSat':
+        u = scale*np.tanh(u)
+    elif sat_type == 'sigmoidSat':
+        u = scale*(2*_sigmoid(u) - 1)
+    elif sat_type == 'maxSat':
+        u = np.minimum(np.maximum(u, -scale), scale)
+    else:
+        raise ValueError('Unsupported saturation function %s' % (sat_type))
+    return u + offset
+
+
+class NumpyPolicy(object):
+    ''' Base class for policies evaluated with numpy. Calling the policy
+    returns the control signal, and zero output and input-output covariances,
+    like control.RandPolicy'''
+    def __init__(self, D, E, sat_type=None, scale=None, offset=None,
+                 maxU=None, minU=None, name='NumpyPolicy'):
+        self.D = D
+        self.E = E
+        self.name = name
+        self.sat_type = sat_type
+        self.scale = scale
+        self.offset = offset
+        self.maxU = maxU
+        self.minU = minU
+        self.S = np.zeros((E, E))
+        self.C = np.zeros((D, E))
+
+    def predict(self, x):
+        msg = "You need to implement self.predict in your NumpyPolicy subclass"
+        raise NotImplementedError(msg)
+
+    def __call__(self, m, s=None, t=None, **kwargs):
+        u = self.predict(m)
+        u = saturate(u, self.sat_type, self.scale, self.offset)
+        return u, self.S, self.C
+
+    def get_arrays(self):
+        return {}
+
+    def save(self, path):
+        meta = dict(cls=type(self).__name__, D=self.D, E=self.E,
+                    name=self.name, sat_type=self.sat_type,
+                    **self.get_meta())
+        arrays = dict(self.get_arrays())
+        for k in ['scale', 'offset', 'maxU', 'minU']:
+            if getattr(self, k) is not None:
+                arrays[k] = np.asarray(getattr(self, k))
+        np.savez(path, meta=np.array(json.dumps(meta)), **arrays)
+
+    def get_meta(self):
+        return {}
+
+
+class NumpyRBFPolicy(NumpyPolicy):
+    ''' Evaluates the predictive mean of an RBFPolicy for deterministic
+    inputs. X are the centers (N x D), beta the weights (E x N), lscales the
+    lengthscales (E x D) and sf2 the signal variances (E)'''
+    def __init__(self, X, beta, lscales, sf2, **kwargs):
+        N, D = X.shape
+        E = beta.shape[0]
+        super(NumpyRBFPolicy, self).__init__(D, E, **kwargs)
+        self.X = X
+        self.beta = beta
+        self.lscales = lscales
+        self.sf2 = sf2
+        self.iL = 1.0/lscales
+
+        # preallocated buffers
+        self.zeta = np.empty((N, D), dtype=X.dtype)
+        self.inp = np.empty((E, N, D), dtype=X.dtype)
+        self.l = np.empty((E, N), dtype=X.dtype)
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=self.X.dtype)
+        if x.ndim > 1:
+            return np.stack([self.predict(xi) for xi in x])
+        np.subtract(self.X, x, out=self.zeta)
+        np.multiply(self.iL[:, None, :], self.zeta[None, :, :], out=self.inp)
+        np.square(self.inp, out=self.inp)
+        np.sum(self.inp, -1, out=self.l)
+        self.l *= -0.5
+        np.exp(self.l, out=self.l)
+        self.l *= self.beta
+        return self.l.sum(1)*self.sf2
+
+    def get_arrays(self):
+        return dict(X=self.X, beta=self.beta, lscales=self.lscales,
+                    sf2=self.sf2)
+
+
+class NumpyNNPolicy(NumpyPolicy):
+    ''' Evaluates a feedforward network made of dense layers. layers is a list
+    of (W, b, nonlinearity, nonlinearity_arg) tuples. Inputs are whitened with
+    Xm, iXs and outputs are rescaled with Ys, Ym when available'''
+    def __init__(self, layers, Xm=None, iXs=None, Ym=None, Ys=None,
+                 **kwargs):
+        D = layers[0][0].shape[0]
+        E = Ys.shape[0] if Ys is not None else layers[-1][0].shape[1]
+        super(NumpyNNPolicy, self).__init__(D, E, **kwargs)
+        self.layers = layers
+        self.Xm = Xm
+        self.iXs = iXs
+        self.Ym = Ym
+        self.Ys = Ys
+
+        # preallocated buffers for single inputs
+        self.buffers = [np.empty((1, W.shape[1]), dtype=W.dtype)
+                        for W, b, f, a in layers]
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=self.layers[0][0].dtype)
+        single = x.ndim == 1
+        x = x[None, :] if single else x
+        if self.Xm is not None:
+            x = (x - self.Xm).dot(self.iXs)
+        for i, (W, b, f, a) in enumerate(self.layers):
+            out = self.buffers[i] if single else None
+            h = np.dot(x, W, out=out)
+            if b is not None:
+                h += b
+            x = NONLINEARITIES[f](h, a)
+        y = x[:, :self.E]
+        if self.Ym is not None:
+            y = y.dot(self.Ys) + self.Ym
+        # single outputs may be a view into the preallocated buffers, which
+        # are overwritten on the next call
+        return y[0].copy() if single else y
+
+    def get_arrays(self):
+        arrays = {}
+        for i, (W, b, f, a) in enumerate(self.layers):
+            arrays['W%d' % (i)] = W
+            if b is not None:
+                arrays['b%d' % (i)] = b
+        for k in ['Xm', 'iXs', 'Ym', 'Ys']:
+            if getattr(self, k) is not None:
+                arrays[k] = getattr(self, k)
+        return arrays
+
+    def get_meta(self):
+        return dict(nonlinearities=[(f, a) for W, b, f, a in self.layers])
+
+
+def load_numpy_policy(path):
+    ''' Loads a policy saved with NumpyPolicy.save'''
+    with np.load(path, allow_pickle=False) as f:
+        arrays = dict(f.items())
+    meta = json.loads(str(arrays.pop('meta')))
+    kwargs = dict(sat_type=meta['sat_type'], name=meta['name'])
+    for k in ['scale', 'offset', 'maxU', 'minU']:
+        kwargs[k] = arrays.pop(k, None)
+
+    if meta['cls'] == 'NumpyRBFPolicy':
+        return NumpyRBFPolicy(arrays['X'], arrays['beta'], arrays['lscales'],
+                              arrays['sf2'], **kwargs)
+    elif meta['cls'] == 'NumpyNNPolicy':
+        layers = []
+        for i, (f, a) in enumerate(meta['nonlinearities']):
+            layers.append((arrays['W%d' % (i)], arrays.get('b%d' % (i)),
+                           f, a))
+        whitening = dict((k, arrays.get(k)) for k in ['Xm', 'iXs', 'Ym', 'Ys'])
+        return NumpyNNPolicy(layers, **dict(whitening, **kwargs))
+    raise ValueError('Unknown policy type %s' % (meta['cls']))
@@ -107,3 +107,14 @@ def sigmoidSat(u, e):
 
 def maxSat(u, e):
     return tt.minimum(theano.tensor.maximum(u, -e), e)
+
+
+def sat_func_spec(sat_func):
+    ''' Returns the name, scale and offset of a saturating function built as
+    partial(sfunc, offset, partial(sat, e=scale)), as done by the policy
+    classes. Returns (None, None, None) if sat_func is None.'''
+    if sat_func is None:
+        return None, None, None
+    offset, sat = sat_func.args[:2]
+    scale = sat.keywords.get('e', 1.0)
+    return sat.func.__name__, np.array(scale), np.array(offset)
@@ -1,25 +1,46 @@
 # pylint: disable=C0103
+import multiprocessing
 import numpy as np
 import theano
+from theano.gof import vm
+import theano.tensor as tt
 import time
 from kusanagi import utils
 from scipy.optimize import minimize
 from theano.updates import OrderedUpdates
 import traceback
 
+floatX = theano.config.floatX
+
 SCIPY_MIN_METHODS = ['L-BFGS-B', 'TNC', 'BFGS', 'SLSQP', 'CG']
 
 
+def supports_output_subset(fn):
+    ''' Returns True if the compiled function can compute a subset of its
+    outputs. Only the Stack and CVM virtual machines support this; e.g. the
+    py and debug linkers don't'''
+    vm_types = tuple(getattr(vm, name) for name in ['Stack', 'CVM']
+                     if hasattr(vm, name))
+    return isinstance(getattr(fn, 'fn', None), vm_types)
+
+
 class ScipyOptimizer(object):
     def __init__(self, min_method='L-BFGS-B',
                  max_evals=150,
                  conv_thr=1e-12,
-                 name='ScipyOptimizer'):
+                 name='ScipyOptimizer',
+                 n_starts=1, seed=None, perturbation=0.1, n_workers=None):
         self.min_method = min_method
         self.max_evals = max_evals
         self.conv_thr = conv_thr
         self.name = name
 
+        # multi-start options
+        self.n_starts = n_starts
+        self.seed = seed
+        self.perturbation = perturbation
+        self.n_workers = n_workers
+
         self.loss_fn = None
         self.grads_fn = None
         self.n_evals = 0
@@ -28,6 +49,13 @@ class ScipyOptimizer(object):
         self.best_p = [None, None, self.n_evals]
         self.params = None
         self.callback = None
+        self.loss_trace = []
+
+        # flat buffers for parameter values and gradients
+        self.param_buffer = None
+        self.grad_buffer = None
+        self.param_views = None
+        self.reuse_grad_buffer = False
 
     @property
     def min_method(self):
@@ -60,6 +88,10 @@ class ScipyOptimizer(object):
             @param grads gradients of the loss function. If not provided, will
                          be computed here
         '''
+        if getattr(loss.tag, 'n_shards', 1) > 1:
+            # the loss of a sharded objective is the loss of a single shard
+            raise ValueError(
+                'Sharded losses are only supported by the SGDOptimizer')
         if inputs is None:
             inputs = []
 
@@ -71,55 +103,117 @@ class ScipyOptimizer(object):
                                    self.name)
             grads = theano.grad(loss, params)
 
-        utils.print_with_stamp('Compiling function for loss', self.name)
+        # the gradients are returned as a single flat vector, so they can be
+        # copied directly into the flat gradient buffer
+        flat_grads = tt.concatenate([tt.flatten(g) for g in grads])
 
-        self.loss_fn = theano.function(
-            inputs, loss, updates=updts, allow_input_downcast=True,
-            mode=compilation_mode)
         utils.print_with_stamp('Compiling function for loss+gradients',
                                self.name)
-        self.grads_fn = theano.function(
-            inputs, [loss, ]+grads, updates=updts, allow_input_downcast=True,
-            mode=compilation_mode)
+        self.grads_fn = utils.cached_function(
+            inputs, [loss, theano.Out(flat_grads, borrow=True)],
+            updates=updts, allow_input_downcast=True, mode=compilation_mode)
+        # the loss is evaluated with the same compiled function, skipping the
+        # computation of the gradients
+        self.loss_fn = self.eval_loss
 
         self.n_evals = 0
         self.start_time = 0
         self.iter_time = 0
         self.params = params
 
+    def eval_loss(self, *inputs):
+        '''
+            Evaluates the loss only, using the compiled loss+gradients function
+            (skipping the gradients, if the function supports it)
+        '''
+        if supports_output_subset(self.grads_fn):
+            return self.grads_fn(*inputs, output_subset=[0])[0]
+        return self.grads_fn(*inputs)[0]
+
+    def init_param_buffer(self):
+        '''
+            Allocates contiguous flat buffers for the values and gradients of
+            the optimized parameters, and sets the shared variables to views
+            of the parameter buffer. If the backend copies the values (e.g.
+            when running on the GPU), parameters are set via set_value instead
+        '''
+        p0 = [p.get_value() for p in self.params]
+        size = sum([p.size for p in p0])
+        self.param_buffer = np.empty(size, dtype=floatX)
+        self.grad_buffer = np.empty(size, dtype=np.float64)
+        views = []
+        i = 0
+        for p in p0:
+            v = self.param_buffer[i:i+p.size].reshape(p.shape)
+            v[...] = p
+            views.append(v)
+            i += p.size
+
+        self.param_views = views
+        for sp, v in zip(self.params, views):
+            sp.set_value(v, borrow=True)
+            sv = sp.get_value(borrow=True, return_internal_type=True)
+            if not np.may_share_memory(sv, v):
+                self.param_views = None
+
+        if self.param_views is None:
+            utils.print_with_stamp(
+                'Parameters can not share memory with the flat buffer',
+                self.name)
+            for sp, p in zip(self.params, p0):
+                sp.set_value(p)
+
+    def set_param_values(self, p):
+        '''
+            Sets the values of the optimized parameters
+            @param p list with the values of every parameter
+        '''
+        if self.param_views is not None:
+            for v, p_i in zip(self.param_views, p):
+                v[...] = p_i
+        else:
+            for sp, p_i in zip(self.params, p):
+                sp.set_value(p_i)
+
     def loss_wrapper(self, p, p_shapes, *inputs):
         '''
             Loss function wrapper compatible with scipy optimize
             @param p numpy array with the current evaluation point for the loss
             @param p_shapes array with the shapes of every parameter
         '''
-        # transform flattened parameter vector into array of parameters
-        p = utils.unwrap_params(p, p_shapes)
-
-        # set new parameter values
-        for i in range(len(self.params)):
-            self.params[i].set_value(p[i])
+        if self.param_views is not None:
+            # the shared variables are views of the parameter buffer
+            np.copyto(self.param_buffer, p)
+            p = self.param_views
+        else:
+            # transform flattened parameter vector into array of parameters
+            p = utils.unwrap_params(p, p_shapes)
+            # set new parameter values
+            for i in range(len(self.params)):
+                self.params[i].set_value(p[i])
 
         # compute value + derivatives
-        ret = self.grads_fn(*inputs)
-        loss, dloss = ret[0], ret[1:]
-
-        # flatten gradients
-        dloss = utils.wrap_params(dloss)
+        loss, dloss = self.grads_fn(*inputs)
 
         # cast value and gradients as double precision floats
         # (required by fmin_l_bfgs_b)
-        loss, dloss = (np.array(loss).astype(np.float64),
-                       np.array(dloss).astype(np.float64))
+        loss = np.array(loss).astype(np.float64)
+        np.copyto(self.grad_buffer, dloss)
+        # fmin_l_bfgs_b copies the gradients before the next call, the other
+        # methods may keep references to them
+        dloss = self.grad_buffer
+        if not self.reuse_grad_buffer:
+            dloss = dloss.copy()
 
         # update internal state variables
         self.n_evals += 1
         if loss < self.best_p[0]:
-            self.best_p = [loss, p, self.n_evals]
+            self.best_p = [loss, [p_i.copy() for p_i in p], self.n_evals]
         end_time = time.time()
         iter_time_upt = ((end_time - self.start_time) - self.iter_time)
         iter_time_upt /= self.n_evals
         self.iter_time += iter_time_upt
+        self.loss_trace.append(float(loss))
         msg = 'Current loss: %s, Total evaluations: %d'
         msg += ', Avg. time per call: %f\t'
         utils.print_with_stamp(msg % (str(loss), self.n_evals, self.iter_time),
@@ -136,20 +230,64 @@ class ScipyOptimizer(object):
         '''
             @param inputs python variables to pass as inputs to the compiled
                    theano functions for the loss and gradients
+            @param n_starts number of initial points to optimize from. The
+                   first one is the current value of the parameters, the rest
+                   are random perturbations of it (see multistart)
+            @param seed random seed for the multi-start perturbations
+            @param n_workers number of worker processes for multi-start
+            @return list with the results of every start: final loss,
+                    parameters, number of evaluations, time and loss trace
         '''
-        self.callback = kwargs.get('callback')
-        utils.print_with_stamp('Optimizing parameters', self.name)
+        with utils.timing_span('optimize', optimizer=self.name) as counters:
+            self.callback = kwargs.get('callback')
+            n_starts = kwargs.get('n_starts', self.n_starts)
+            utils.print_with_stamp('Optimizing parameters', self.name)
 
-        # set initial loss and parameters
-        loss0 = self.loss_fn(*inputs)
-        utils.print_with_stamp('Initial loss [%s]' % (loss0), self.name)
-        p0 = [p.get_value() for p in self.params]
+            # set initial loss and parameters
+            loss0 = self.loss_fn(*inputs)
+            utils.print_with_stamp('Initial loss [%s]' % (loss0), self.name)
+            p0 = [p.get_value() for p in self.params]
+
+            if n_starts > 1:
+                results = self.multistart(
+                    p0, inputs, n_starts, seed=kwargs.get('seed', self.seed),
+                    n_workers=kwargs.get('n_workers', self.n_workers))
+            else:
+                results = [self.run_start(p0, inputs, loss0)]
+
+            # keep the best result (the first one, in case of ties)
+            best = min(results, key=lambda r: r['loss'])
+            for sp_i, p_i in zip(self.params, best['params']):
+                sp_i.set_value(p_i)
+            v = self.loss_fn(*inputs)
+            msg = 'Done training. New loss [%f] iter: [%d]'
+            utils.print_with_stamp(msg % (v, best['best_eval']), self.name)
+            counters.update(n_starts=len(results),
+                            n_evals=sum(r['n_evals'] for r in results),
+                            initial_loss=float(loss0), loss=float(v))
+            return results
+
+    def run_start(self, p0, inputs, loss0=None, start=0):
+        '''
+            Runs the optimizer from the initial parameters p0
+            @param p0 list with the initial values of the parameters
+            @param inputs python variables to pass as inputs to the compiled
+                   theano functions for the loss and gradients
+            @param loss0 loss at p0. Will be evaluated if not provided
+            @param start index of this start (for multi-start optimization)
+        '''
+        start_time = time.time()
+        self.init_param_buffer()
+        if loss0 is None:
+            self.set_param_values(p0)
+            loss0 = self.loss_fn(*inputs)
         self.best_p = [loss0, p0, 0]
+        self.loss_trace = []
 
         # get parameter shapes
         p_shapes = [p.shape for p in p0]
         mloss = utils.MemoizeJac(self.loss_wrapper,
-                                 args=(p_shapes,)+inputs)
+                                 args=(p_shapes,)+tuple(inputs))
 
         # keep on trying to optimize with all the methods, until one succeeds,
         # or we go through all of them
@@ -160,6 +298,7 @@ class ScipyOptimizer(object):
             try:
                 utils.print_with_stamp("Using %s optimizer" % (min_method),
                                        self.name)
+                self.reuse_grad_buffer = min_method.lower() == 'l-bfgs-b'
                 p0_wrapped = utils.wrap_params(p0)
                 opts = {'maxiter': self.max_evals,
                         'ftol': 1e5*np.finfo(float).eps,
@@ -176,8 +315,7 @@ class ScipyOptimizer(object):
                                    options=opts)
                 # set params to new values
                 popt = utils.unwrap_params(opt_res.x, p_shapes)
-                for i in range(len(self.params)):
-                    self.params[i].set_value(popt[i])
+                self.set_param_values(popt)
                 # break the loop since we succeeded
                 break
             except (ValueError, np.linalg.LinAlgError):
@@ -188,12 +326,73 @@ class ScipyOptimizer(object):
                 utils.print_with_stamp(msg % (self.min_method),
                                        self.name)
                 loss, popt = self.best_p[:2]
-                for i in range(len(self.params)):
-                    self.params[i].set_value(popt[i])
+                self.set_param_values(popt)
         print('')
         v, p, i = self.best_p
-        for sp_i, p_i in zip(self.params, p):
-            sp_i.set_value(p_i)
-        v = self.loss_fn(*inputs)
-        msg = 'Done training. New loss [%f] iter: [%d]'
-        utils.print_with_stamp(msg % (v, i), self.name)
+        return {'start': start, 'loss': float(v), 'params': p,
+                'initial_loss': float(loss0), 'n_evals': self.n_evals,
+                'best_eval': i, 'time': time.time() - start_time,
+                'loss_trace': np.array(self.loss_trace)}
+
+    def multistart(self, p0, inputs, n_starts, seed=None, n_workers=None):
+        '''
+            Optimizes from n_starts initial points concurrently, using a pool
+            of forked worker processes. Each worker inherits its own copy of
+            the compiled loss+gradients function. Start 0 uses p0; the others
+            add gaussian noise to p0, scaled by self.perturbation times the
+            magnitude of every parameter. The results are deterministic given
+            the seed. Callbacks are executed in the worker processes.
+            @param p0 list with the initial values of the parameters
+            @param inputs python variables to pass as inputs to the compiled
+                   theano functions for the loss and gradients
+            @param n_starts number of initial points
+            @param seed random seed for the perturbations
+            @param n_workers number of worker processes. Defaults to the
+                   number of cpus. If 1, the starts are run sequentially
+        '''
+        global _multistart_args
+        rng = np.random.RandomState(seed)
+        p0s = [p0]
+        for k in range(1, n_starts):
+            p0s.append([
+                (p + self.perturbation*np.maximum(np.abs(p), 1e-1)
+                 * rng.standard_normal(np.shape(p))).astype(p.dtype)
+                for p in p0])
+
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        n_workers = min(n_workers, n_starts)
+        msg = 'Optimizing from %d initial points with %d workers'
+        utils.print_with_stamp(msg % (n_starts, n_workers), self.name)
+
+        _multistart_args = (self, p0s, inputs)
+        try:
+            if n_workers > 1:
+                ctx = multiprocessing.get_context('fork')
+                pool = ctx.Pool(n_workers)
+                try:
+                    results = pool.map(_multistart_worker, range(n_starts))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [_multistart_worker(k) for k in range(n_starts)]
+        finally:
+            _multistart_args = None
+
+        for r in results:
+            msg = 'Start [%d]: loss [%f] -> [%f], evals: [%d], time: [%f s]'
+            utils.print_with_stamp(
+                msg % (r['start'], r['initial_loss'], r['loss'],
+                       r['n_evals'], r['time']), self.name)
+        return results
+
+
+# optimizer, initial points and inputs for the multi-start workers. This is
+# inherited by the forked processes, so the compiled functions are not pickled
+_multistart_args = None
+
+
+def _multistart_worker(start):
+    optimizer, p0s, inputs = _multistart_args
+    return optimizer.run_start(p0s[start], inputs, start=start)
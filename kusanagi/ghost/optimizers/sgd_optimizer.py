@@ -1,9 +1,11 @@
 # pylint: disable=C0103
 from __future__ import print_function
 import lasagne
+import multiprocessing
 import numpy as np
 import theano
 import time
+import traceback
 
 from collections import OrderedDict
 from theano.updates import OrderedUpdates
@@ -41,6 +43,7 @@ class SGDOptimizer(object):
         self.best_p = [None, None, self.n_evals]
         self.params = None
         self.callback = None
+        self.shards = None
 
     @property
     def min_method(self):
@@ -53,7 +56,8 @@ class SGDOptimizer(object):
     def set_objective(self, loss, params, inputs=None, updts=None,
                       outputs=[], output_grads=False, grads=None,
                       polyak_averaging=None, clip=None, trust_input=True,
-                      compilation_mode=None, **kwargs):
+                      compilation_mode=None, n_shards=None, shard_seed=None,
+                      **kwargs):
         '''
             Changes the objective function to be optimized
             @param loss theano graph representing the loss to be optimized
@@ -68,6 +72,15 @@ class SGDOptimizer(object):
                                 callbacks
             @param grads gradients of the loss function. If not provided, will
                          be computed here
+            @param n_shards number of worker processes evaluating the loss
+                            and gradients, each on its own shard of the
+                            objective (see mc_pilco.get_loss). The loss is
+                            the loss of a single shard; the losses and
+                            gradients of all shards are averaged before
+                            applying the updates. Defaults to the n_shards
+                            tag of the loss, if any, or 1
+            @param shard_seed seed for initializing the random numbers of
+                              every shard
             @param kwargs arguments to pass to the lasagne.updates function
         '''
         if inputs is None:
@@ -76,7 +89,39 @@ class SGDOptimizer(object):
         if updts is not None:
             updts = OrderedUpdates(updts)
 
-        if grads is None:
+        # converts inputs to shared variables to avoid repeated gpu transfers
+        self.shared_inpts = [theano.shared(np.empty([1]*inp.ndim,
+                                           dtype=inp.dtype),
+                                           name=inp.name) for inp in inputs]
+        givens_dict = dict(zip(inputs, self.shared_inpts))
+
+        if n_shards is None:
+            n_shards = getattr(loss.tag, 'n_shards', 1)
+        self.close()
+        if n_shards > 1:
+            if polyak_averaging:
+                raise ValueError(
+                    'Polyak averaging is not supported with shards')
+            if grads is None:
+                utils.print_with_stamp(
+                    'Building computation graph for gradients', self.name)
+                shard_grads = theano.grad(loss, params)
+            else:
+                shard_grads = grads
+            # the updates are computed from the gradients averaged over
+            # shards, which are stored in these shared variables
+            grads = [theano.shared(np.zeros_like(p.get_value()),
+                                   broadcastable=p.broadcastable,
+                                   name='%s>grad' % (p.name))
+                     for p in params]
+            self.shard_grads = grads
+            if clip is not None:
+                utils.print_with_stamp(
+                    "Clipping gradients to norm %s" % (str(clip)), self.name)
+                grads = lasagne.updates.total_norm_constraint(grads, clip)
+            else:
+                utils.print_with_stamp("No gradient clipping", self.name)
+        elif grads is None:
             utils.print_with_stamp('Building computation graph for gradients',
                                    self.name)
             grads = theano.grad(loss, params)
@@ -90,6 +135,11 @@ class SGDOptimizer(object):
         utils.print_with_stamp("Computing parameter update rules", self.name)
         min_method_updt = LASAGNE_MIN_METHODS[self.min_method]
         grad_updates = min_method_updt(grads, params, **kwargs)
+        if n_shards > 1:
+            self.set_shards(loss, params, shard_grads, outputs, updts,
+                            grad_updates, givens_dict, n_shards, shard_seed,
+                            output_grads, compilation_mode)
+            return
 
         outputs = [loss] + outputs
         if output_grads:
@@ -123,13 +173,7 @@ class SGDOptimizer(object):
                 delattr(self, 'params_avg')
 
         utils.print_with_stamp('Compiling function for loss', self.name)
-        # converts inputs to shared variables to avoid repeated gpu transfers
-        self.shared_inpts = [theano.shared(np.empty([1]*inp.ndim,
-                                           dtype=inp.dtype),
-                                           name=inp.name) for inp in inputs]
-
-        givens_dict = dict(zip(inputs, self.shared_inpts))
-        self.loss_fn = theano.function(
+        self.loss_fn = utils.cached_function(
             [], loss, updates=updts,
             on_unused_input='ignore',
             allow_input_downcast=True,
@@ -139,7 +183,7 @@ class SGDOptimizer(object):
 
         utils.print_with_stamp("Compiling parameter updates", self.name)
 
-        self.update_params_fn = theano.function(
+        self.update_params_fn = utils.cached_function(
             [], outputs,
             updates=grad_updates,
             on_unused_input='ignore',
@@ -154,6 +198,73 @@ class SGDOptimizer(object):
         self.params = params
         self.optimizer_state = [s for s in grad_updates.keys()]
 
+    def set_shards(self, loss, params, shard_grads, outputs, updts,
+                   grad_updates, givens_dict, n_shards, seed=None,
+                   output_grads=False, compilation_mode=None):
+        '''
+            Compiles the loss and gradients of a single shard, forks the
+            shard workers and replaces loss_fn and update_params_fn with
+            functions that evaluate the shards, and apply the updates with
+            the averaged gradients in this process.
+        '''
+        utils.print_with_stamp('Compiling functions for shards', self.name)
+        shard_loss_fn = utils.cached_function(
+            [], loss, updates=updts,
+            on_unused_input='ignore',
+            allow_input_downcast=True,
+            givens=givens_dict,
+            mode=compilation_mode)
+        # extra outputs are returned from the first shard
+        shard_grads_fn = utils.cached_function(
+            [], [loss] + outputs + shard_grads, updates=updts,
+            on_unused_input='ignore',
+            allow_input_downcast=True,
+            givens=givens_dict,
+            mode=compilation_mode)
+        utils.print_with_stamp("Compiling parameter updates", self.name)
+        apply_updates_fn = utils.cached_function(
+            [], [], updates=grad_updates,
+            on_unused_input='ignore',
+            allow_input_downcast=True,
+            mode=compilation_mode)
+
+        self.shards = ShardPool(
+            shard_loss_fn, shard_grads_fn, params, n_shards, updts=updts,
+            init_shard=getattr(loss.tag, 'init_shard', None), seed=seed,
+            name=self.name)
+
+        def loss_fn():
+            return self.shards.evaluate(with_grads=False)[0]
+
+        def update_params_fn():
+            loss, grads, outs = self.shards.evaluate()
+            grads = utils.unwrap_params(
+                grads, [g.get_value(borrow=True).shape
+                        for g in self.shard_grads])
+            for g, v in zip(self.shard_grads, grads):
+                g.set_value(v)
+            apply_updates_fn()
+            ret = [loss] + outs
+            if output_grads:
+                ret += grads
+            return ret
+
+        self.loss_fn = loss_fn
+        self.update_params_fn = update_params_fn
+        if hasattr(self, 'params_avg'):
+            delattr(self, 'params_avg')
+        self.n_evals = 0
+        self.start_time = 0
+        self.iter_time = 0
+        self.params = params
+        self.optimizer_state = [s for s in grad_updates.keys()]
+
+    def close(self):
+        ''' Stops the shard workers, if any'''
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+
     def minibatch_minimize(self, X, Y, *inputs, **kwargs):
         callback = kwargs.get('callback', None)
         return_best = kwargs.get('return_best', False)
@@ -245,72 +356,208 @@ class SGDOptimizer(object):
             @param inputs python variables to pass as inputs to the compiled
                           theano functions for the loss and gradients
         '''
-        callback = kwargs.get('callback')
-        return_best = kwargs.get('return_best', False)
-        self.iter_time = 0
-        self.start_time = time.time()
-        self.n_evals = 0
-        utils.print_with_stamp('Optimizing parameters', self.name)
-        # set values for shared inputs
-        for s, i in zip(self.shared_inpts, inputs):
-            s.set_value(np.array(i).astype(s.dtype))
-        # set initial loss and parameters
-        state0 = [s.get_value(return_internal_type=True, borrow=False)
-                  for s in self.optimizer_state]
-        ret = self.update_params_fn()
-        loss0 = self.loss_fn()
-        utils.print_with_stamp('Initial loss [%s]' % (loss0), self.name)
-        self.best_p = [loss0, state0, 0]
-
-        # training loop
-        if return_best:
-            out_str = 'Curr loss: %E [%d: %E], n_evals: %d'
-            out_str += ', Avg. time per updt: %f'
-        else:
-            out_str = 'Curr loss: %E, n_evals: %d, Avg. time per updt: %f'
-        for i in range(1, self.max_evals):
-            start_time = time.time()
-
-            # evaluate current policy and update parameters
+        with utils.timing_span('optimize', optimizer=self.name) as counters:
+            callback = kwargs.get('callback')
+            return_best = kwargs.get('return_best', False)
+            self.iter_time = 0
+            self.start_time = time.time()
+            self.n_evals = 0
+            utils.print_with_stamp('Optimizing parameters', self.name)
+            # set values for shared inputs
+            for s, i in zip(self.shared_inpts, inputs):
+                s.set_value(np.array(i).astype(s.dtype))
+            if self.shards is not None:
+                # send the inputs and current state of the models to the
+                # shard workers
+                self.shards.sync()
+            # set initial loss and parameters
+            state0 = [s.get_value(return_internal_type=True, borrow=False)
+                      for s in self.optimizer_state]
             ret = self.update_params_fn()
-            # the returned loss corresponds to the parameters BEFORE the update
-            loss = ret[0]
-
-            if loss < self.best_p[0] or i < 10 and return_best:
-                # get current optimizer state
-                state = [s.get_value(return_internal_type=True,
-                                     borrow=False)
-                         for s in self.optimizer_state]
-                self.best_p = [loss, state, i]
-            if callable(callback):
-                callback(*ret)
-            self.n_evals += 1
-
-            end_time = time.time()
-            dt = end_time - start_time
-            it_updt = (dt - self.iter_time)/self.n_evals
-            self.iter_time += it_updt
+            loss0 = self.loss_fn()
+            utils.print_with_stamp('Initial loss [%s]' % (loss0), self.name)
+            self.best_p = [loss0, state0, 0]
+
+            # training loop
             if return_best:
-                str_params = (loss, self.best_p[2], self.best_p[0],
-                              self.n_evals, self.iter_time)
+                out_str = 'Curr loss: %E [%d: %E], n_evals: %d'
+                out_str += ', Avg. time per updt: %f'
             else:
-                str_params = (loss, self.n_evals, self.iter_time)
-            utils.print_with_stamp(out_str % str_params, self.name, True)
+                out_str = 'Curr loss: %E, n_evals: %d, Avg. time per updt: %f'
+            for i in range(1, self.max_evals):
+                start_time = time.time()
 
-        print('')
+                # evaluate current policy and update parameters
+                ret = self.update_params_fn()
+                # the returned loss corresponds to the parameters BEFORE the
+                # update
+                loss = ret[0]
 
-        if return_best:
-            v, s, i = self.best_p
-            for s_i, st_i in zip(self.optimizer_state, s):
-                s_i.set_value(st_i)
+                if loss < self.best_p[0] or i < 10 and return_best:
+                    # get current optimizer state
+                    state = [s.get_value(return_internal_type=True,
+                                         borrow=False)
+                             for s in self.optimizer_state]
+                    self.best_p = [loss, state, i]
+                if callable(callback):
+                    callback(*ret)
+                self.n_evals += 1
 
-        if hasattr(self, 'params_avg'):
-            # set the model parameters to be the ones found via
-            # polyak averaging
-            for p_i, pp_i in zip(self.params, self.params_avg):
-                p_i.set_value(pp_i.get_value())
+                end_time = time.time()
+                dt = end_time - start_time
+                it_updt = (dt - self.iter_time)/self.n_evals
+                self.iter_time += it_updt
+                if return_best:
+                    str_params = (loss, self.best_p[2], self.best_p[0],
+                                  self.n_evals, self.iter_time)
+                else:
+                    str_params = (loss, self.n_evals, self.iter_time)
+                utils.print_with_stamp(out_str % str_params, self.name, True)
 
-        v = self.loss_fn()
+            print('')
 
-        msg = 'Done training. New loss [%f] iter: [%d]'
-        utils.print_with_stamp(msg % (v, i), self.name)
+            if return_best:
+                v, s, i = self.best_p
+                for s_i, st_i in zip(self.optimizer_state, s):
+                    s_i.set_value(st_i)
+
+            if hasattr(self, 'params_avg'):
+                # set the model parameters to be the ones found via
+                # polyak averaging
+                for p_i, pp_i in zip(self.params, self.params_avg):
+                    p_i.set_value(pp_i.get_value())
+
+            v = self.loss_fn()
+
+            msg = 'Done training. New loss [%f] iter: [%d]'
+            utils.print_with_stamp(msg % (v, i), self.name)
+            counters.update(n_evals=self.n_evals, initial_loss=float(loss0),
+                            loss=float(v))
+
+
+class ShardPool(object):
+    '''
+        Pool of forked worker processes, each evaluating the compiled loss and
+        gradients of one shard of the objective (e.g. a subset of the
+        particles of an mc_pilco rollout). The parameter values are broadcast
+        to, and the losses and gradients gathered from, the workers through
+        shared memory. The losses and gradients are averaged over shards.
+    '''
+    def __init__(self, loss_fn, grads_fn, params, n_shards, updts=None,
+                 init_shard=None, seed=None, name='ShardPool'):
+        self.params = params
+        self.shapes = [p.get_value(borrow=True).shape for p in params]
+        self.n_shards = n_shards
+        self.name = name
+        self.loss_fn = loss_fn
+        self.grads_fn = grads_fn
+        self.init_shard = init_shard
+
+        # every shared variable the shard functions read is broadcast when
+        # syncing, except for the parameters (broadcast on every evaluation)
+        # and the variables updated by the shards themselves, e.g. random
+        # number generator states or common random numbers
+        local = set(params)
+        if updts is not None:
+            local.update(updts.keys())
+        self.state = []
+        for fn in (loss_fn, grads_fn):
+            for s in fn.get_shared():
+                if s in local or s in self.state or\
+                   getattr(s, 'default_update', None) is not None:
+                    continue
+                self.state.append(s)
+
+        n_params = sum([int(np.prod(shape)) for shape in self.shapes])
+        ctx = multiprocessing.get_context('fork')
+        self.param_buffer = np.frombuffer(
+            ctx.RawArray('d', max(n_params, 1)))[:n_params]
+        self.out_buffer = np.frombuffer(
+            ctx.RawArray('d', n_shards*(1+n_params))).reshape(n_shards, -1)
+
+        if seed is None:
+            seed = np.random.randint(1, 2147462579)
+        utils.print_with_stamp(
+            'Starting %d shard workers' % (n_shards), self.name)
+        self.conns, self.workers = [], []
+        for shard in range(n_shards):
+            conn, worker_conn = ctx.Pipe()
+            worker = ctx.Process(target=_shard_worker,
+                                 args=(self, shard, worker_conn, seed+shard))
+            worker.daemon = True
+            worker.start()
+            worker_conn.close()
+            self.conns.append(conn)
+            self.workers.append(worker)
+
+    def gather(self, command, *args):
+        for conn in self.conns:
+            conn.send((command,) + args)
+        results = [conn.recv() for conn in self.conns]
+        for status, result in results:
+            if status == 'error':
+                raise RuntimeError('Shard worker failed:\n%s' % (result))
+        return [result for status, result in results]
+
+    def sync(self):
+        ''' Broadcasts the values of the shared variables, other than the
+        parameters, to the workers. Should be called after they change; e.g.
+        after updating the inputs or retraining the models'''
+        values = [s.get_value(borrow=True) for s in self.state]
+        self.gather('sync', values)
+
+    def evaluate(self, with_grads=True):
+        ''' Evaluates the shards at the current parameter values. Returns the
+        averaged loss and flattened gradients (if with_grads is True), and the
+        additional outputs of the first shard'''
+        self.param_buffer[:] = utils.wrap_params(
+            [p.get_value(borrow=True) for p in self.params])
+        outs = self.gather('eval', with_grads)
+        loss = self.out_buffer[:, 0].mean()
+        grads = self.out_buffer[:, 1:].mean(0) if with_grads else None
+        return loss, grads, outs[0]
+
+    def close(self):
+        for conn, worker in zip(self.conns, self.workers):
+            if worker.is_alive():
+                conn.send(('close',))
+            worker.join()
+            conn.close()
+        self.conns, self.workers = [], []
+
+
+def _shard_worker(pool, shard, conn, seed):
+    ''' Evaluates one shard of the objective, on request of the pool'''
+    if callable(pool.init_shard):
+        pool.init_shard(seed=seed)
+    out = pool.out_buffer[shard]
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'close':
+            break
+        try:
+            result = None
+            if msg[0] == 'sync':
+                for s, v in zip(pool.state, msg[1]):
+                    s.set_value(v)
+                if callable(pool.init_shard):
+                    pool.init_shard()
+            elif msg[0] == 'eval':
+                params = utils.unwrap_params(pool.param_buffer, pool.shapes)
+                for p, v in zip(pool.params, params):
+                    p.set_value(v.astype(p.dtype))
+                if msg[1]:
+                    ret = pool.grads_fn()
+                    n_grads = len(pool.params)
+                    out[1:] = utils.wrap_params(ret[-n_grads:])
+                    ret = ret[:-n_grads]
+                else:
+                    ret = pool.loss_fn()
+                    ret = ret if isinstance(ret, list) else [ret]
+                out[0] = ret[0]
+                if shard == 0:
+                    result = ret[1:]
+            conn.send(('done', result))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
@@ -17,7 +17,7 @@ class BaseRegressor(Loadable):
         Loadable.__init__(self, name=name, filename=self.filename)
         self.register(['param_names', 'fixed_params'])
 
-        # compiled functions
+        # compiled functions (per input ndim)
         self.predict_fn = None
         self.predict_ic_fn = None
 
@@ -204,10 +204,10 @@ class BaseRegressor(Loadable):
                    if input_covariance else '%s>predict' % (self.name))
         if len(prediction) == 1:
             prediction = prediction[0]
-        predict_fn = theano.function(input_vars, prediction,
-                                     on_unused_input='ignore',
-                                     name=fn_name,
-                                     allow_input_downcast=True)
+        predict_fn = utils.cached_function(input_vars, prediction,
+                                           on_unused_input='ignore',
+                                           name=fn_name,
+                                           allow_input_downcast=True)
 
         utils.print_with_stamp('Done compiling', self.name)
 
@@ -217,21 +217,19 @@ class BaseRegressor(Loadable):
         return theano.updates.OrderedUpdates()
 
     def __call__(self, mx, Sx=None, *args, **kwargs):
-        # check if we need to compile the prediction functions
-        if Sx is None:
-            if not hasattr(self, 'predict_fn') or self.predict_fn is None:
-                self.predict_fn = self.init_predict(
-                    input_covariance=False, input_ndim=mx.ndim,
-                    *args, **kwargs)
-                self.state_changed = True  # for saving
-            predict = self.predict_fn
-        else:
-            if not hasattr(self, 'predict_ic_fn') or self.predict_ic_fn is None:
-                self.predict_ic_fn = self.init_predict(
-                    input_covariance=True, input_ndim=mx.ndim,
-                    *args, **kwargs)
-                self.state_changed = True  # for saving
-            predict = self.predict_ic_fn
+        # check if we need to compile the prediction functions. These are
+        # kept in dictionaries keyed by the number of dimensions of the
+        # input, since a compiled function only accepts inputs of one ndim
+        attr = 'predict_fn' if Sx is None else 'predict_ic_fn'
+        if getattr(self, attr, None) is None:
+            setattr(self, attr, {})
+        fns = getattr(self, attr)
+        if mx.ndim not in fns:
+            fns[mx.ndim] = self.init_predict(
+                input_covariance=Sx is not None, input_ndim=mx.ndim,
+                *args, **kwargs)
+            self.state_changed = True  # for saving
+        predict = fns[mx.ndim]
 
         # call the predict function with appropriate inputs
         input_vars = [mx]
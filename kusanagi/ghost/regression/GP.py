@@ -5,10 +5,9 @@ import theano.tensor as tt
 from functools import partial
 from kusanagi.ghost.optimizers import ScipyOptimizer
 from theano import function as F, shared as S
-from theano.tensor.nlinalg import matrix_dot, det
 from theano.tensor.slinalg import (solve_lower_triangular,
                                    solve_upper_triangular,
-                                   solve, Cholesky)
+                                   Cholesky)
 
 from . import cov
 from . import SNRpenalty
@@ -134,6 +133,9 @@ class GP(BaseRegressor):
         # overrides append_dataset from BaseRegressor
         if self.X is None:
             self.set_dataset(X_dataset, Y_dataset, X_cov, Y_var)
+        elif self.can_update_cholesky(X_cov, Y_var):
+            # avoid refactorizing the full kernel matrix
+            self.update_cholesky(X_dataset, Y_dataset)
         else:
             X_ = np.vstack((self.X.get_value(),
                             X_dataset.astype(self.X.dtype)))
@@ -150,6 +152,78 @@ class GP(BaseRegressor):
 
             self.set_dataset(X_, Y_, X_cov_, Y_var_)
 
+    def can_update_cholesky(self, X_cov=None, Y_var=None):
+        ''' Returns True if the cached intermediate values (L, iK, beta) are
+        valid for the current dataset and can be updated incrementally'''
+        shared_type = tt.sharedvar.SharedVariable
+        if not self.trained or type(self).get_loss is not GP.get_loss:
+            return False
+        if X_cov is not None or Y_var is not None:
+            return False
+        if self.nigp or self.Y_var:
+            return False
+        cached = (self.L, self.iK, self.beta)
+        if not all(isinstance(v, shared_type) for v in cached):
+            return False
+        return self.L.get_value(borrow=True).shape[-1] == self.N
+
+    def update_cholesky(self, X_dataset, Y_dataset):
+        ''' Appends data to the training set, updating the cached Cholesky
+        factors, inverse kernel matrices and beta with rank-M block updates.
+        This is O(N^2 M) per output, instead of the O(N^3) required for
+        refactorizing the full kernel matrix.'''
+        from scipy.linalg import solve_triangular, cholesky
+        msg = 'Updating Cholesky factors with %d new samples'
+        utils.print_with_stamp(msg % (X_dataset.shape[0]), self.name)
+        idims = self.D
+        X1 = self.X.get_value()
+        X2 = X_dataset.astype(X1.dtype)
+        X_ = np.vstack((X1, X2))
+        Y_ = np.vstack((self.Y.get_value(), Y_dataset.astype(X1.dtype)))
+        N1, N2 = X1.shape[0], X2.shape[0]
+        N = N1 + N2
+
+        hyp = self.hyp.eval()
+        L_old = self.L.get_value()
+        iK_old = self.iK.get_value()
+        L = np.zeros((self.E, N, N), dtype=L_old.dtype)
+        iK = np.zeros((self.E, N, N), dtype=iK_old.dtype)
+        beta = np.zeros((self.E, N), dtype=L_old.dtype)
+        for i in range(self.E):
+            sn2 = hyp[i, idims+1]**2
+            K12 = cov.SEard_np(hyp[i], X1, X2)
+            K22 = cov.SEard_np(hyp[i], X2) + sn2*np.eye(N2)
+            L11, iK11 = L_old[i], iK_old[i]
+
+            # block cholesky: [[L11, 0], [L21, L22]]
+            L21 = solve_triangular(L11, K12, lower=True).T
+            L22 = cholesky(K22 - L21.dot(L21.T), lower=True)
+            L[i, :N1, :N1] = L11
+            L[i, N1:, :N1] = L21
+            L[i, N1:, N1:] = L22
+
+            # block inverse, using the schur complement S = L22 L22^T
+            A = iK11.dot(K12)
+            iL22 = solve_triangular(L22, np.eye(N2), lower=True)
+            iS = iL22.T.dot(iL22)
+            iS_At = iS.dot(A.T)
+            iK[i, :N1, :N1] = iK11 + A.dot(iS_At)
+            iK[i, :N1, N1:] = -iS_At.T
+            iK[i, N1:, :N1] = -iS_At
+            iK[i, N1:, N1:] = iS
+
+            # beta = K^-1 y
+            Ly = solve_triangular(L[i], Y_[:, i], lower=True)
+            beta[i] = solve_triangular(L[i].T, Ly, lower=False)
+
+        # update the dataset without reinitializing the hyperparameters
+        super(GP, self).set_dataset(X_, Y_)
+        self.L.set_value(L, borrow=True)
+        self.iK.set_value(iK, borrow=True)
+        self.beta.set_value(beta, borrow=True)
+        self.state_changed = True
+        self.ready = True
+
     def init_params(self):
         utils.print_with_stamp('Initialising parameters', self.name)
         idims = self.D
@@ -296,30 +370,42 @@ class GP(BaseRegressor):
         self.state_changed = True  # for saving
         return loss.sum(), inps, updts
 
-    def predict(self, mx, Sx, **kwargs):
+    def predict(self, mx, Sx=None, **kwargs):
+        ''' Predictive distribution at the test inputs mx. If mx is a [D]
+        vector, returns the [E] mean, the [E x E] (diagonal) covariance and
+        the [D x E] input-output covariance. If mx is an [n x D] matrix,
+        returns the [n x E] means and variances, computed for all test inputs
+        and output dimensions at once.'''
         idims = self.D
+        batched = mx.ndim == 2
+        if not batched:
+            mx = mx[None, :]
 
-        # compute the mean and variance for each output dimension
-        def predict_odim(L, beta, hyp, X, mx):
-            hyps = (hyp[:idims+1], hyp[idims+1])
-            kernel_func = partial(cov.Sum, hyps, self.covs)
-
-            k = kernel_func(mx[None, :], X)
-            mean = k.dot(beta)
-            kc = solve_lower_triangular(L, k.flatten())
-            variance = kernel_func(mx[None, :], all_pairs=False) - kc.dot(kc)
-
-            return mean, variance
-
-        (M, S), updts = theano.scan(fn=predict_odim,
-                                    sequences=[self.L, self.beta, self.hyp],
-                                    non_sequences=[self.X, mx],
-                                    allow_gc=False,
-                                    name='%s>predict_scan' % (self.name))
+        # scale the inputs with the lengthscales of every output dimension
+        sf2 = self.hyp[:, idims]**2
+        sn2 = self.hyp[:, idims+1]**2
+        iL = 1.0/self.hyp[:, None, :idims]
+        X_ = self.X[None, :, :]*iL
+        mx_ = mx[None, :, :]*iL
+
+        # E x n x N covariances between test and training inputs
+        dist = (tt.sum(mx_**2, 2)[:, :, None] + tt.sum(X_**2, 2)[:, None, :]
+                - 2*tt.batched_dot(mx_, X_.transpose(0, 2, 1)))
+        K = sf2[:, None, None]*tt.exp(-0.5*tt.maximum(dist, 0))
+
+        # mean and variance for each output dimension, as E x n tensors.
+        # k^T K^-1 k is computed with the cached inverse, since there is no
+        # batched triangular solve in theano
+        M = tt.sum(K*self.beta[:, None, :], 2)
+        kiKk = tt.sum(tt.batched_dot(K, self.iK)*K, 2)
+        S = tt.maximum(sf2[:, None] - kiKk, 0) + sn2[:, None]
+
+        if batched:
+            return M.T, S.T
 
         # reshape output variables
-        M = M.flatten()
-        S = tt.diag(S.flatten())
+        M = M[:, 0]
+        S = tt.diag(S[:, 0])
         V = tt.zeros((self.D, self.E))
 
         return M, S, V
@@ -369,82 +455,81 @@ class GP_UI(GP):
             X_dataset, Y_dataset, name=name, idims=idims, odims=odims,
             **kwargs)
 
-    def predict(self, mx, Sx, unroll_scan=False, **kwargs):
+    def predict(self, mx, Sx, **kwargs):
+        return self.moment_matching(mx, Sx, self.X, self.beta, self.iK)
+
+    def moment_matching(self, mx, Sx, X, beta, iK=None, jitter=0.0):
+        ''' Mean, covariance and input-output covariance of the predictive
+        distribution for Gaussian inputs N(mx, Sx), with a squared exponential
+        kernel centered at the rows of X. (Deisenroth's thesis, Eqs 2.34-2.55)
+        The second moments for all the E(E+1)/2 pairs of output dimensions are
+        computed as batched tensors. If iK is None, the outputs are assumed to
+        be deterministic (no latent variance term in the diagonal).'''
         idims = self.D
         odims = self.E
 
         # centralize inputs
-        zeta = self.X - mx
+        zeta = X - mx
 
         # initialize some variables
         sf2 = self.hyp[:, idims]**2
-        eyeE = tt.tile(tt.eye(idims), (odims, 1, 1))
-        lscales = self.hyp[:, :idims]
-        iL = eyeE/lscales.dimshuffle(0, 1, 'x')
+        iL = 1.0/self.hyp[:, :idims]
+        eyeD = tt.eye(idims)
 
         # predictive mean
-        inp = iL.dot(zeta.T).transpose(0, 2, 1)
-        iLdotSx = iL.dot(Sx)
-        # TODO vectorize this
-        B = (iLdotSx[:, :, None, :]*iL[:, None, :, :]).sum(-1) + tt.eye(idims)
-        t = tt.stack([solve(B[i].T, inp[i].T).T for i in range(odims)])
-        c = sf2/tt.sqrt(tt.stack([det(B[i]) for i in range(odims)]))
+        inp = zeta[None, :, :]*iL[:, None, :]
+        B = iL[:, :, None]*Sx[None, :, :]*iL[:, None, :] + eyeD
+        LB = utils.batched_cholesky(B, idims)
+        t = utils.batched_cho_solve(
+            LB, inp.transpose(0, 2, 1), idims).transpose(0, 2, 1)
+        c = sf2*tt.exp(-0.5*utils.batched_logdet(LB, idims))
         l = tt.exp(-0.5*tt.sum(inp*t, 2))
-        lb = l*self.beta  # E x N dot E x N
+        lb = l*beta  # E x N dot E x N
         M = tt.sum(lb, 1)*c
 
         # input output covariance
-        tiL = (t[:, :, None, :]*iL[:, None, :, :]).sum(-1)
-        # tiL = tt.stack([t[i].dot(iL[i]) for i in range(odims)])
-        V = tt.stack([tiL[i].T.dot(lb[i]) for i in range(odims)]).T*c
+        tiL = t*iL[:, None, :]
+        V = tt.sum(tiL*lb[:, :, None], 1).T*c
 
-        # predictive covariance
+        # predictive covariance, for every pair of output dimensions
+        # i <= j. This comes from Deisenroth's thesis ( Eqs 2.51- 2.54 )
+        I, J = np.triu_indices(odims)
         logk = (tt.log(sf2))[:, None] - 0.5*tt.sum(inp*inp, 2)
-        logk_r = logk.dimshuffle(0, 'x', 1)
-        logk_c = logk.dimshuffle(0, 1, 'x')
         Lambda = tt.square(iL)
-        LL = (Lambda.dimshuffle(0, 'x', 1, 2) + Lambda).transpose(0, 1, 3, 2)
-        R = tt.dot(LL, Sx).transpose(0, 1, 3, 2) + tt.eye(idims)
-        z_ = Lambda.dot(zeta.T).transpose(0, 2, 1)
+        z_ = zeta[None, :, :]*Lambda[:, None, :]
+
+        # R = Sx(Li + Lj) + I is not symmetric, so we work with the
+        # symmetric T = s Sx s + I, where s = sqrt(Li + Lj).
+        # det(R) = det(T) and R^-1 Sx = Sx - Sx s T^-1 s Sx
+        sij = tt.sqrt(Lambda[I] + Lambda[J])
+        sSx = sij[:, :, None]*Sx[None, :, :]
+        T = sSx*sij[:, None, :] + eyeD
+        LT = utils.batched_cholesky(T, idims)
+        iRSx = Sx - tt.batched_dot(
+            sSx.transpose(0, 2, 1), utils.batched_cho_solve(LT, sSx, idims))
+        iRSx = 0.5*iRSx
+
+        zi, zj = z_[I], z_[J]
+        zi_iRSx = tt.batched_dot(zi, iRSx)
+        n2 = logk[I][:, :, None] + logk[J][:, None, :]
+        n2 += tt.sum(zi_iRSx*zi, 2)[:, :, None]
+        n2 += tt.sum(tt.batched_dot(zj, iRSx)*zj, 2)[:, None, :]
+        n2 += 2*tt.batched_dot(zi_iRSx, zj.transpose(0, 2, 1))
+        Q = tt.exp(n2 - 0.5*utils.batched_logdet(LT, idims)[:, None, None])
+
+        # Eq 2.55
+        m2 = tt.sum(tt.sum(beta[I][:, :, None]*Q, 1)*beta[J], 1)
+
+        # diagonal terms
+        diag = (I == J).nonzero()[0]
+        m2_diag = m2[diag] + jitter
+        if iK is not None:
+            m2_diag += sf2 - tt.sum(iK*Q[diag], (1, 2))
+        m2 = tt.set_subtensor(m2[diag], m2_diag)
 
         M2 = tt.zeros((odims, odims))
-
-        # initialize indices
-        triu_indices = np.triu_indices(odims)
-        indices = [tt.as_index_variable(idx) for idx in triu_indices]
-
-        def second_moments(i, j, M2, beta, iK, sf2, R, logk_c, logk_r, z_, Sx, *args):
-            # This comes from Deisenroth's thesis ( Eqs 2.51- 2.54 )
-            Rij = R[i, j]
-            n2 = logk_c[i] + logk_r[j]
-            n2 += utils.maha(z_[i], -z_[j], 0.5*solve(Rij, Sx))
-
-            Q = tt.exp(n2)/tt.sqrt(det(Rij))
-
-            # Eq 2.55
-            m2 = matrix_dot(beta[i], Q, beta[j])
-
-            m2 = theano.ifelse.ifelse(
-                tt.eq(i, j), m2 - tt.sum(iK[i]*Q) + sf2[i], m2)
-            M2 = tt.set_subtensor(M2[i, j], m2)
-            return M2
-
-        nseq = [self.beta, self.iK, sf2, R, logk_c, logk_r, z_, Sx, self.L]
-        if unroll_scan:
-            from lasagne.utils import unroll_scan
-            [M2_] = unroll_scan(second_moments, indices,
-                                [M2], nseq, len(triu_indices[0]))
-            updts = {}
-        else:
-            M2_, updts = theano.scan(fn=second_moments,
-                                     sequences=indices,
-                                     outputs_info=[M2],
-                                     non_sequences=nseq,
-                                     allow_gc=False,
-                                     strict=True,
-                                     name="%s>M2_scan" % (self.name))
-        M2 = M2_[-1]
-        M2 = M2 + tt.triu(M2, k=1).T
+        M2 = tt.set_subtensor(M2[I, J], m2)
+        M2 = tt.set_subtensor(M2[J, I], m2)
         S = M2 - tt.outer(M, M)
 
         return M, S, V
@@ -464,7 +549,7 @@ class RBFGP(GP_UI):
         self.register(['sat_func'])
         self.register(['iK', 'beta', 'L'])
 
-    def predict(self, mx, Sx=None, unroll_scan=False, **kwargs):
+    def predict(self, mx, Sx=None, **kwargs):
         idims = self.D
         odims = self.E
 
@@ -496,70 +581,8 @@ class RBFGP(GP_UI):
 
             return M, tt.tile(self.sn, (M.shape[0], 1))
 
-        # centralize inputs
-        zeta = self.X - mx
-
-        # predictive mean
-        inp = iL.dot(zeta.T).transpose(0, 2, 1)
-        iLdotSx = iL.dot(Sx)
-        B = (iLdotSx[:, :, None, :]*iL[:, None, :, :]).sum(-1) + tt.eye(idims)
-        t = tt.stack([solve(B[i].T, inp[i].T).T for i in range(odims)])
-        c = sf2/tt.sqrt(tt.stack([det(B[i]) for i in range(odims)]))
-        l = tt.exp(-0.5*tt.sum(inp*t, 2))
-        lb = l*self.beta
-        M = tt.sum(lb, 1)*c
-
-        # input output covariance
-        tiL = tt.stack([t[i].dot(iL[i]) for i in range(odims)])
-        V = tt.stack([tiL[i].T.dot(lb[i]) for i in range(odims)]).T*c
-
-        # predictive covariance
-        logk = (tt.log(sf2))[:, None] - 0.5*tt.sum(inp*inp, 2)
-        logk_r = logk.dimshuffle(0, 'x', 1)
-        logk_c = logk.dimshuffle(0, 1, 'x')
-        Lambda = tt.square(iL)
-        LL = (Lambda.dimshuffle(0, 'x', 1, 2) + Lambda).transpose(0, 1, 3, 2)
-        R = tt.dot(LL, Sx).transpose(0, 1, 3, 2) + tt.eye(idims)
-        z_ = Lambda.dot(zeta.T).transpose(0, 2, 1)
-
-        M2 = tt.zeros((odims, odims))
-
-        # initialize indices
-        triu_indices = np.triu_indices(odims)
-        indices = [tt.as_index_variable(idx) for idx in triu_indices]
-
-        def second_moments(i, j, M2, beta, R, logk_c, logk_r, z_, Sx, *args):
-            # This comes from Deisenroth's thesis ( Eqs 2.51- 2.54 )
-            Rij = R[i, j]
-            n2 = logk_c[i] + logk_r[j]
-            n2 += utils.maha(z_[i], -z_[j], 0.5*solve(Rij, Sx))
-            Q = tt.exp(n2)/tt.sqrt(det(Rij))
-
-            # Eq 2.55
-            m2 = matrix_dot(beta[i], Q, beta[j])
-
-            m2 = theano.ifelse.ifelse(tt.eq(i, j), m2 + 1e-6, m2)
-            M2 = tt.set_subtensor(M2[i, j], m2)
-            return M2
-
-        nseq = [self.beta, R, logk_c, logk_r, z_, Sx, self.iK, self.L]
-
-        if unroll_scan:
-            from lasagne.utils import unroll_scan
-            [M2_] = unroll_scan(second_moments, indices,
-                                [M2], nseq, len(triu_indices[0]))
-            updts = {}
-        else:
-            M2_, updts = theano.scan(fn=second_moments,
-                                     sequences=indices,
-                                     outputs_info=[M2],
-                                     non_sequences=nseq,
-                                     allow_gc=False,
-                                     strict=True,
-                                     name="%s>M2_scan" % (self.name))
-        M2 = M2_[-1]
-        M2 = M2 + tt.triu(M2, k=1).T
-        S = M2 - tt.outer(M, M)
+        M, S, V = self.moment_matching(
+            mx, Sx, self.X, self.beta, jitter=1e-6)
 
         # apply saturating function to the output if available
         if self.sat_func is not None:
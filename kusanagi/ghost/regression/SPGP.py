@@ -4,10 +4,8 @@ import theano.tensor as tt
 
 from functools import partial
 from theano import shared as S
-from theano.tensor.nlinalg import matrix_dot, det
 from theano.tensor.slinalg import (solve_lower_triangular,
                                    solve_upper_triangular,
-                                   solve,
                                    cholesky)
 
 from kusanagi import utils
@@ -245,71 +243,8 @@ class SPGP_UI(SPGP, GP_UI):
             # stick with the full GP
             return GP_UI.predict(self, mx, Sx)
 
-        idims = self.D
-        odims = self.E
-
-        # centralize inputs
-        zeta = self.X_sp - mx
-
-        # initialize some variables
-        sf2 = self.hyp[:, idims]**2
-        eyeE = tt.tile(tt.eye(idims), (odims, 1, 1))
-        lscales = self.hyp[:, :idims]
-        iL = eyeE/lscales.dimshuffle(0, 1, 'x')
-
-        # predictive mean
-        inp = iL.dot(zeta.T).transpose(0, 2, 1)
-        iLdotSx = iL.dot(Sx)
-        B = (iLdotSx[:, :, None, :]*iL[:, None, :, :]).sum(-1) + tt.eye(idims)
-        t = tt.stack([solve(B[i].T, inp[i].T).T for i in range(odims)])
-        c = sf2/tt.sqrt(tt.stack([det(B[i]) for i in range(odims)]))
-        l_ = tt.exp(-0.5*tt.sum(inp*t, 2))
-        lb = l_*self.beta_sp
-        M = tt.sum(lb, 1)*c
-
-        # input output covariance
-        tiL = tt.stack([t[i].dot(iL[i]) for i in range(odims)])
-        V = tt.stack([tiL[i].T.dot(lb[i]) for i in range(odims)]).T*c
-
-        # predictive covariance
-        logk = (tt.log(sf2))[:, None] - 0.5*tt.sum(inp*inp, 2)
-        logk_r = logk.dimshuffle(0, 'x', 1)
-        logk_c = logk.dimshuffle(0, 1, 'x')
-        Lambda = tt.square(iL)
-        LL = (Lambda.dimshuffle(0, 'x', 1, 2) + Lambda).transpose(0, 1, 3, 2)
-        R = tt.dot(LL, Sx.T).transpose(0, 1, 3, 2) + tt.eye(idims)
-        z_ = Lambda.dot(zeta.T).transpose(0, 2, 1)
-
-        M2 = tt.zeros((odims, odims))
-
-        # initialize indices
-        triu_indices = np.triu_indices(odims)
-        indices = [tt.as_index_variable(idx) for idx in triu_indices]
-
-        def second_moments(i, j, M2, beta, iK, sf2, R, logk_c, logk_r, z_, Sx):
-            # This comes from Deisenroth's thesis ( Eqs 2.51- 2.54 )
-            Rij = R[i, j]
-            n2 = logk_c[i] + logk_r[j]
-            n2 += utils.maha(z_[i], -z_[j], 0.5*solve(Rij, Sx))
-
-            Q = tt.exp(n2)/tt.sqrt(det(Rij))
-
-            # Eq 2.55
-            m2 = matrix_dot(beta[i], Q, beta[j])
-
-            m2 = theano.ifelse.ifelse(
-                tt.eq(i, j), m2 - tt.sum(iK[i]*Q) + sf2[i], m2)
-            M2 = tt.set_subtensor(M2[i, j], m2)
-            M2 = theano.ifelse.ifelse(
-                tt.eq(i, j), M2 + 1e-6, tt.set_subtensor(M2[j, i], m2))
-            return M2
-
-        nseq = [self.beta_sp, (self.iKmm - self.iBmm), sf2,
-                R, logk_c, logk_r, z_, Sx]
-        M2_, updts = theano.scan(
-            fn=second_moments, sequences=indices, outputs_info=[M2],
-            non_sequences=nseq, allow_gc=False)
-        M2 = M2_[-1]
-        S = M2 - tt.outer(M, M)
+        iK = self.iKmm - self.iBmm
+        M, S, V = self.moment_matching(
+            mx, Sx, self.X_sp, self.beta_sp, iK, jitter=1e-6)
 
         return M, S, V
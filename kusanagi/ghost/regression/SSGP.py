@@ -3,7 +3,6 @@ import theano
 import theano.tensor as tt
 
 from theano import shared as S
-from theano.tensor.nlinalg import matrix_dot
 from theano.tensor.slinalg import (solve_lower_triangular,
                                    solve_upper_triangular,
                                    cholesky)
@@ -241,7 +240,7 @@ class SSGP_UI(SSGP, GP_UI):
                       odims=odims, n_inducing=n_inducing,
                       **kwargs)
 
-    def predict(self, mx, Sx, unroll_scan=False):
+    def predict(self, mx, Sx, **kwargs):
         idims = self.D
         odims = self.E
 
@@ -293,69 +292,46 @@ class SSGP_UI(SSGP, GP_UI):
         # input covariance inverse)
         V = tt.sum(c*beta_ss_r, 2).T - tt.outer(mx, M)
 
-        srdotSxdotsr_c = srdotSxdotsr.dimshuffle(0, 1, 'x')
-        srdotSxdotsr_r = srdotSxdotsr.dimshuffle(0, 'x', 1)
-        M2 = tt.zeros((odims, odims))
-
-        # initialize indices
-        triu_indices = np.triu_indices(odims)
-        indices = [tt.as_index_variable(idx) for idx in triu_indices]
-
-        def second_moments(i, j, M2, beta, iA, sn2, sf2M, sr, srdotSx,
-                           srdotSxdotsr_c, srdotSxdotsr_r,
-                           sin_srdotx, cos_srdotx, *args):
-            # compute the second moments of the spectrum feature vectors
-            siSxsj = srdotSx[i].dot(sr[j].T)  # Ms x Ms
-            sijSxsij = -0.5*(srdotSxdotsr_c[i] + srdotSxdotsr_r[j])
-            em = tt.exp(sijSxsij+siSxsj)      # MsxMs
-            ep = tt.exp(sijSxsij-siSxsj)     # MsxMs
-            si = sin_srdotx[i]       # Msx1
-            ci = cos_srdotx[i]       # Msx1
-            sj = sin_srdotx[j]       # Msx1
-            cj = cos_srdotx[j]       # Msx1
-            sicj = tt.outer(si, cj)  # MsxMs
-            cisj = tt.outer(ci, sj)  # MsxMs
-            sisj = tt.outer(si, sj)  # MsxMs
-            cicj = tt.outer(ci, cj)  # MsxMs
-            sm = (sicj-cisj)*em
-            sp = (sicj+cisj)*ep
-            cm = (sisj+cicj)*em
-            cp = (cicj-sisj)*ep
-
-            # Populate the second moment matrix of the feature vector
-            Q_up = tt.concatenate([cm-cp, sm+sp], axis=1)
-            Q_lo = tt.concatenate([sp-sm, cm+cp], axis=1)
-            Q = tt.concatenate([Q_up, Q_lo], axis=0)
-
-            # Compute the second moment of the output
-            m2 = 0.5*matrix_dot(beta[i], Q, beta[j].T)
-
-            m2 = theano.ifelse.ifelse(
-                tt.eq(i, j),
-                m2 + sn2[i]*(1.0 + sf2M[i]*tt.sum(self.iA[i]*Q)) + 1e-6,
-                m2)
-            M2 = tt.set_subtensor(M2[i, j], m2)
-            return M2
-
-        nseq = [self.beta_ss, self.iA, sn2, sf2M, self.sr, srdotSx,
-                srdotSxdotsr_c, srdotSxdotsr_r, sin_srdotx, cos_srdotx,
-                self.Lmm]
+        # compute the second moments of the spectrum feature vectors, for
+        # every pair of output dimensions i <= j
+        I, J = np.triu_indices(odims)
+        siSxsj = tt.batched_dot(
+            srdotSx[I], self.sr[J].transpose(0, 2, 1))  # P x Ms x Ms
+        sijSxsij = -0.5*(srdotSxdotsr[I][:, :, None] +
+                         srdotSxdotsr[J][:, None, :])
+        em = tt.exp(sijSxsij+siSxsj)      # P x Ms x Ms
+        ep = tt.exp(sijSxsij-siSxsj)      # P x Ms x Ms
+        si = sin_srdotx[I][:, :, None]    # P x Ms x 1
+        ci = cos_srdotx[I][:, :, None]    # P x Ms x 1
+        sj = sin_srdotx[J][:, None, :]    # P x 1 x Ms
+        cj = cos_srdotx[J][:, None, :]    # P x 1 x Ms
+        sicj = si*cj
+        cisj = ci*sj
+        sisj = si*sj
+        cicj = ci*cj
+        sm = (sicj-cisj)*em
+        sp = (sicj+cisj)*ep
+        cm = (sisj+cicj)*em
+        cp = (cicj-sisj)*ep
+
+        # Populate the second moment matrix of the feature vector
+        Q_up = tt.concatenate([cm-cp, sm+sp], axis=2)
+        Q_lo = tt.concatenate([sp-sm, cm+cp], axis=2)
+        Q = tt.concatenate([Q_up, Q_lo], axis=1)
+
+        # Compute the second moment of the output
+        beta = self.beta_ss
+        m2 = 0.5*tt.sum(tt.sum(beta[I][:, :, None]*Q, 1)*beta[J], 1)
+
+        # diagonal terms
+        diag = (I == J).nonzero()[0]
+        m2_diag = m2[diag] + 1e-6
+        m2_diag += sn2*(1.0 + sf2M*tt.sum(self.iA*Q[diag], (1, 2)))
+        m2 = tt.set_subtensor(m2[diag], m2_diag)
 
-        if unroll_scan:
-            from lasagne.utils import unroll_scan
-            [M2_] = unroll_scan(second_moments, indices,
-                                [M2], nseq, len(triu_indices[0]))
-            updts = {}
-        else:
-            M2_, updts = theano.scan(fn=second_moments,
-                                     sequences=indices,
-                                     outputs_info=[M2],
-                                     non_sequences=nseq,
-                                     allow_gc=False,
-                                     name="%s>M2_scan" % (self.name))
-
-        M2 = M2_[-1]
-        M2 = M2 + tt.triu(M2, k=1).T
+        M2 = tt.zeros((odims, odims))
+        M2 = tt.set_subtensor(M2[I, J], m2)
+        M2 = tt.set_subtensor(M2[J, I], m2)
         S = M2 - tt.outer(M, M)
 
         return M, S, V
@@ -1,3 +1,4 @@
+import numpy as np
 import theano.tensor as tt
 from kusanagi import utils
 
@@ -27,6 +28,21 @@ def SEard(hyp, X1, X2=None, all_pairs=True):
     return K
 
 
+def SEard_np(hyp, X1, X2=None):
+    ''' Numpy version of SEard. Useful for updating cached values of the
+        kernel matrices without building a theano graph'''
+    if X2 is None:
+        X2 = X1
+    idims = X1.shape[1]
+    sf2 = hyp[idims]**2
+    iL = 1.0/hyp[:idims]
+    X1_, X2_ = X1*iL, X2*iL
+    D = (np.sum(X1_**2, 1)[:, None] + np.sum(X2_**2, 1)[None, :]
+         - 2*X1_.dot(X2_.T))
+    K = sf2*np.exp(-0.5*np.maximum(D, 0))
+    return K
+
+
 def Noise(hyp, X1, X2=None, all_pairs=True):
     ''' Noise kernel. Takes as an input a distance matrix D
     and creates a new matrix as Kij = sn2 if Dij == 0 else 0'''
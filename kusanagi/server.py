@@ -1,25 +1,64 @@
 #!/usr/bin/env python
-import sys
+import argparse
+import hashlib
+import io
+import multiprocessing
 import pickle
+import queue
+import sys
+import threading
+import time
+import traceback
+import uuid
 import numpy as np
-from collections import OrderedDict
-from flask import Flask, request
+from collections import OrderedDict, deque
+from functools import partial
+from flask import Flask, request, jsonify
 from werkzeug.utils import secure_filename
 
 from kusanagi.ghost.algorithms import mc_pilco
 from kusanagi import utils
-from kusanagi.base import train_dynamics
+from kusanagi.base import train_dynamics, ExperienceDataset
 
 
-ALLOWED_EXTENSIONS = set(['zip', 'pkl'])
+ALLOWED_EXTENSIONS = set(['zip', 'pkl', 'npz'])
 DEBUG = True
 
-task_spec_dict = {}
+job_manager = None
+job_manager_lock = threading.Lock()
+
 
+class JobCancelled(Exception):
+    pass
 
-def mc_pilco_polopt(task_name, task_spec):
+
+def polopt_options(task_spec):
+    '''
+    returns the options used to build and compile the policy objective
+    '''
+    plant_params = task_spec['plant']
+    H = int(np.ceil(task_spec['horizon_secs']/plant_params['dt']))
+    # if a maximum horizon is given, the objective is compiled for it and
+    # can be used for any horizon up to it
+    max_H = task_spec.get('max_horizon_secs')
+    if max_H is not None:
+        max_H = int(np.ceil(max_H/plant_params['dt']))
+    return OrderedDict([
+        ('H', H),
+        ('max_H', max_H),
+        ('n_samples', task_spec.get('n_samples', 100)),
+        ('split_H', task_spec.get('split_H', 1)),
+        ('noisy_policy_input', task_spec.get('noisy_policy_input', False)),
+        ('noisy_cost_input', task_spec.get('noisy_cost_input', False)),
+        ('truncate_gradient', task_spec.get('truncate_gradient', -1)),
+        ('learning_rate', task_spec.get('learning_rate', 1e-3)),
+        ('gradient_clip', task_spec.get('gradient_clip', 1.0))])
+
+
+def mc_pilco_polopt(task_name, task_spec, minimize_cb=None):
     '''
     executes one iteration of mc_pilco (model updating and policy optimization)
+    minimize_cb is called after every optimizer update
     '''
     # get task specific variables
     dyn = task_spec['transition_model']
@@ -27,8 +66,13 @@ def mc_pilco_polopt(task_name, task_spec):
     pol = task_spec['policy']
     plant_params = task_spec['plant']
     immediate_cost = task_spec['cost']['graph']
-    H = int(np.ceil(task_spec['horizon_secs']/plant_params['dt']))
-    n_samples = task_spec.get('n_samples', 100)
+    options = polopt_options(task_spec)
+    H = options['H']
+    max_H = options['max_H']
+    if max_H is not None and H > max_H:
+        raise ValueError('The horizon (%d steps) is longer than the maximum '
+                         'horizon (%d steps)' % (H, max_H))
+    n_samples = options['n_samples']
 
     # if state != 'init':
     # train dynamics model. TODO block if training multiple tasks with
@@ -42,12 +86,12 @@ def mc_pilco_polopt(task_name, task_spec):
         # task_state[task_name] = 'compile_polopt'
 
         # get policy optimizer options
-        split_H = task_spec.get('split_H', 1)
-        noisy_policy_input = task_spec.get('noisy_policy_input', False)
-        noisy_cost_input = task_spec.get('noisy_cost_input', False)
-        truncate_gradient = task_spec.get('truncate_gradient', -1)
-        learning_rate = task_spec.get('learning_rate', 1e-3)
-        gradient_clip = task_spec.get('gradient_clip', 1.0)
+        split_H = options['split_H']
+        noisy_policy_input = options['noisy_policy_input']
+        noisy_cost_input = options['noisy_cost_input']
+        truncate_gradient = options['truncate_gradient']
+        learning_rate = options['learning_rate']
+        gradient_clip = options['gradient_clip']
 
         # get extra inputs, if needed
         import theano.tensor as tt
@@ -63,8 +107,9 @@ def mc_pilco_polopt(task_name, task_spec):
             noisy_cost_input=noisy_cost_input,
             noisy_policy_input=noisy_policy_input,
             split_H=split_H,
-            truncate_gradient=(H/split_H)-truncate_gradient,
+            truncate_gradient=((max_H or H)/split_H)-truncate_gradient,
             crn=100,
+            max_H=max_H,
             **ex_in)
         inps += ex_in.values()
 
@@ -92,7 +137,8 @@ def mc_pilco_polopt(task_name, task_spec):
     # call minimize
     callback()
     optimizer.minimize(
-        *polopt_args, return_best=task_spec['return_best'])
+        *polopt_args, return_best=task_spec['return_best'],
+        callback=minimize_cb)
     # task_state[task_name] = 'ready'
 
     # check if task is done
@@ -102,6 +148,393 @@ def mc_pilco_polopt(task_name, task_spec):
     return pol.get_params(symbolic=False)
 
 
+def named_shared_vars(model):
+    '''
+    returns the (name, shared variable) pairs of a policy or dynamics model,
+    sorted by name. Models whose get_all_shared_vars doesn't take the as_dict
+    argument are named after their variables, keeping their original order
+    '''
+    try:
+        named = model.get_all_shared_vars(as_dict=True)
+    except TypeError:
+        named = [(str(v.name), v) for v in model.get_all_shared_vars()]
+    return sorted(named, key=lambda kv: kv[0])
+
+
+def model_shared_vars(model):
+    '''
+    returns the shared variables of a policy or dynamics model, in an order
+    that only depends on the structure of the model
+    '''
+    shared = []
+    if getattr(model, 'network', None) is not None:
+        import lasagne
+        shared += lasagne.layers.get_all_params(model.network)
+    for name, v in named_shared_vars(model):
+        if v not in shared:
+            shared.append(v)
+    return shared
+
+
+def model_signature(model):
+    '''
+    returns a description of the architecture of a policy or dynamics model
+    '''
+    sig = [type(model).__name__]
+    if getattr(model, 'network', None) is not None:
+        import lasagne
+        for layer in lasagne.layers.get_all_layers(model.network):
+            nonlinearity = getattr(layer, 'nonlinearity', None)
+            sig.append((type(layer).__name__,
+                        getattr(nonlinearity, '__name__', None)))
+        sig += [(str(p.type), p.get_value(borrow=True).shape)
+                for p in lasagne.layers.get_all_params(model.network)]
+    sig += [(name, str(v.type)) for name, v in named_shared_vars(model)]
+    return sig
+
+
+def value_signature(value):
+    '''
+    returns a description of the arguments of the cost function: the type of
+    symbolic inputs, a hash of arrays and the name of functions
+    '''
+    import theano
+    if isinstance(value, theano.gof.Variable):
+        return str(value.type)
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(value)).hexdigest()
+    if isinstance(value, (list, tuple)):
+        return [value_signature(v) for v in value]
+    if isinstance(value, dict):
+        return sorted((k, value_signature(v)) for k, v in value.items())
+    if isinstance(value, partial):
+        return [value_signature(value.func), value_signature(value.args),
+                value_signature(value.keywords or {})]
+    if callable(value):
+        return '%s.%s' % (getattr(value, '__module__', None),
+                          getattr(value, '__name__', type(value).__name__))
+    return repr(value)
+
+
+def objective_key(task_spec):
+    '''
+    returns a key that identifies the compiled policy objective of a task.
+    Tasks with the same key can share the compiled objective, after swapping
+    their parameter values into its shared variables
+    '''
+    options = polopt_options(task_spec)
+    if options['max_H'] is not None:
+        # the compiled objective doesn't depend on the horizon
+        del options['H']
+    sig = [model_signature(task_spec['policy']),
+           model_signature(task_spec['transition_model']),
+           value_signature(task_spec['cost']['graph']),
+           type(task_spec['optimizer']).__name__,
+           list(options.items())]
+    return hashlib.sha1(repr(sig).encode('utf-8')).hexdigest()
+
+
+def objective_shared_vars(task_spec):
+    '''
+    returns the shared variables that hold the state of a task: the policy
+    and dynamics parameters, and the optimizer state (if compiled)
+    '''
+    shared = model_shared_vars(task_spec['policy'])
+    shared += model_shared_vars(task_spec['transition_model'])
+    shared += [s for s in getattr(task_spec['optimizer'], 'optimizer_state',
+                                  None) or [] if s not in shared]
+    return shared
+
+
+def load_objective(objectives, tasks, task_id):
+    '''
+    makes the task use a compiled objective from another task with the same
+    structure, if available. The values of the shared variables of the
+    previous user of the objective are stored in its task spec, and the ones
+    for this task are swapped in.
+    '''
+    task_spec = tasks[task_id]
+    entry = objectives.get(task_spec['objective_key'])
+    if entry is None or entry['owner'] == task_id:
+        return
+    shared = entry['shared']
+    owner_spec = tasks.get(entry['owner'])
+    if owner_spec is not None:
+        owner_spec['objective_state'] = [s.get_value() for s in shared]
+
+    state = task_spec.pop('objective_state', None)
+    if state is None:
+        # first job for this task; copy the values from its own models, and
+        # reset the optimizer state
+        own = model_shared_vars(task_spec['policy'])
+        own += model_shared_vars(task_spec['transition_model'])
+        state = [s.get_value() for s in own]
+        state += [np.zeros_like(s.get_value()) for s in shared[len(own):]]
+        utils.print_with_stamp(
+            'Reusing compiled objective from task %s' % (entry['owner']),
+            task_id)
+    for s, v in zip(shared, state):
+        s.set_value(v)
+
+    for k in ['policy', 'transition_model', 'optimizer', 'extra_in']:
+        task_spec[k] = entry[k]
+    entry['owner'] = task_id
+
+
+def store_objective(objectives, tasks, task_id):
+    '''
+    registers the compiled objective of the task, so that tasks with the same
+    structure can reuse it
+    '''
+    task_spec = tasks[task_id]
+    key = task_spec['objective_key']
+    if key not in objectives and task_spec['optimizer'].loss_fn is not None:
+        entry = dict((k, task_spec.get(k)) for k in [
+            'policy', 'transition_model', 'optimizer', 'extra_in'])
+        entry['shared'] = objective_shared_vars(task_spec)
+        entry['owner'] = task_id
+        objectives[key] = entry
+
+
+def poll_inbox(inbox, pending, cancelled, block=False):
+    '''
+    moves the messages in the inbox of a worker to its pending jobs, and
+    records cancellation requests
+    '''
+    while True:
+        try:
+            msg = inbox.get(block)
+        except queue.Empty:
+            return
+        block = False
+        if msg is not None and msg[0] == 'cancel':
+            cancelled.add(msg[1])
+        else:
+            pending.append(msg)
+
+
+def run_job(tasks, objectives, command, task_id, args, minimize_cb):
+    if command == 'init':
+        task_spec = pickle.loads(args[0])
+        task_spec['objective_key'] = objective_key(task_spec)
+        tasks[task_id] = task_spec
+        for entry in objectives.values():
+            if entry['owner'] == task_id:
+                # the task was re-initialized with new models
+                entry['owner'] = None
+        return pickle.dumps(task_spec['objective_key'])
+    elif command == 'append':
+        task_spec = tasks[task_id]
+        if task_spec.get('experience') is None:
+            task_spec['experience'] = ExperienceDataset()
+        exp = task_spec['experience']
+        n_appended = exp.append_episodes_from_bytes(args[0])
+        return pickle.dumps(dict(appended=n_appended,
+                                 next_seq=exp.n_episodes()))
+    elif command == 'optimize':
+        load_objective(objectives, tasks, task_id)
+        task_spec = tasks[task_id]
+        exp, pol_params = args
+        if exp is not None:
+            task_spec['experience'] = pickle.loads(exp)
+        elif task_spec.get('experience') is None:
+            raise ValueError('No experience data for task %s' % (task_id))
+        task_spec['policy'].set_params(pickle.loads(pol_params))
+        utils.set_logfile("%s.log" % task_id, base_path="/localdata")
+        pol_params = mc_pilco_polopt(task_id, task_spec, minimize_cb)
+        store_objective(objectives, tasks, task_id)
+        return pickle.dumps(pol_params)
+    raise ValueError('Unknown command %s' % (command))
+
+
+def task_worker(inbox, outbox):
+    '''
+    worker process loop. Executes the jobs sent to its inbox in order, and
+    keeps the specs of the tasks assigned to it, so that compiled objectives
+    are reused across optimization jobs and across tasks with the same
+    structure. Status updates are sent to the outbox as (job_id, status,
+    result) tuples.
+    '''
+    tasks = {}
+    objectives = {}
+    pending = deque()
+    cancelled = set()
+    while True:
+        poll_inbox(inbox, pending, cancelled, block=len(pending) == 0)
+        msg = pending.popleft()
+        if msg is None:
+            break
+        command, job_id, task_id, args = msg
+        if job_id in cancelled:
+            cancelled.discard(job_id)
+            outbox.put((job_id, 'cancelled', None))
+            continue
+        outbox.put((job_id, 'running', None))
+
+        def minimize_cb(*args, **kwargs):
+            poll_inbox(inbox, pending, cancelled)
+            if job_id in cancelled:
+                raise JobCancelled()
+        try:
+            result = run_job(tasks, objectives, command, task_id, args,
+                             minimize_cb)
+            outbox.put((job_id, 'done', result))
+        except JobCancelled:
+            outbox.put((job_id, 'cancelled', None))
+        except Exception:
+            outbox.put((job_id, 'failed', traceback.format_exc()))
+        cancelled.discard(job_id)
+
+
+class JobManager(object):
+    '''
+    Runs the jobs submitted by the clients on a pool of worker processes.
+    All the jobs for a task run on the same worker, so updates to the same task
+    are serialized. Tasks are assigned to workers by model id, so tasks
+    sharing a model also share a worker, and then by the structure of their
+    policy objective, so that tasks with the same structure reuse the
+    objective compiled by the worker. Other tasks run concurrently.
+    '''
+    def __init__(self, n_workers=None):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        ctx = multiprocessing.get_context('fork')
+        self.outbox = ctx.Queue()
+        self.inboxes = []
+        self.workers = []
+        for i in range(n_workers):
+            inbox = ctx.Queue()
+            worker = ctx.Process(target=task_worker,
+                                 args=(inbox, self.outbox))
+            worker.daemon = True
+            worker.start()
+            self.inboxes.append(inbox)
+            self.workers.append(worker)
+
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.tasks = {}
+        self.model_workers = {}
+        self.key_workers = {}
+        self.collector = threading.Thread(target=self.collect_results)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def assign_worker(self, task_id, model_id=None, objective_key=None):
+        '''
+        returns the worker for the given task. New tasks go to the worker of
+        their model id if given, or else to the worker that already holds a
+        compiled objective with the same structure key, so that it can be
+        reused. Otherwise, the least loaded worker is assigned
+        '''
+        with self.lock:
+            if task_id in self.tasks:
+                return self.tasks[task_id]['worker']
+            if model_id in self.model_workers:
+                worker = self.model_workers[model_id]
+            elif objective_key in self.key_workers:
+                worker = self.key_workers[objective_key]
+            else:
+                load = [0]*len(self.workers)
+                for task in self.tasks.values():
+                    load[task['worker']] += 1
+                worker = int(np.argmin(load))
+            if model_id is not None:
+                self.model_workers.setdefault(model_id, worker)
+            if objective_key is not None:
+                self.key_workers.setdefault(objective_key, worker)
+            self.tasks[task_id] = dict(worker=worker, model_id=model_id,
+                                       init_job=None)
+            return worker
+
+    def submit(self, command, task_id, *args):
+        '''
+        queues a job on the worker assigned to the task and returns its id
+        '''
+        worker = self.assign_worker(task_id)
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = dict(
+                job_id=job_id, task_id=task_id, command=command,
+                worker=worker, status='queued', submitted=time.time(),
+                started=None, finished=None, result=None, error=None)
+            if command == 'init':
+                self.tasks[task_id]['init_job'] = job_id
+        self.inboxes[worker].put((command, job_id, task_id, args))
+        return job_id
+
+    def cancel(self, job_id):
+        '''
+        requests the cancellation of a queued or running job. Returns False
+        if the job has already finished
+        '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] not in ('queued', 'running'):
+                return False
+            job['cancel_requested'] = True
+            worker = job['worker']
+        self.inboxes[worker].put(('cancel', job_id))
+        return True
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def get_task_status(self, task_id):
+        '''
+        returns the status of the init job for the task, or None if the
+        task is not known
+        '''
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task['init_job'] is None:
+                return None
+            return self.jobs[task['init_job']]['status']
+
+    def collect_results(self):
+        while True:
+            job_id, status, result = self.outbox.get()
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                job['status'] = status
+                if status == 'running':
+                    job['started'] = time.time()
+                    continue
+                job['finished'] = time.time()
+                if status == 'done':
+                    job['result'] = result
+                    if job['command'] == 'init':
+                        # route new tasks with the same objective key to
+                        # the worker that will compile it
+                        key = pickle.loads(result)
+                        self.key_workers.setdefault(key, job['worker'])
+                elif status == 'failed':
+                    job['error'] = result
+            sys.stderr.write("JOB %s (%s/%s): %s\n" % (
+                job_id, job['command'], job['task_id'], status))
+
+    def shutdown(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def get_job_manager(n_workers=None):
+    '''
+    returns the job manager, starting the worker processes on the first call
+    '''
+    global job_manager
+    with job_manager_lock:
+        if job_manager is None:
+            job_manager = JobManager(n_workers)
+    return job_manager
+
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -117,8 +550,13 @@ def get_task_init_status(task_id):
     sys.stderr.write("GET REQUEST: get_task_init_status/%s" % task_id+"\n")
 
     response = "NOT FOUND"
-    if task_id in task_spec_dict:
+    status = get_job_manager().get_task_status(task_id)
+    if status == 'done':
         response = "INITIALISED"
+    elif status in ('queued', 'running'):
+        response = "PENDING"
+    elif status is not None:
+        response = status.upper()
 
     return "get_task_init_status/%s: %s" % (task_id, response)
 
@@ -142,7 +580,17 @@ def init_task(task_id):
 
         elif f_tspec and allowed_file(f_tspec.filename):
             tspec_filename = secure_filename(f_tspec.filename)
-            task_spec_dict[task_id] = pickle.loads(f_tspec.read())
+            # tasks that share a model should be initialized with the same
+            # model_id, so that their updates are serialized. Otherwise, the
+            # task goes to a worker that has compiled the same objective. The
+            # task spec is only unpickled by the worker, so this needs the
+            # client to send the objective_key of the task; the keys of
+            # previous tasks are reported by their init jobs
+            tspec = f_tspec.read()
+            manager = get_job_manager()
+            manager.assign_worker(task_id, request.form.get('model_id'),
+                                  request.form.get('objective_key'))
+            manager.submit('init', task_id, tspec)
 
             sys.stderr.write("Received file:\t" + tspec_filename + "\t")
 
@@ -153,45 +601,134 @@ def init_task(task_id):
 
 @app.route("/optimize/<task_id>", methods=['POST'])
 def optimize(task_id):
-    utils.set_logfile("%s.log" % task_id, base_path="/localdata")
+    '''
+    queues a policy optimization job for the task, and returns its job id.
+    The new policy parameters can be retrieved from /jobs/<job_id>/result
+    once the job is done. If exp_file is not given, the episodes uploaded
+    with /append_episodes are used
+    '''
     sys.stderr.write("POST REQUEST: optimize/%s" % task_id+"\n")
 
     response = "FAILED"
+    manager = get_job_manager()
 
-    if task_id not in task_spec_dict:
+    if manager.get_task_status(task_id) is None:
         response = "TASK NOT INITIALIZED"
 
-    elif 'exp_file' not in request.files:
-        response = "exp_file missing"
-        sys.stderr.write(response + "\n")
-
     elif 'pol_params_file' not in request.files:
         response = "pol_params_file missing"
         sys.stderr.write(response + "\n")
 
     else:
-        f_exp = request.files['exp_file']
+        f_exp = request.files.get('exp_file')
         f_pol_params = request.files['pol_params_file']
 
-        if f_exp and allowed_file(f_exp.filename) and \
+        if (f_exp is None or f_exp and allowed_file(f_exp.filename)) and \
            f_pol_params and allowed_file(f_pol_params.filename):
 
-            exp_filename = secure_filename(f_exp.filename)
+            exp_filename = secure_filename(f_exp.filename) if f_exp else ''
             pol_params_filename = secure_filename(f_pol_params.filename)
             sys.stderr.write("Received files:\t" + exp_filename + "\t"
                                                  + pol_params_filename + "\n")
 
-            task_spec_dict[task_id]['experience'] = pickle.loads(f_exp.read())
-            task_spec_dict[task_id]['policy'].set_params(
-                pickle.loads(f_pol_params.read()))
-            f_exp.close(), f_pol_params.close()
+            exp = f_exp.read() if f_exp else None
+            job_id = manager.submit(
+                'optimize', task_id, exp, f_pol_params.read())
+            if f_exp:
+                f_exp.close()
+            f_pol_params.close()
+
+            return jsonify(job_id=job_id, status='queued')
+
+    return "optimize/%s: %s" % (task_id, response)
+
+
+@app.route("/append_episodes/<task_id>", methods=['POST'])
+def append_episodes(task_id):
+    '''
+    queues a job that appends the episodes in episodes_file (serialized with
+    ExperienceDataset.episodes_to_bytes) to the dataset of the task. Episodes
+    that were already received are skipped, so failed uploads can be retried
+    with the same file. The job result contains the number of appended
+    episodes and the sequence number expected for the next upload
+    '''
+    sys.stderr.write("POST REQUEST: append_episodes/%s" % task_id+"\n")
 
-            pol_params = mc_pilco_polopt(task_id, task_spec_dict[task_id])
+    response = "FAILED"
+    manager = get_job_manager()
+
+    if manager.get_task_status(task_id) is None:
+        response = "TASK NOT INITIALIZED"
+
+    elif 'episodes_file' not in request.files:
+        response = "episodes_file missing"
+        sys.stderr.write(response + "\n")
+
+    else:
+        f_episodes = request.files['episodes_file']
+        data = f_episodes.read()
+        f_episodes.close()
+        try:
+            with np.load(io.BytesIO(data), allow_pickle=False) as f:
+                first_seq = int(f['first_seq'])
+                n_episodes = int(f['n_episodes'])
+        except Exception:
+            response = "episodes_file is not a valid episodes archive"
+            sys.stderr.write(response + "\n")
+        else:
+            sys.stderr.write("Received episodes %d to %d (%d bytes)\n" % (
+                first_seq, first_seq + n_episodes - 1, len(data)))
+            job_id = manager.submit('append', task_id, data)
+            return jsonify(job_id=job_id, status='queued',
+                           first_seq=first_seq, n_episodes=n_episodes)
+
+    return "append_episodes/%s: %s" % (task_id, response)
+
+
+def job_status(job):
+    return dict((k, v) for k, v in job.items() if k != 'result')
+
+
+@app.route("/jobs/<string:job_id>", methods=['GET'])
+def get_job(job_id):
+    job = get_job_manager().get_job(job_id)
+    if job is None:
+        return "jobs/%s: NOT FOUND" % job_id, 404
+    return jsonify(**job_status(job))
+
+
+@app.route("/jobs/<string:job_id>/result", methods=['GET'])
+def get_job_result(job_id):
+    '''
+    returns the pickled policy parameters found by an optimization job
+    '''
+    job = get_job_manager().get_job(job_id)
+    if job is None:
+        return "jobs/%s: NOT FOUND" % job_id, 404
+    if job['status'] != 'done':
+        return jsonify(**job_status(job)), 202
+    return job['result']
 
-            response = pickle.dumps(pol_params)
 
-    return response  # "optimize/%s: %s" % (task_id, response)
+@app.route("/jobs/<string:job_id>/cancel", methods=['POST'])
+def cancel_job(job_id):
+    sys.stderr.write("POST REQUEST: jobs/%s/cancel" % job_id+"\n")
+    manager = get_job_manager()
+    if manager.get_job(job_id) is None:
+        return "jobs/%s: NOT FOUND" % job_id, 404
+    response = "CANCELLING" if manager.cancel(job_id) else "FINISHED"
+    return "jobs/%s/cancel: %s" % (job_id, response)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8008)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument(
+        '--n_workers', type=int, default=None,
+        help='number of worker processes. Default: number of cpus')
+    args = parser.parse_args()
+
+    # start the workers before the server threads
+    get_job_manager(args.n_workers)
+    app.run(host=args.host, port=args.port)
@@ -1,11 +1,8 @@
-from .plant import Plant
-
-from . import arduino
-from . import cartpole
-from . import cost
-from . import double_cartpole
-from . import evaluate_policy
-from . import experiment_utils
-from . import pendulum
-from . import plant
+from kusanagi.utils.lazy import lazy_module
 
+# the plants and experiment utilities are imported when first accessed
+lazy_module(
+    __name__,
+    submodules=['arduino', 'cartpole', 'cost', 'double_cartpole',
+                'evaluate_policy', 'experiment_utils', 'pendulum', 'plant'],
+    attributes={'Plant': 'plant', 'BatchedODEPlant': 'plant'})
@@ -6,7 +6,6 @@ a rendering class
 import numpy as np
 
 from gym import spaces
-from matplotlib import pyplot as plt
 
 from kusanagi.shell import plant
 from kusanagi.shell import cost
@@ -159,6 +158,25 @@ class Cartpole(plant.ODEPlant):
 
         return dz
 
+    def batch_dynamics(self, t, z, u):
+        l, m, M, b, g = self.l, self.m, self.M, self.b, self.g
+        f = u[:, 0]
+
+        sz, cz = np.sin(z[:, 3]), np.cos(z[:, 3])
+        cz2 = cz*cz
+        a0 = m*l*z[:, 2]*z[:, 2]*sz
+        a1 = g*sz
+        a2 = f - b*z[:, 1]
+        a3 = 4*(M+m) - 3*m*cz2
+
+        dz = np.empty_like(z)
+        dz[:, 0] = z[:, 1]
+        dz[:, 1] = (2*a0 + 3*m*a1*cz + 4*a2)/a3
+        dz[:, 2] = -3*(a0*cz + 2*((M+m)*a1 + a2*cz))/(l*a3)
+        dz[:, 3] = z[:, 2]
+
+        return dz
+
     def reset(self):
         state0 = self.state0_dist()
         self.set_state(state0)
@@ -190,6 +208,7 @@ class CartpoleDraw(plant.PlantDraw):
         self.center_y = 0
 
     def init_artists(self):
+        from matplotlib import pyplot as plt
         plt.figure(self.name)
         # initialize the patches to draw the cartpole
         l = self.plant.l
@@ -6,7 +6,6 @@ a rendering class
 import numpy as np
 
 from gym import spaces
-from matplotlib import pyplot as plt
 
 from kusanagi.shell import plant
 from kusanagi.shell import cost
@@ -188,6 +187,47 @@ class DoubleCartpole(plant.ODEPlant):
 
         return dz
 
+    def batch_dynamics(self, t, z, u):
+        m1, m2, M, l1, l2, b, g = self.m1, self.m2, self.M,\
+                                  self.l1, self.l2, self.b,\
+                                  self.g
+        f = u[:, 0]
+
+        sz4 = np.sin(z[:, 4])
+        cz4 = np.cos(z[:, 4])
+        sz5 = np.sin(z[:, 5])
+        cz5 = np.cos(z[:, 5])
+        cz4m5 = np.cos(z[:, 4] - z[:, 5])
+        sz4m5 = np.sin(z[:, 4] - z[:, 5])
+        a0 = m2+2*M
+        a1 = M*l2
+        a2 = l1*(z[:, 2]*z[:, 2])
+        a3 = a1*(z[:, 3]*z[:, 3])
+
+        A = np.empty((z.shape[0], 3, 3))
+        A[:, 0, 0] = 2*(m1+m2+M)
+        A[:, 0, 1] = -a0*l1*cz4
+        A[:, 0, 2] = -a1*cz5
+        A[:, 1, 0] = -3*a0*cz4
+        A[:, 1, 1] = (2*a0+2*M)*l1
+        A[:, 1, 2] = 3*a1*cz4m5
+        A[:, 2, 0] = -3*cz5
+        A[:, 2, 1] = 3*l1*cz4m5
+        A[:, 2, 2] = 2*l2
+        c = np.stack([2*f-2*b*z[:, 1]-a0*a2*sz4-a3*sz5,
+                      3*a0*g*sz4 - 3*a3*sz4m5,
+                      3*a2*sz4m5 + 3*g*sz5], axis=-1)
+
+        x = np.linalg.solve(A, c[:, :, None])[:, :, 0]
+
+        dz = np.empty_like(z)
+        dz[:, 0] = z[:, 1]
+        dz[:, 1:4] = x
+        dz[:, 4] = z[:, 2]
+        dz[:, 5] = z[:, 3]
+
+        return dz
+
     def reset(self):
         state0 = self.state0_dist()
         self.set_state(state0)
@@ -207,6 +247,7 @@ class DoubleCartpole(plant.ODEPlant):
 class DoubleCartpoleDraw(plant.PlantDraw):
     def __init__(self, double_cartpole_plant, refresh_period=(1.0/240),
                  name='DoubleCartpoleDraw'):
+        from matplotlib import pyplot as plt
         super(DoubleCartpoleDraw, self).__init__(double_cartpole_plant,
                                                  refresh_period, name)
         m1 = self.plant.m1
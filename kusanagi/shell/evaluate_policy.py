@@ -1,7 +1,6 @@
 import argparse
 import dill
 import os
-import pickle as pkl
 
 from functools import partial
 
@@ -79,14 +78,18 @@ if __name__ == '__main__':
     # init environment
     env = env_class(loss_func=cost, **params['plant'])
 
-    # evaluate policy
-    results = experiment_utils.evaluate_policy(
-        env, pol, exp, params, n_trials, render=args.render)
-
-    # dump results to file
+    # results are dumped to file after every evaluated iteration; previously
+    # evaluated iterations are skipped unless --force is set
     results_path = os.path.join(
         odir, 'results_%d_%d' % (last_iteration, n_trials))
-    if (not os.path.isfile(results_path)) or args.force:
-        with open(results_path, 'wb+') as f:
-            utils.print_with_stamp('Dumping results to [%s]' % (results_path))
-            pkl.dump(results, f, 2)
+    if os.path.isfile(results_path) and args.force:
+        os.remove(results_path)
+
+    # evaluate policy
+    n_workers = kwargs.get('n_workers', None)
+    n_workers = int(n_workers) if n_workers is not None else None
+    seed = int(kwargs.get('seed', 0))
+    results = experiment_utils.evaluate_policy(
+        env, pol, exp, params, n_trials, render=args.render,
+        n_workers=n_workers, seed=seed, results_path=results_path)
+    utils.print_with_stamp('Dumped results to [%s]' % (results_path))
@@ -1,7 +1,9 @@
+import multiprocessing
 import numpy as np
+import os
+import pickle
 
 from lasagne import nonlinearities
-from matplotlib import pyplot as plt
 
 from kusanagi import utils
 from kusanagi.ghost import (algorithms, regression, control, optimizers)
@@ -9,6 +11,7 @@ from kusanagi.base import apply_controller, train_dynamics, ExperienceDataset
 
 
 def plot_rollout(rollout_fn, exp, *args, **kwargs):
+    from matplotlib import pyplot as plt
     fig = kwargs.get('fig', None)
     axarr = kwargs.get('axarr', None)
     name = kwargs.get('name', 'Rollout')
@@ -186,12 +189,15 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
             step_cb(state, action, cost, info)
 
     def minimize_cb_internal(*args, **kwargs):
+        if particle_controller is not None:
+            particle_controller.update(args[0], args[costs_idx])
         if not crn_dropout:
             if hasattr(dyn, 'update'):
                 dyn.update()
             if hasattr(pol, 'update'):
                 pol.update()
         if debug_plot > 1:
+            from matplotlib import pyplot as plt
             counter, progress_fig, progress_axarr = minimize_cb_state
             if counter % 100 == 0:
                 p0 = params['state0_dist']
@@ -214,6 +220,10 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
     def gTrig(state):
         return utils.gTrig_np(state, angle_dims).flatten()
 
+    # timing spans recorded before the first policy optimization are
+    # assigned to iteration 0
+    utils.set_timing_context(iteration=0)
+
     # collect experience with random controls
     randpol = control.RandPolicy(maxU=pol.maxU)
     for i in range(n_rnd):
@@ -242,6 +252,13 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
     if isinstance(loss, list):
         loss, outs = loss[0], loss[1:]
 
+    # the number of particles may be adapted from the per particle costs,
+    # which are passed as an additional output to the minimize callback
+    particle_controller = getattr(loss.tag, 'particle_controller', None)
+    if particle_controller is not None:
+        costs_idx = 1 + len(outs)
+        outs.append(particle_controller.costs)
+
     rollout_fn = None
     if debug_plot > 0:
         # build rollout function for plotting
@@ -270,6 +287,7 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
         total_exp = sum([len(st) for st in exp.states])
         msg = '==== Iteration [%d], experience: [%d steps] ===='
         utils.print_with_stamp(msg % (i+1, total_exp))
+        utils.set_timing_context(iteration=i+1)
         if crn_dropout:
             if hasattr(dyn, 'update'):
                 dyn.update()
@@ -291,9 +309,13 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
                 lr = lr(i)
             minimize_args.append(lr)
 
-        polopt.minimize(*minimize_args,
-                        callback=minimize_cb_internal,
-                        return_best=return_best)
+        if particle_controller is not None:
+            particle_controller.reset()
+        with utils.timing_span('policy_optimization',
+                               experience_size=total_exp):
+            polopt.minimize(*minimize_args,
+                            callback=minimize_cb_internal,
+                            return_best=return_best)
 
         # 3. apply controller
         exp.new_episode(
@@ -311,12 +333,94 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
         if debug_plot > 0:
             fig, axarr = plot_rollout(
                 rollout_fn, exp, m0, S0, H, gamma, fig=fig, axarr=axarr)
+    utils.set_timing_context(iteration=None)
     env.close()
 
 
-def evaluate_policy(env, input_pol, exp, params, n_tests=100, render=False):
+def evaluate_policy(env, input_pol, exp, params, n_tests=100, render=False,
+                    n_workers=None, seed=None, results_path=None):
+    '''
+        Evaluates the policy parameters stored in exp at every iteration, by
+        running n_tests trials on env. Trials are distributed over n_workers
+        processes (one per core by default); each worker holds its own copy of
+        the env and policy. Every trial is seeded with (seed, iteration, trial)
+        so results don't depend on the number of workers. If results_path is
+        given, results are saved there after every iteration and iterations
+        already in that file are skipped.
+    '''
+    global _evaluate_args
     H = params['min_steps']
     angle_dims = params['angle_dims']
+    if seed is None:
+        seed = params.get('seed', 0)
+    policy_params = exp.policy_parameters
+
+    results = []
+    if results_path is not None and os.path.isfile(results_path):
+        with open(results_path, 'rb') as f:
+            results = pickle.load(f)
+        msg = 'Loaded results for %d iterations from [%s]'
+        utils.print_with_stamp(msg % (len(results), results_path))
+    pending = list(range(len(results), len(policy_params)))
+    if len(pending) == 0:
+        return results
+
+    if render:
+        n_workers = 1
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(1, min(n_workers, len(pending)*n_tests))
+
+    # compile the policy before forking, so workers don't have to
+    if hasattr(input_pol, 'get_params'):
+        if len(input_pol.get_params()) == 0:
+            input_pol.init_params()
+        input_pol(np.zeros((input_pol.D,)))
+
+    _evaluate_args = (env, input_pol, policy_params, H, angle_dims, seed,
+                      render)
+    tasks = [(i, it) for i in pending for it in range(n_tests)]
+    pool = None
+    try:
+        if n_workers > 1:
+            msg = 'Evaluating %d iterations with %d workers'
+            utils.print_with_stamp(msg % (len(pending), n_workers))
+            ctx = multiprocessing.get_context('fork')
+            pool = ctx.Pool(n_workers)
+            trials = pool.imap(_evaluate_worker, tasks, chunksize=n_tests)
+        else:
+            trials = map(_evaluate_worker, tasks)
+
+        # gather trials in order, one iteration at a time
+        for i in pending:
+            utils.print_with_stamp('Evaluating policy at iteration %d' % i)
+            results_i = [next(trials) for it in range(n_tests)]
+            results.append(results_i)
+            if results_path is not None:
+                with open(results_path, 'wb+') as f:
+                    pickle.dump(results, f, 2)
+    finally:
+        _evaluate_args = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return results
+
+
+_evaluate_args = None
+
+
+def _evaluate_worker(task):
+    env, input_pol, policy_params, H, angle_dims, seed, render =\
+        _evaluate_args
+    i, it = task
+    p = policy_params[i]
+    if p:
+        input_pol.set_params(p)
+        pol = input_pol
+    else:
+        pol = control.RandPolicy(maxU=input_pol.maxU)
 
     def gTrig(state):
         return utils.gTrig_np(state, angle_dims).flatten()
@@ -325,20 +429,5 @@ def evaluate_policy(env, input_pol, exp, params, n_tests=100, render=False):
         if render:
             env.render()
 
-    results = []
-    for i, p in enumerate(exp.policy_parameters):
-        utils.print_with_stamp('Evaluating policy at iteration %d' % i)
-        if p:
-            input_pol.set_params(p)
-            pol = input_pol
-        else:
-            pol = control.RandPolicy(maxU=input_pol.maxU)
-
-        results_i = []
-        for it in range(n_tests):
-            ret = apply_controller(
-                env, pol, H, preprocess=gTrig, callback=step_cb)
-            results_i.append(ret)
-        results.append(results_i)
-
-    return results
+    np.random.seed([seed, i, it])
+    return apply_controller(env, pol, H, preprocess=gTrig, callback=step_cb)
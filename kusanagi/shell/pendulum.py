@@ -6,7 +6,6 @@ a rendering class
 import numpy as np
 
 from gym import spaces
-from matplotlib import pyplot as plt
 
 from kusanagi.shell import plant
 from kusanagi.shell import cost
@@ -148,6 +147,17 @@ class Pendulum(plant.ODEPlant):
 
         return dz
 
+    def batch_dynamics(self, t, z, u):
+        l, m, b, g = self.l, self.m, self.b, self.g
+        f = u[:, 0]
+
+        a1 = m*l
+        dz = np.empty_like(z)
+        dz[:, 0] = z[:, 1]
+        dz[:, 1] = 3*(f - b*z[:, 1] - 0.5*a1*g*np.sin(z[:, 0]))/(a1*l)
+
+        return dz
+
     def reset(self):
         state0 = self.state0_dist()
         self.set_state(state0)
@@ -167,6 +177,7 @@ class Pendulum(plant.ODEPlant):
 class PendulumDraw(plant.PlantDraw):
     def __init__(self, pendulum_plant, refresh_period=(1.0/240),
                  name='PendulumDraw'):
+        from matplotlib import pyplot as plt
         super(PendulumDraw, self).__init__(pendulum_plant,
                                            refresh_period, name)
         l = self.plant.l
@@ -3,17 +3,13 @@ import gym
 import numpy as np
 import types
 
-from matplotlib import pyplot as plt
-from matplotlib.widgets import Cursor
-from matplotlib.colors import cnames
-from scipy.integrate import ode
 from time import time, sleep
 from threading import Thread
-from multiprocessing import Process, Pipe, Event
 from kusanagi.utils import print_with_stamp, gTrig_np
-from kusanagi.shell.cost import build_loss_func
 
-color_generator = iter(cnames.items())
+# matplotlib, scipy and multiprocessing are imported where they are used, so
+# that importing this module stays cheap
+color_generator = None
 
 
 class Plant(gym.Env):
@@ -36,6 +32,7 @@ class Plant(gym.Env):
         # reward/loss function
         self.loss_func = loss_func
         if callable(loss_func):
+            from kusanagi.shell.cost import build_loss_func
             try:
                 self.loss_func = build_loss_func(loss_func, False,
                                                  self.name+'_loss')
@@ -89,6 +86,7 @@ class ODEPlant(Plant):
         rtol = kwargs.get('rtol', 1e-12)
 
         # initialize ode solver
+        from scipy.integrate import ode
         self.solver = ode(self.dynamics).set_integrator(integrator,
                                                         atol=atol,
                                                         rtol=rtol)
@@ -121,6 +119,140 @@ class ODEPlant(Plant):
         msg = "You need to implement self.dynamics in the ODEPlant subclass."
         raise NotImplementedError(msg)
 
+    def batch_dynamics(self, t, z, u):
+        msg = "You need to implement self.batch_dynamics in the ODEPlant "\
+              "subclass to use it with BatchedODEPlant."
+        raise NotImplementedError(msg)
+
+
+# Dormand-Prince 5(4) coefficients
+DOPRI5_C = np.array([0, 1/5., 3/10., 4/5., 8/9., 1.])
+DOPRI5_A = [np.array([]),
+            np.array([1/5.]),
+            np.array([3/40., 9/40.]),
+            np.array([44/45., -56/15., 32/9.]),
+            np.array([19372/6561., -25360/2187., 64448/6561., -212/729.]),
+            np.array([9017/3168., -355/33., 46732/5247., 49/176.,
+                      -5103/18656.])]
+DOPRI5_B = np.array([35/384., 0, 500/1113., 125/192., -2187/6784., 11/84.])
+DOPRI5_E = np.array([71/57600., 0, -71/16695., 71/1920., -17253/339200.,
+                     22/525., -1/40.])
+
+
+class BatchedODEPlant(Plant):
+    '''
+    Simulates batch_size independent copies of an ODEPlant in lockstep. The
+    plant must implement batch_dynamics(t, z, u), where z is a (B, D) array of
+    states and u is a (B, U) array of controls. States are integrated with
+    either a Dormand-Prince 5(4) method with a step size shared across the
+    batch ('dopri5'), or with fixed step RK4 ('rk4'). reset and step return
+    stacked (B, D) observations and (B,) costs.
+    '''
+    def __init__(self, plant, batch_size=1, integrator='dopri5',
+                 atol=1e-12, rtol=1e-12, n_substeps=10,
+                 name=None, *args, **kwargs):
+        name = plant.name+'_batch' if name is None else name
+        super(BatchedODEPlant, self).__init__(
+            dt=plant.dt, noise_dist=plant.noise_dist,
+            angle_dims=plant.angle_dims, name=name, *args, **kwargs)
+        self.plant = plant
+        self.batch_size = batch_size
+        self.integrator = integrator
+        self.atol = atol
+        self.rtol = rtol
+        self.n_substeps = n_substeps
+        self.loss_func = plant.loss_func
+        self.observation_space = getattr(plant, 'observation_space', None)
+        self.action_space = getattr(plant, 'action_space', None)
+        # last accepted step size for the adaptive integrator
+        self.h = None
+
+    def apply_control(self, u):
+        self.u = np.array(u, dtype=np.float64).reshape(self.batch_size, -1)
+
+    def get_state(self, noisy=True):
+        state = self.state
+
+        if noisy and self.noise_dist is not None:
+            # noisy state measurements
+            state = state + self.noise_dist.sample(self.batch_size)
+
+        if self.angle_dims:
+            # convert angle dimensions to complex representation
+            state = gTrig_np(state, self.angle_dims)
+        return state, self.t
+
+    def set_state(self, state):
+        state = np.array(state, dtype=np.float64)
+        if state.ndim < 2:
+            state = np.tile(state.flatten(), (self.batch_size, 1))
+        self.state = state.reshape(self.batch_size, -1)
+        self.t = 0
+        self.h = None
+
+    def reset(self):
+        state0 = self.plant.state0_dist.sample(self.batch_size)
+        self.set_state(state0)
+        return self.state
+
+    def dynamics(self, t, z):
+        u = self.u
+        if u is None:
+            u = np.zeros((self.batch_size, 1))
+        return self.plant.batch_dynamics(t, z, u)
+
+    def integrate_rk4(self, t, z, dt):
+        h = dt/self.n_substeps
+        for i in range(self.n_substeps):
+            k1 = self.dynamics(t, z)
+            k2 = self.dynamics(t + 0.5*h, z + 0.5*h*k1)
+            k3 = self.dynamics(t + 0.5*h, z + 0.5*h*k2)
+            k4 = self.dynamics(t + h, z + h*k3)
+            z = z + (h/6.0)*(k1 + 2*k2 + 2*k3 + k4)
+            t = t + h
+        return z
+
+    def integrate_dopri5(self, t, z, dt):
+        t1 = t + dt
+        h = dt/self.n_substeps if self.h is None else self.h
+        K = np.empty((7,) + z.shape)
+        K[0] = self.dynamics(t, z)
+        while t1 - t > 1e-12*dt:
+            h = min(h, t1 - t)
+            for i in range(1, 6):
+                dz = np.tensordot(DOPRI5_A[i], K[:i], axes=1)
+                K[i] = self.dynamics(t + DOPRI5_C[i]*h, z + h*dz)
+            z_new = z + h*np.tensordot(DOPRI5_B, K[:6], axes=1)
+            K[6] = self.dynamics(t + h, z_new)
+
+            # error estimate; the step is accepted only if it is within
+            # tolerance for every element in the batch
+            scale = self.atol + self.rtol*np.maximum(abs(z), abs(z_new))
+            err = h*np.tensordot(DOPRI5_E, K, axes=1)/scale
+            err = np.sqrt((err**2).mean(-1)).max()
+            if err <= 1.0:
+                t = t + h
+                z = z_new
+                K[0] = K[6]
+            factor = 10.0 if err == 0 else 0.9*err**(-0.2)
+            h = h*min(10.0, max(0.2, factor))
+        self.h = h
+        return z
+
+    def step(self, action):
+        self.apply_control(action)
+        if self.integrator == 'rk4':
+            self.state = self.integrate_rk4(self.t, self.state, self.dt)
+        else:
+            self.state = self.integrate_dopri5(self.t, self.state, self.dt)
+        self.t = self.t + self.dt
+        cost = None
+        if self.loss_func is not None:
+            cost = np.array(self.loss_func(self.state)).flatten()
+        state, t = self.get_state()
+        done = np.zeros((self.batch_size,), dtype=bool)
+        return state, cost, done, dict(t=t)
+
 
 
 class PlantDraw(object):
@@ -138,11 +270,14 @@ class PlantDraw(object):
 
         self.center_x = 0
         self.center_y = 0
+        from multiprocessing import Pipe, Event
         self.running = Event()
 
         self.polling_pipe, self.drawing_pipe = Pipe()
 
     def init_ui(self):
+        from matplotlib import pyplot as plt
+        from matplotlib.widgets import Cursor
         plt.close(self.name)
         self.fig = plt.figure(self.name)
         self.ax = plt.gca()
@@ -158,6 +293,7 @@ class PlantDraw(object):
         plt.show(False)
 
     def drawing_loop(self, drawing_pipe):
+        from matplotlib import pyplot as plt
         # start the matplotlib plotting
         self.init_ui()
 
@@ -183,10 +319,12 @@ class PlantDraw(object):
 
     def close(self):
         # close the matplotlib windows, clean up
+        from matplotlib import pyplot as plt
         # plt.ioff()
         plt.close(self.fig)
 
     def update(self, *args, **kwargs):
+        from matplotlib import pyplot as plt
         plt.figure(self.name)
         updts = self._update(*args, **kwargs)
         self.update_canvas(updts)
@@ -202,6 +340,7 @@ class PlantDraw(object):
         raise NotImplementedError(msg)
 
     def update_canvas(self, updts):
+        from matplotlib import pyplot as plt
         if updts is not None:
             # update the drawing from the plant state
             self.fig.canvas.restore_region(self.bg)
@@ -227,6 +366,7 @@ class PlantDraw(object):
 
     def start(self):
         print_with_stamp('Starting drawing loop', self.name)
+        from multiprocessing import Process
         self.drawing_thread = Process(target=self.drawing_loop,
                                       args=(self.drawing_pipe, ))
         self.drawing_thread.daemon = True
@@ -270,6 +410,11 @@ class LivePlot(PlantDraw):
         self.update_period = refresh_period
 
     def init_artists(self):
+        global color_generator
+        from matplotlib import pyplot as plt
+        if color_generator is None:
+            from matplotlib.colors import cnames
+            color_generator = iter(cnames.items())
         plt.figure(self.name)
         self.lines = [plt.Line2D(self.t_labels, self.data[:, i],
                                  c=next(color_generator)[0])
@@ -280,6 +425,7 @@ class LivePlot(PlantDraw):
         self.previous_update_time = time()
 
     def _update(self, state, t):
+        from matplotlib import pyplot as plt
         if t != self.current_t:
             if len(self.data) <= 1:
                 self.data = np.array([state]*2)
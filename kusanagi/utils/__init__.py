@@ -1,3 +1,13 @@
-from . import updates
 from . import distributions
-from .utils_ import *
+from .np_utils import *
+from .profiling import (timing_span, set_timing_context, get_timings_file,
+                        set_timings_file, get_timing_stats)
+from .lazy import lazy_module
+
+# the theano dependent utilities are imported when first accessed
+lazy_module(
+    __name__, submodules=['updates', 'function_cache', 'utils_'],
+    attributes={'cached_function': 'function_cache',
+                'get_function_cache_dir': 'function_cache',
+                'get_function_cache_stats': 'function_cache'},
+    fallback='utils_')
@@ -0,0 +1,206 @@
+'''
+Disk cache for compiled theano functions. Functions are stored under a key
+computed from the symbolic graph (outputs, updates and givens), the input
+types, floatX, device, compilation mode and theano version, so restarted or
+resumed experiments can skip graph optimization and compilation. Shared
+variables of the cached function are swapped for the ones in the current
+graph when loading. The cache is opt-in: it is only used if the
+$KUSANAGI_FUNCTION_CACHE environment variable is set.
+'''
+import hashlib
+import io
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import theano
+from theano.compile import SharedVariable
+from theano.gof import Constant, graph
+
+from .np_utils import print_with_stamp
+from .profiling import timing_span
+
+# cache statistics for the current process
+cache_stats = {'hits': 0, 'misses': 0, 'time_saved': 0.0}
+
+
+def get_function_cache_dir():
+    ''' Returns the folder where compiled functions are cached, set via the
+    $KUSANAGI_FUNCTION_CACHE environment variable (e.g. to
+    $HOME/.kusanagi/function_cache). The cache is disabled if it is not set,
+    or set to an empty string.'''
+    cache_dir = os.environ.get('KUSANAGI_FUNCTION_CACHE', '')
+    if cache_dir:
+        cache_dir = os.path.expanduser(cache_dir)
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    return cache_dir
+
+
+def get_function_cache_stats():
+    ''' Returns the number of cache hits, misses and the compilation time
+    saved (in seconds) by the function cache in the current process'''
+    return dict(cache_stats)
+
+
+def _as_list(x):
+    if x is None:
+        return []
+    if isinstance(x, (list, tuple)):
+        return list(x)
+    return [x]
+
+
+def _as_pairs(x):
+    if x is None:
+        return []
+    if isinstance(x, dict):
+        return list(x.items())
+    return list(x)
+
+
+def _graph_variables(outputs, updates, givens):
+    ''' Returns the list of all variables that define the function graph'''
+    outs = [o.variable if isinstance(o, theano.Out) else o
+            for o in _as_list(outputs)]
+    variables = outs
+    for k, v in _as_pairs(updates) + _as_pairs(givens):
+        variables += [k, v]
+    return variables
+
+
+def _shared_variables(variables):
+    ''' Returns the shared variables in the graph, in a deterministic order'''
+    shared = []
+    for v in graph.inputs(variables):
+        if isinstance(v, SharedVariable) and v not in shared:
+            shared.append(v)
+    return shared
+
+
+def graph_signature(inputs, outputs, updates=None, givens=None, mode=None,
+                    **kwargs):
+    ''' Returns a hash of the symbolic graph and compilation settings'''
+    cfg = theano.config
+    variables = _graph_variables(outputs, updates, givens)
+    shared = _shared_variables(variables)
+
+    buf = io.StringIO()
+    buf.write('theano %s\n' % (theano.__version__))
+    buf.write('%s %s %s %s\n' % (cfg.floatX, cfg.device, cfg.mode, mode))
+    for k in sorted(kwargs):
+        buf.write('%s=%r\n' % (k, kwargs[k]))
+    for inp in _as_list(inputs):
+        buf.write('input %s %s\n' % (inp.name, inp.type))
+    # a single output is returned unpacked, a list of outputs as a list
+    buf.write('outputs %s\n' % (type(outputs).__name__))
+    for o in _as_list(outputs):
+        if isinstance(o, theano.Out):
+            buf.write('output borrow=%s\n' % (o.borrow))
+    for k, v in _as_pairs(updates):
+        buf.write('update %d\n' % (shared.index(k)))
+    for k, v in _as_pairs(givens):
+        buf.write('given %s %s\n' % (k.name, k.type))
+    theano.printing.debugprint(variables, file=buf, print_type=True)
+
+    # debugprint abbreviates constants, so we hash their contents as well
+    for v in graph.ancestors(variables):
+        if isinstance(v, Constant):
+            buf.write('%s\n' % (hashlib.sha1(
+                np.ascontiguousarray(v.data)).hexdigest()))
+
+    return hashlib.sha256(buf.getvalue().encode('utf-8')).hexdigest()
+
+
+def cached_function(inputs, outputs=None, updates=None, givens=None,
+                    mode=None, name=None, **kwargs):
+    ''' Drop-in replacement for theano.function. Compiled functions are
+    pickled to the folder returned by get_function_cache_dir, and loaded
+    from there when a function with the same graph signature is requested.
+    '''
+    with timing_span('compile', function=name) as counters:
+        hits = cache_stats['hits']
+        fn = _cached_function(inputs, outputs, updates, givens, mode, name,
+                              **kwargs)
+        counters['cache_hit'] = cache_stats['hits'] > hits
+    return fn
+
+
+def _cached_function(inputs, outputs=None, updates=None, givens=None,
+                     mode=None, name=None, **kwargs):
+    fn_kwargs = dict(updates=updates, givens=givens, mode=mode, name=name,
+                     **kwargs)
+    cache_dir = get_function_cache_dir()
+    if not cache_dir:
+        return theano.function(inputs, outputs, **fn_kwargs)
+
+    variables = _graph_variables(outputs, updates, givens)
+    shared = _shared_variables(variables)
+    key = graph_signature(inputs, outputs, updates, givens, mode, **kwargs)
+    path = os.path.join(cache_dir, '%s.pkl' % (key))
+    fn_name = name if name else key[:12]
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, 50000))
+
+    try:
+        # try loading the function from the cache
+        if os.path.isfile(path):
+            try:
+                start_time = time.time()
+                with open(path, 'rb') as f:
+                    entry = pickle.load(f)
+                fn = entry['fn']
+                cached_shared = [i.variable for i in fn.maker.inputs
+                                 if isinstance(i.variable, SharedVariable)]
+                swap = dict((sv, shared[pos]) for sv, pos in
+                            zip(cached_shared, entry['shared_positions']))
+                fn = fn.copy(swap=swap)
+                # neither pickling nor copy keep track of how the outputs
+                # were given, so single outputs wouldn't be unpacked anymore
+                unpack_single = outputs is not None and not isinstance(
+                    outputs, (list, tuple))
+                fn.unpack_single = fn.maker.unpack_single = unpack_single
+                time_saved = entry['compile_time'] - (time.time()-start_time)
+                cache_stats['hits'] += 1
+                cache_stats['time_saved'] += max(time_saved, 0)
+                msg = 'Loaded %s from function cache [%.2f s saved]'
+                print_with_stamp(msg % (fn_name, time_saved), 'FunctionCache')
+                return fn
+            except Exception as e:
+                msg = 'Failed to load %s from function cache (%s)'
+                print_with_stamp(msg % (fn_name, e), 'FunctionCache')
+
+        # compile and store the function
+        start_time = time.time()
+        fn = theano.function(inputs, outputs, **fn_kwargs)
+        compile_time = time.time() - start_time
+        cache_stats['misses'] += 1
+
+        fn_shared = [i.variable for i in fn.maker.inputs
+                     if isinstance(i.variable, SharedVariable)]
+        if any(sv not in shared for sv in fn_shared):
+            # the graph was modified during compilation in a way that we
+            # can't track; don't cache this function
+            return fn
+        entry = {'fn': fn, 'compile_time': compile_time,
+                 'shared_positions': [shared.index(sv) for sv in fn_shared]}
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+            msg = 'Compiled %s in %.2f s and stored it in function cache'
+            print_with_stamp(msg % (fn_name, compile_time), 'FunctionCache')
+        except Exception as e:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            msg = 'Failed to store %s in function cache (%s)'
+            print_with_stamp(msg % (fn_name, e), 'FunctionCache')
+        return fn
+    finally:
+        sys.setrecursionlimit(limit)
@@ -0,0 +1,77 @@
+'''
+Lazy loading of package attributes. Packages call lazy_module at the end of
+their __init__.py, which replaces the package in sys.modules with a
+LazyModule, so that importing the package doesn't import its submodules (and
+their dependencies on theano, lasagne, matplotlib or gym) until they are
+used. e.g.
+    lazy_module(__name__, submodules=['plant'], attributes={'Plant': 'plant'})
+This doesn't rely on module level __getattr__ (PEP 562), so it also works
+with python 2.7.
+'''
+import importlib
+import sys
+import types
+
+# the replaced modules; python 2 clears the globals of a module when it is
+# garbage collected, and the functions defined in __init__.py still use them
+_replaced_modules = {}
+
+
+class LazyModule(types.ModuleType):
+    ''' Module that imports its submodules, and the attributes defined in
+    them, when they are first accessed. Names in submodules are imported as
+    submodules of the package, names in attributes are loaded from the
+    submodule they map to, and any other public name is looked up in the
+    fallback submodule, if given. Loaded values are stored in the module, so
+    the lookup only happens once.'''
+    def __init__(self, name, submodules=[], attributes={}, fallback=None):
+        super(LazyModule, self).__init__(name)
+        self._lazy_submodules = list(submodules)
+        self._lazy_attributes = dict(attributes)
+        self._lazy_fallback = fallback
+
+    def __getattr__(self, name):
+        # only called when the attribute is not in the module yet
+        if name.startswith('_lazy_'):
+            raise AttributeError(name)
+        package = self.__name__
+        if name in self._lazy_submodules:
+            value = importlib.import_module('.' + name, package)
+        elif name in self._lazy_attributes or (
+                self._lazy_fallback is not None and
+                not name.startswith('_')):
+            module = importlib.import_module(
+                '.' + self._lazy_attributes.get(name, self._lazy_fallback),
+                package)
+            if not hasattr(module, name):
+                raise AttributeError(
+                    "module '%s' has no attribute '%s'" % (package, name))
+            value = getattr(module, name)
+        else:
+            raise AttributeError(
+                "module '%s' has no attribute '%s'" % (package, name))
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        names = set(n for n in vars(self) if not n.startswith('_lazy_'))
+        names.update(self._lazy_submodules)
+        names.update(self._lazy_attributes)
+        loaded = sys.modules.get('%s.%s' % (self.__name__,
+                                            self._lazy_fallback))
+        if loaded is not None:
+            names.update(n for n in dir(loaded) if not n.startswith('_'))
+        return sorted(names)
+
+
+def lazy_module(package, submodules=[], attributes={}, fallback=None):
+    ''' Replaces the package with the given name in sys.modules with a
+    LazyModule that has the same contents, and returns it. Must be called at
+    the end of the __init__.py of the package, since names defined after the
+    call would not be visible in the new module'''
+    module = sys.modules[package]
+    lazy = LazyModule(package, submodules, attributes, fallback)
+    lazy.__dict__.update(vars(module))
+    _replaced_modules[package] = module
+    sys.modules[package] = lazy
+    return lazy
@@ -0,0 +1,157 @@
+'''
+Buffered log file writer used by print_with_stamp. Messages are appended to an
+in-memory buffer and written by a background thread, so logging doesn't block
+on file I/O. Consecutive same_line messages are collapsed, keeping only the
+latest one in the file.
+'''
+import atexit
+import os
+import threading
+
+
+class LogWriter(object):
+    ''' Writes log records to files from a background thread. Records are
+    (path, message, same_line) tuples. Files are opened once, and their
+    permissions set to 666 when they are created. self.cond only protects the
+    buffer; the files are written while holding self.io_lock, so that
+    buffering new records never waits for file I/O.'''
+    def __init__(self, flush_interval=0.5):
+        self.flush_interval = flush_interval
+        self.init_state()
+
+    def init_state(self):
+        self.cond = threading.Condition()
+        self.io_lock = threading.Lock()
+        self.records = []
+        self.pending = 0
+        self.files = {}
+        # offsets where the last same_line record of each file starts and
+        # ends
+        self.same_line_pos = {}
+        self.thread = None
+        self.idle = False
+        self.flushing = False
+        self.closed = False
+
+    def write(self, path, message, same_line=False):
+        write_now = False
+        with self.cond:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.writer_loop,
+                                               name='LogWriter')
+                self.thread.daemon = True
+                self.thread.start()
+            if self.records and same_line:
+                # collapse consecutive progress records
+                last_path, last_message, last_same_line = self.records[-1]
+                if last_same_line and last_path == path:
+                    self.records.pop()
+                    self.pending -= 1
+            self.records.append((path, message, same_line))
+            self.pending += 1
+            if self.closed:
+                write_now = True
+            elif self.idle:
+                self.cond.notify_all()
+        if write_now:
+            self.write_records()
+
+    def flush(self, timeout=None):
+        ''' Blocks until all buffered records have been written'''
+        if self.thread is None or not self.thread.is_alive():
+            self.write_records()
+            return
+        with self.cond:
+            self.flushing = True
+            self.cond.notify_all()
+            while self.pending > 0:
+                if not self.cond.wait(timeout):
+                    break
+            self.flushing = False
+
+    def close(self):
+        self.flush()
+        with self.io_lock:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+            for f in self.files.values():
+                f.close()
+            self.files = {}
+            self.same_line_pos = {}
+
+    def get_file(self, path):
+        f = self.files.get(path)
+        if f is None:
+            exists = os.path.isfile(path)
+            f = open(path, 'ab')
+            if not exists:
+                try:
+                    os.chmod(path, 0o666)
+                except OSError:
+                    pass
+            self.files[path] = f
+        return f
+
+    def write_records(self):
+        ''' Writes the buffered records. Must be called without holding
+        self.cond: the buffer is swapped out under self.cond, and the records
+        are written outside of it'''
+        with self.io_lock:
+            with self.cond:
+                records, self.records = self.records, []
+            touched = set()
+            for path, message, same_line in records:
+                try:
+                    f = self.get_file(path)
+                    pos = self.same_line_pos.pop(path, None)
+                    data = (message+os.linesep).encode('utf-8')
+                    if same_line:
+                        f.flush()
+                        if pos is not None and\
+                           os.fstat(f.fileno()).st_size == pos[1]:
+                            # overwrite the previous progress record, unless
+                            # other processes have appended to the file since
+                            f.truncate(pos[0])
+                            f.seek(pos[0])
+                        data = b'\r' + data
+                    f.write(data)
+                    if same_line:
+                        f.flush()
+                        end = f.tell()
+                        self.same_line_pos[path] = (end - len(data), end)
+                    touched.add(path)
+                except (IOError, OSError):
+                    pass
+            for path in touched:
+                self.files[path].flush()
+        with self.cond:
+            self.pending -= len(records)
+            self.cond.notify_all()
+
+    def writer_loop(self):
+        while True:
+            with self.cond:
+                while not self.closed and not self.records:
+                    self.idle = True
+                    self.cond.wait()
+                    self.idle = False
+                if self.closed:
+                    return
+                if not self.flushing:
+                    # give other messages a chance to accumulate
+                    self.cond.wait(self.flush_interval)
+            self.write_records()
+
+
+log_writer = LogWriter()
+atexit.register(log_writer.close)
+if hasattr(os, 'register_at_fork'):
+    # the writer thread doesn't survive a fork; the child starts afresh
+    os.register_at_fork(after_in_child=log_writer.init_state)
+
+
+def flush_log(timeout=None):
+    ''' Waits until all the messages passed to print_with_stamp have been
+    written to the log file'''
+    log_writer.flush(timeout)
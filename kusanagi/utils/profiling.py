@@ -0,0 +1,122 @@
+'''
+Structured timing instrumentation. Code regions are wrapped in timing spans,
+which are written as JSONL (or CSV, if the file name ends in .csv) records to
+the file returned by get_timings_file. Each record contains the span name,
+start time, duration, nesting depth, the enclosing span and any counters set
+by the instrumented code, plus the fields set with set_timing_context (e.g.
+the learning iteration). kusanagi/diagnosis_tools/summarize_timings.py
+summarizes these files.
+'''
+import json
+import os
+import threading
+import time
+
+from .logger import log_writer
+
+CSV_FIELDS = ['name', 'iteration', 'start', 'duration', 'depth', 'parent',
+              'pid', 'counters']
+# fields set by every span
+SPAN_FIELDS = set(['name', 'start', 'duration', 'depth', 'parent', 'pid',
+                   'error'])
+
+# aggregated timings for the current process
+timing_stats = {}
+_context = {}
+_local = threading.local()
+_csv_headers = set()
+
+
+def get_timings_file():
+    ''' Returns the file where timing spans are recorded. This can be set via
+    the $KUSANAGI_TIMINGS environment variable. If not set, it will return an
+    empty string and spans will only be aggregated in memory.'''
+    return os.environ.get('KUSANAGI_TIMINGS', '')
+
+
+def set_timings_file(new_path):
+    ''' Sets the file where timing spans are recorded'''
+    os.environ['KUSANAGI_TIMINGS'] = new_path
+
+
+def set_timing_context(**kwargs):
+    ''' Sets fields that will be added to all subsequent timing records, e.g.
+    set_timing_context(iteration=3). Setting a field to None removes it'''
+    for k, v in kwargs.items():
+        if v is None:
+            _context.pop(k, None)
+        else:
+            _context[k] = v
+
+
+def get_timing_stats():
+    ''' Returns the number of calls and total time (in seconds) per span name
+    in the current process'''
+    return dict((k, dict(v)) for k, v in timing_stats.items())
+
+
+def _span_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def record_span(record):
+    ''' Writes a timing record to the timings file, if set'''
+    path = get_timings_file()
+    if not path:
+        return
+    if path.endswith('.csv'):
+        if path not in _csv_headers:
+            _csv_headers.add(path)
+            if not os.path.isfile(path) or os.path.getsize(path) == 0:
+                log_writer.write(path, ','.join(CSV_FIELDS))
+        counters = ';'.join('%s=%s' % (k, v) for k, v in record.items()
+                            if k not in CSV_FIELDS)
+        row = [record.get(k, '') for k in CSV_FIELDS[:-1]] + [counters]
+        line = ','.join('' if v is None else str(v) for v in row)
+    else:
+        line = json.dumps(record, default=str)
+    log_writer.write(path, line)
+
+
+class timing_span(object):
+    ''' Context manager that records the duration of the wrapped code. The
+    counters dictionary is returned when entering the context, so that the
+    instrumented code can add to it:
+        with timing_span('dynamics_fit', dataset_size=N) as counters:
+            ...
+            counters['n_evals'] = n_evals
+    '''
+    def __init__(self, *args, **counters):
+        # the span name is taken positionally, so counters can have any name
+        self.name, = args
+        self.counters = counters
+
+    def __enter__(self):
+        stack = _span_stack()
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = time.time()
+        return self.counters
+
+    def __exit__(self, exc_type, exc_value, tb):
+        duration = time.time() - self.start
+        stack = _span_stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        stats = timing_stats.setdefault(self.name, {'count': 0, 'total': 0.0})
+        stats['count'] += 1
+        stats['total'] += duration
+
+        record = dict(_context)
+        record.update(name=self.name, start=self.start, duration=duration,
+                      depth=self.depth, parent=self.parent, pid=os.getpid())
+        for k, v in self.counters.items():
+            # counters don't overwrite the fields of the span
+            record['counter_%s' % (k) if k in SPAN_FIELDS else k] = v
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record_span(record)
+        return False
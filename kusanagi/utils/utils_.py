@@ -1,27 +1,16 @@
 # pylint: disable=C0103
 import csv
-import itertools
 import lasagne
-import math
 import numpy as np
 import os
 import random
 import theano
-import time
-import sys
-import zipfile
-
-# These lines are necessary for plot_and_save to work on server side without
-# a GUI.
-# import matplotlib as mpl
-# Needs to be set before plt is imported.
-# mpl.use('Agg')
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib import pyplot as plt
+
 from functools import reduce
-from datetime import datetime
 from enum import IntEnum
 
+from .np_utils import *
+
 from theano import tensor as tt, ifelse
 from theano.gof import Variable
 
@@ -69,6 +58,50 @@ def maha(X1, X2=None, M=None, all_pairs=True):
     return D
 
 
+def batched_cholesky(A, D):
+    ''' Lower triangular cholesky factors of a stack of [D x D] symmetric
+    positive definite matrices (n x D x D). The loop over the columns is
+    unrolled, so D must be known when building the graph. Meant for the small
+    matrices used in moment matching.'''
+    cols = []
+    for j in range(D):
+        v = A[:, :, j]
+        if j > 0:
+            Lj = tt.stack(cols, axis=2)
+            v = v - (Lj*Lj[:, j, :].dimshuffle(0, 'x', 1)).sum(2)
+        d = tt.sqrt(v[:, j])
+        mask = (np.arange(D) >= j).astype(theano.config.floatX)
+        cols.append(mask*v/d[:, None])
+    return tt.stack(cols, axis=2)
+
+
+def batched_cho_solve(L, B, D):
+    ''' Solves A X = B for a stack of matrices A = L L^T, given the batched
+    cholesky factors L (n x D x D) and right hand sides B (n x D x K)'''
+    # forward substitution L Y = B
+    Y = []
+    for i in range(D):
+        b = B[:, i, :]
+        if i > 0:
+            b = b - (L[:, i, :i, None]*tt.stack(Y, axis=1)).sum(1)
+        Y.append(b/L[:, i, i, None])
+    # back substitution L^T X = Y
+    X = [None]*D
+    for i in reversed(range(D)):
+        x = Y[i]
+        if i < D-1:
+            x = x - (L[:, i+1:, i, None]*tt.stack(X[i+1:], axis=1)).sum(1)
+        X[i] = x/L[:, i, i, None]
+    return tt.stack(X, axis=1)
+
+
+def batched_logdet(L, D):
+    ''' Log determinant of a stack of matrices A = L L^T, given the batched
+    cholesky factors L (n x D x D)'''
+    idx = np.arange(D)
+    return 2*tt.log(L[:, idx, idx]).sum(1)
+
+
 def fast_jacobian(expr, wrt, chunk_size=16, func=None):
     '''
     Computes the jacobian by tiling the inputs
@@ -110,46 +143,6 @@ def fast_jacobian(expr, wrt, chunk_size=16, func=None):
     return jac
 
 
-def print_with_stamp(message, name=None, same_line=False, use_log=True):
-    '''
-    Helper function to print with a current time stamp.
-    '''
-    out_str = ''
-    if name is None:
-        out_str = '[%s] %s' % (str(datetime.now()), message)
-    else:
-        out_str = '[%s] %s > %s' % (str(datetime.now()), name, message)
-
-    logfile = get_logfile()
-    # this will only log to a file if 1) use_log is True and
-    # 2) $KUSANAGI_LOGFILE is set ( can be set with
-    # utils.set_logfile(new_path) )
-    if not use_log or not logfile:
-        if same_line:
-            sys.stdout.write('\r'+'\x1b[2K'+out_str)
-        else:
-            sys.stdout.write(out_str)
-            print('')
-        sys.stdout.flush()
-    else:
-        write_mode = 'a+'
-        with open(logfile, write_mode) as f:
-            if same_line:
-                f.seek(0, os.SEEK_END)
-                pos = f.tell() - 1
-                c = f.read(1)
-                while pos > 0 and c != '\r' and c != os.linesep:
-                    pos = pos - 1
-                    f.seek(pos, os.SEEK_SET)
-                    c = f.read(1)
-                if pos > 0 and c == '\r':
-                    f.seek(pos, os.SEEK_SET)
-                    f.truncate()
-                f.write('\r')
-            f.write(out_str+os.linesep)
-        os.system('chmod 666 %s' % (logfile))
-
-
 def kmeanspp(X, k):
     '''
     Initializer for kmeans
@@ -279,95 +272,6 @@ def gTrig2(m, v, angi, D=None):
     return [M, V, Ca]
 
 
-def gTrig_np(x, angi):
-    '''
-        Replaces angle dimensions with their complex representation
-    '''
-    if isinstance(x, list):
-        x = np.array(x)
-    if x.ndim == 1:
-        x = x[None, :]
-    D = x.shape[1]
-    Da = 2*len(angi)
-    n = x.shape[0]
-    xang = np.zeros((n, Da))
-    xi = x[:, angi]
-    xang[:, ::2] = np.sin(xi)
-    xang[:, 1::2] = np.cos(xi)
-
-    na_dims = list(set(range(D)).difference(angi))
-    xnang = x[:, na_dims]
-    m = np.concatenate([xnang, xang], axis=1)
-
-    return m
-
-
-def gTrig2_np(m, v, angi, D):
-    '''
-        Replaces angle dimensions with their complex represnetations. Given an
-        input Gaussian distribution (parametrized by its mean and covariance),
-        it computes the Gaussian distribution of the complex angle
-        representation.
-    '''
-    na_dims = list(set(range(D)).difference(angi))
-    Da = 2*len(angi)
-    Dna = len(na_dims)
-    n = m.shape[0]
-    Ma = np.zeros((n, Da))
-    Va = np.zeros((n, Da, Da))
-    Ca = np.zeros((n, D, Da))
-    Is = 2*np.arange(len(angi))
-    Ic = Is + 1
-
-    # compute the mean
-    mi = m[:, angi]
-    vi = (v[:, angi, :][:, :, angi])
-    vii = (v[:, angi, angi])
-    exp_vii_h = np.exp(-vii/2)
-
-    Ma[:, ::2] = exp_vii_h*np.sin(mi)
-    Ma[:, 1::2] = exp_vii_h*np.cos(mi)
-
-    # compute the entries in the augmented covariance matrix
-    lq = -0.5*(vii[:, :, None] + vii[:, None, :])
-    q = np.exp(lq)
-    exp_lq_p_vi = np.exp(lq+vi)
-    exp_lq_m_vi = np.exp(lq-vi)
-    U1 = (exp_lq_p_vi - q)*(np.sin(mi[:, :, None]-mi[:, None, :]))
-    U2 = (exp_lq_m_vi - q)*(np.sin(mi[:, :, None]+mi[:, None, :]))
-    U3 = (exp_lq_p_vi - q)*(np.cos(mi[:, :, None]-mi[:, None, :]))
-    U4 = (exp_lq_m_vi - q)*(np.cos(mi[:, :, None]+mi[:, None, :]))
-
-    Va[:, ::2, ::2] = U3-U4
-    Va[:, 1::2, 1::2] = U3+U4
-    Va[:, ::2, 1::2] = U1+U2
-    Va[:, 1::2, ::2] = Va[:, ::2, 1::2].transpose(0, 2, 1)
-    Va = 0.5*Va
-
-    # inv times input output covariance
-    Ca[:, angi, Is] = Ma[:, 1::2]
-    Ca[:, angi, Ic] = -Ma[:, ::2]
-
-    # construct mean vectors ( non angle dimensions come first,
-    # then angle dimensions)
-    Mna = m[:, na_dims]
-    M = np.concatenate([Mna, Ma], axis=1)
-
-    # construct the corresponding covariance matrices
-    # (ust the blocks for the non angle dimensions and the angle dimensions
-    # separately
-    V = np.zeros((n, Dna+Da, Dna+Da))
-    Vna = v[:, na_dims, :][:, :, na_dims]
-    V[:, :Dna, :Dna] = Vna
-    V[:, Dna:, Dna:] = Va
-
-    # fill in the cross covariances
-    V[:, :Dna, Dna:] = (v[:, :, :, None]*Ca[:, :, None, :]).sum(1)[:, na_dims, :]
-    V[:, Dna:, :Dna] = V[:, :Dna, Dna:].transpose(0, 2, 1)
-
-    return [M, V]
-
-
 def get_compiled_gTrig(angi, D, derivs=True):
     m = tt.dvector('x')      # n_samples x idims
     v = tt.dmatrix('x_cov')  # n_samples x idims x idims
@@ -476,6 +380,7 @@ def plot_results(learner, H=None, plot_samples=True):
     one for cost vs timestep for last episode, and plots for each state
     dimension vs time step for the last episode.
     '''
+    from matplotlib import pyplot as plt
     dt = learner.plant.dt
     x0 = learner.plant.state0_dist.mean
     S0 = learner.plant.state0_dist.cov
@@ -559,6 +464,10 @@ def plot_results(learner, H=None, plot_samples=True):
 
 def plot_and_save(learner, filename, H=None,
                   target=None, output_folder=None):
+    # to use this on the server side without a GUI, call matplotlib.use('Agg')
+    # before calling this function
+    from matplotlib.backends.backend_pdf import PdfPages
+    from matplotlib import pyplot as plt
     output_file = None
     output_folder = get_output_dir() if output_folder is None else output_folder
     output_file = os.path.abspath(os.path.join(output_folder, filename))
@@ -652,6 +561,7 @@ def plot_learning_results(plant, H=None):
     one for cost vs timestep for last episode, and plots for each state dimension vs
     time step for the last episode.
     '''
+    from matplotlib import pyplot as plt
     dt = learner.plant.dt
     x0 = np.array(learner.plant.x0)
     S0 = np.array(learner.plant.S0)
@@ -717,139 +627,6 @@ def plot_learning_results(plant, H=None):
     plt.waitforbuttonpress(0.05)
 
 
-def get_logfile():
-    ''' Returns the path of the file where the output of print_with_stamp wil be redirected. This can be set 
-    via the $KUSANAGI_LOGFILE environment variable. If not set, it will return an empty string.'''
-
-    if 'KUSANAGI_LOGFILE' in os.environ:
-        return os.environ['KUSANAGI_LOGFILE']
-    else:
-        return ''
-
-
-def get_run_output_dir():
-    ''' Returns the current output folder for the last run results. This can be set via the $KUSANAGI_RUN_OUTPUT environment 
-    variable. If not set, it will default to $HOME/.kusanagi/output/last_run. The directory will be created 
-    by this method, if it does not exist.'''
-    if not 'KUSANAGI_RUN_OUTPUT' in os.environ:
-        os.environ['KUSANAGI_RUN_OUTPUT'] = os.path.join(get_output_dir(),"last_run")
-    try: 
-        os.makedirs(os.environ['KUSANAGI_RUN_OUTPUT'])
-        chmod_cmd = 'chmod a+rwx -R ' + os.path.abspath(os.environ['KUSANAGI_RUN_OUTPUT'])
-        os.system(chmod_cmd)
-    except OSError:
-        if not os.path.isdir(os.environ['KUSANAGI_RUN_OUTPUT']):
-            raise
-    return os.environ['KUSANAGI_RUN_OUTPUT']
-
-
-def get_output_dir():
-    ''' Returns the current output folder. This can be set via the $KUSANAGI_OUTPUT environment 
-    variable. If not set, it will default to $HOME/.kusanagi/output. The directory will be created 
-    by this method, if it does not exist.'''
-    if not 'KUSANAGI_OUTPUT' in os.environ:
-        homefolder = os.environ['HOME'] if 'HOME' in os.environ else os.environ['USERPROFILE']
-        os.environ['KUSANAGI_OUTPUT'] = os.path.join(os.path.join(homefolder, ".kusanagi"), "output")
-    try: 
-        os.makedirs(os.environ['KUSANAGI_OUTPUT'])
-        chmod_cmd = 'chmod a+rwx -R ' + os.path.abspath(os.environ['KUSANAGI_OUTPUT'])
-        os.system(chmod_cmd)
-    except OSError:
-        if not os.path.isdir(os.environ['KUSANAGI_OUTPUT']):
-            raise
-    return os.environ['KUSANAGI_OUTPUT']
-
-
-def set_logfile(new_path, base_path=None):
-    ''' Sets the path of the log file. Assumes that new_path is well formed'''
-    if base_path is None:
-        os.environ['KUSANAGI_LOGFILE'] = new_path
-    else:
-        os.environ['KUSANAGI_LOGFILE'] = os.path.join(base_path,new_path)
-
-
-def set_run_output_dir(new_path):
-    ''' Sets the output directory for the files related to the current run. Assumes that new_path is well formed'''
-    os.environ['KUSANAGI_RUN_OUTPUT'] = new_path
-
-
-def set_output_dir(new_path):
-    ''' Sets the output directory temporary files. Assumes that new_path is well formed'''
-    os.environ['KUSANAGI_OUTPUT'] = new_path
-
-
-def sync_output_filename(output_filename, obj_filename, suffix):
-  if output_filename is None:
-    output_filename = obj_filename+suffix
-  else:
-    obj_filename = output_filename
-    # try removing suffix
-    suffix_idx = obj_filename.find(suffix)
-    if suffix_idx >= 0:
-      obj_filename = obj_filename[:suffix_idx]
-  return output_filename, obj_filename
-
-
-def unzip_snapshot(zip_filepath, extract_path = ''):
-  if not zip_filepath.lower().endswith('.zip'):
-    zip_filepath += '.zip'
-  with zipfile.ZipFile(zip_filepath, 'r') as myzip:
-    myzip.extractall(extract_path)
-    print_with_stamp('Extracted %s to %s'%(zip_filepath, os.path.abspath(extract_path)), 'Utils')
-
-# creates zip of files: <snapshot_header>_<YYMMDD_HHMMSS.mmm>.zip
-# if filename clash, will append _#
-#
-# Sample usage:
-#   save_snapshot_zip('test', ['PILCO_GP_UI_Cartpole_RBFGP_sat.zip',
-# 'PILCO_GP_UI_Cartpole_RBFGP_sat_dataset.zip', 'RBFGP_sat_5_1_cpu_float64.zip'])
-def save_snapshot_zip(snapshot_header='snapshot', archived_files=[], with_timestamp=False):
-  # Construct filename
-  snapshot_filename = snapshot_header
-  if with_timestamp:
-    now = time.time()
-    ms = now - math.floor(now)
-    ms = math.floor(ms*1000)
-    time_str = time.strftime('%y%m%d_%H%M%S')
-    snapshot_filename='%s_%s.%03d' % (snapshot_header, time_str, int(ms))
-
-  # Crash if snapshot file already exists
-  repeat_counter = None
-  if os.path.isfile(snapshot_filename+'.zip'):
-    raise IOError('snapshot file %s already exists' % (snapshot_filename+'.zip'))
-
-  # Save files
-  with zipfile.ZipFile(snapshot_filename+'.zip', 'w') as myzip:
-    for archived_filepath in archived_files:
-      if os.path.isfile(archived_filepath):
-        arcname = archived_filepath
-        sep_idx = arcname.rfind(os.sep)
-        if sep_idx >= 0:
-          arcname = arcname[sep_idx+1:]
-        myzip.write(archived_filepath, arcname)
-      else:
-        print_with_stamp('Snapshot cannot find %s'%(archived_filepath), 'Utils')
-    myzip.close()
-    print_with_stamp('Saved snapshot to %s.zip'%(snapshot_filename), 'Utils')
-
-
-def increment_filename(path):
-    fn, extension = os.path.splitext(path)
-    n = 1
-    yield fn + extension
-    for n in itertools.count(start=1, step=1):
-        yield '%s%d%s' % (fn, n, extension)
-
-
-def check_empty(path):
-    return [f for f in os.listdir(path) if f not in ['.', '..']] == []
-
-
-def unique_path(path):
-    for unique_path in increment_filename(path):
-        if not os.path.isdir(unique_path) or check_empty(unique_path):
-            return unique_path
-
 class ImitationLossType(IntEnum):
     NONE = 0
     KLQP = 1
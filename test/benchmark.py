@@ -0,0 +1,410 @@
+'''
+Benchmarks for the regression, rollout and optimizer hot paths. Timings are
+saved as JSON and compared against a stored baseline; the script exits with a
+non-zero status if any timing is slower than the baseline by more than the
+given tolerance. e.g.
+    python test/benchmark.py --quick --save_baseline
+    python test/benchmark.py --quick
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from collections import OrderedDict
+from functools import partial
+from itertools import product
+
+import numpy as np
+
+import theano
+
+from kusanagi import utils
+from kusanagi.base import ExperienceDataset
+from kusanagi.ghost import (algorithms, control, optimizers,
+                            regression)
+from kusanagi.shell import cartpole
+
+BENCHMARKS = OrderedDict()
+
+# parameter sweeps: (full, quick)
+SWEEPS = {
+    'regression': (
+        dict(reg_class=['GP', 'SSGP_UI', 'SPGP_UI', 'BNN'],
+             N=[100, 500, 1000], D=[4, 8], E=[2, 4]),
+        dict(reg_class=['GP', 'SSGP_UI', 'SPGP_UI', 'BNN'],
+             N=[100], D=[4], E=[2])),
+    'pilco': (
+        dict(H=[10, 40]),
+        dict(H=[10])),
+    'mc_pilco': (
+        dict(H=[10, 40], n_samples=[50, 100, 200]),
+        dict(H=[10], n_samples=[50])),
+    'optimizer': (
+        dict(optimizer=['ScipyOptimizer', 'SGDOptimizer'], H=[10, 40]),
+        dict(optimizer=['ScipyOptimizer', 'SGDOptimizer'], H=[10])),
+    'dataset': (
+        dict(n_episodes=[10, 50, 200], H=[40, 100]),
+        dict(n_episodes=[10], H=[40])),
+    'imports': (
+        dict(module=['kusanagi', 'kusanagi.utils', 'kusanagi.base',
+                     'kusanagi.ghost.control.numpy_policy',
+                     'kusanagi.shell']),
+        dict(module=['kusanagi', 'kusanagi.utils', 'kusanagi.base',
+                     'kusanagi.ghost.control.numpy_policy',
+                     'kusanagi.shell'])),
+}
+
+# modules that lightweight imports of kusanagi should not pull in
+HEAVY_MODULES = ['theano', 'lasagne', 'matplotlib', 'gym', 'scipy']
+
+
+def benchmark(name):
+    ''' registers a benchmark function. The function receives the sweep
+    parameters as keyword arguments and returns a dictionary of timings'''
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+def time_call(fn, repeat=5, number=1):
+    ''' returns the best time per call, over repeat runs of number calls'''
+    best = np.inf
+    for r in range(repeat):
+        start = time.time()
+        for i in range(number):
+            fn()
+        best = min(best, (time.time() - start)/number)
+    return best
+
+
+def timed(fn):
+    start = time.time()
+    ret = fn()
+    return ret, time.time() - start
+
+
+def build_dataset(N, D, E):
+    X = 4*(np.random.rand(N, D) - 0.5)
+    W = np.random.randn(D, E)
+    Y = np.sin(X.dot(W)) + 0.01*np.random.randn(N, E)
+    return X, Y
+
+
+def cartpole_setup(seed=0):
+    ''' returns the cartpole parameters, cost function and a dynamics model
+    dataset from random rollouts'''
+    np.random.seed(seed)
+    params = cartpole.default_params()
+    cost = partial(cartpole.cartpole_loss, **params['cost'])
+    env = cartpole.Cartpole(loss_func=cost, **params['plant'])
+    pol = control.RandPolicy(maxU=params['policy']['maxU'])
+    exp = ExperienceDataset()
+    for i in range(2):
+        exp.new_episode()
+        x = env.reset()
+        for t in range(40):
+            u = pol(x)[0]
+            x_next, c, done, info = env.step(u)
+            exp.add_sample(x, u, c, info)
+            x = x_next
+    X, Y = exp.get_dynmodel_dataset(angle_dims=params['angle_dims'])
+    return params, cost, X, Y
+
+
+@benchmark('regression')
+def regression_benchmark(reg_class, N, D, E, repeat=5):
+    X, Y = build_dataset(N, D, E)
+    kwargs = dict(idims=D, odims=E, max_evals=50)
+    if reg_class in ('SSGP_UI', 'SPGP_UI'):
+        kwargs['n_inducing'] = min(50, N)
+    model = getattr(regression, reg_class)(**kwargs)
+    if reg_class == 'BNN':
+        model.network = model.build_network(regression.dropout_mlp(
+            D, 2*E if model.heteroscedastic else E, hidden_dims=[200]*2,
+            p=0.1, p_input=0.1, name=model.name))
+    model.set_dataset(X, Y)
+    _, train_time = timed(model.train)
+
+    mx = X[0]
+    Sx = 0.01*np.eye(D)
+    _, compile_time = timed(lambda: model(mx, Sx))
+    predict_ui_time = time_call(lambda: model(mx, Sx), repeat, 10)
+    _, compile_det_time = timed(lambda: model(X[:100]))
+    predict_time = time_call(lambda: model(X[:100]), repeat, 10)
+    return OrderedDict(train_time=train_time,
+                       predict_compile_time=compile_time+compile_det_time,
+                       predict_ui_time=predict_ui_time,
+                       predict_batch_time=predict_time)
+
+
+def build_pilco_loss(H):
+    params, cost, X, Y = cartpole_setup()
+    pol = control.RBFPolicy(**params['policy'])
+    dyn = regression.SSGP_UI(max_evals=50, **params['dynamics_model'])
+    dyn.set_dataset(X, Y)
+    dyn.train()
+    (loss, inps, updts), graph_time = timed(lambda: algorithms.pilco.get_loss(
+        pol, dyn, cost, params['angle_dims']))
+    p0 = params['state0_dist']
+    inputs = [p0.mean, p0.cov, H, 1.0]
+    return pol, loss, inps, updts, inputs, graph_time
+
+
+def build_mc_pilco_loss(H, n_samples):
+    params, cost, X, Y = cartpole_setup()
+    D = params['state0_dist'].mean.size
+    pol = control.NNPolicy(D, **params['policy'])
+    pol.network = pol.build_network(regression.mlp(
+        pol.D, pol.E, hidden_dims=[200]*2, output_nonlinearity=pol.sat_func,
+        name=pol.name))
+    dyn = regression.BNN(max_evals=50, **params['dynamics_model'])
+    dyn.network = dyn.build_network(regression.dropout_mlp(
+        dyn.D, 2*dyn.E if dyn.heteroscedastic else dyn.E,
+        hidden_dims=[200]*2, p=0.1, p_input=0.1, name=dyn.name))
+    dyn.set_dataset(X, Y)
+    dyn.train()
+    (loss, inps, updts), graph_time = timed(
+        lambda: algorithms.mc_pilco.get_loss(
+            pol, dyn, cost, params['angle_dims'], n_samples=n_samples))
+    p0 = params['state0_dist']
+    inputs = [p0.mean, p0.cov, H, 1.0]
+    return pol, loss, inps, updts, inputs, graph_time
+
+
+@benchmark('pilco')
+def pilco_benchmark(H, repeat=5):
+    pol, loss, inps, updts, inputs, graph_time = build_pilco_loss(H)
+    opt = optimizers.ScipyOptimizer()
+    _, compile_time = timed(lambda: opt.set_objective(
+        loss, pol.get_params(symbolic=True), inps, updts))
+    loss_time = time_call(lambda: opt.loss_fn(*inputs), repeat)
+    grads_time = time_call(lambda: opt.grads_fn(*inputs), repeat)
+    return OrderedDict(graph_time=graph_time, compile_time=compile_time,
+                       loss_time=loss_time, grads_time=grads_time)
+
+
+@benchmark('mc_pilco')
+def mc_pilco_benchmark(H, n_samples, repeat=5):
+    pol, loss, inps, updts, inputs, graph_time = build_mc_pilco_loss(
+        H, n_samples)
+    opt = optimizers.SGDOptimizer(learning_rate=1e-3)
+    _, compile_time = timed(lambda: opt.set_objective(
+        loss, pol.get_params(symbolic=True), inps, updts,
+        learning_rate=1e-3))
+    for s, i in zip(opt.shared_inpts, inputs):
+        s.set_value(np.array(i).astype(s.dtype))
+    loss_time = time_call(opt.loss_fn, repeat)
+    update_time = time_call(opt.update_params_fn, repeat)
+    return OrderedDict(graph_time=graph_time, compile_time=compile_time,
+                       loss_time=loss_time, update_time=update_time)
+
+
+@benchmark('optimizer')
+def optimizer_benchmark(optimizer, H, max_evals=20):
+    if optimizer == 'ScipyOptimizer':
+        pol, loss, inps, updts, inputs, _ = build_pilco_loss(H)
+        opt = optimizers.ScipyOptimizer(max_evals=max_evals)
+        opt.set_objective(loss, pol.get_params(symbolic=True), inps, updts)
+        results, opt_time = timed(lambda: opt.minimize(*inputs))
+        n_evals = sum(r['n_evals'] for r in results)
+    else:
+        pol, loss, inps, updts, inputs, _ = build_mc_pilco_loss(H, 100)
+        opt = optimizers.SGDOptimizer(max_evals=max_evals)
+        opt.set_objective(loss, pol.get_params(symbolic=True), inps, updts,
+                          learning_rate=1e-3)
+        _, opt_time = timed(lambda: opt.minimize(*inputs))
+        n_evals = opt.n_evals
+    return OrderedDict(iteration_time=opt_time/max(n_evals, 1),
+                       n_evals=n_evals)
+
+
+@benchmark('dataset')
+def dataset_benchmark(n_episodes, H, D=4, U=1, repeat=5):
+    exp = ExperienceDataset()
+    episodes = [(np.random.randn(H, D), np.random.randn(H, U),
+                 np.random.randn(H)) for i in range(n_episodes)]
+
+    def append_all():
+        for states, actions, costs in episodes:
+            exp.append_episode(states, actions, costs)
+    _, append_time = timed(append_all)
+
+    def cold():
+        exp.clear_dynmodel_cache()
+        exp.get_dynmodel_dataset(angle_dims=[3])
+    cold_time = time_call(cold, repeat)
+    warm_time = time_call(lambda: exp.get_dynmodel_dataset(angle_dims=[3]),
+                          repeat)
+
+    def incremental():
+        exp.append_episode(*episodes[0])
+        exp.get_dynmodel_dataset(angle_dims=[3])
+    incremental_time = time_call(incremental, repeat)
+    return OrderedDict(append_time=append_time, cold_time=cold_time,
+                       warm_time=warm_time, incremental_time=incremental_time)
+
+
+@benchmark('imports')
+def imports_benchmark(module, repeat=5):
+    script = ('import sys, time\n'
+              't = time.time()\n'
+              'import %s\n'
+              'print(time.time() - t)\n'
+              'print(len([m for m in %r if m in sys.modules]))') % (
+                  module, HEAVY_MODULES)
+    import_time = np.inf
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', script])
+        t, heavy_imports = out.decode().split()
+        import_time = min(import_time, float(t))
+    return OrderedDict(import_time=import_time,
+                       heavy_imports=int(heavy_imports))
+
+
+def machine_info():
+    return OrderedDict(
+        platform=platform.platform(), processor=platform.processor(),
+        cpu_count=os.cpu_count(), python=platform.python_version(),
+        numpy=np.__version__, theano=theano.__version__,
+        floatX=theano.config.floatX, device=theano.config.device,
+        blas=theano.config.blas.ldflags)
+
+
+def run_benchmarks(names, quick=False, seed=0):
+    results = OrderedDict()
+    for name in names:
+        sweep = SWEEPS[name][1 if quick else 0]
+        keys = sorted(sweep.keys())
+        for values in product(*[sweep[k] for k in keys]):
+            kwargs = OrderedDict(zip(keys, values))
+            key = '%s[%s]' % (name, ','.join('%s=%s' % kv
+                                             for kv in kwargs.items()))
+            utils.print_with_stamp('Running %s' % (key), 'benchmark')
+            np.random.seed(seed)
+            try:
+                metrics = BENCHMARKS[name](**kwargs)
+            except Exception as e:
+                utils.print_with_stamp('%s failed: %s' % (key, e),
+                                       'benchmark')
+                # failures are recorded, so they are reported as regressions
+                results[key] = OrderedDict(
+                    error='%s: %s' % (type(e).__name__, e))
+                continue
+            results[key] = metrics
+            utils.print_with_stamp('%s: %s' % (key, dict(metrics)),
+                                   'benchmark')
+    return results
+
+
+def compare(results, baseline, tolerance, names=()):
+    ''' returns the list of (key, metric, baseline, new) timings that are
+    slower than the baseline by more than the tolerance, and imports that pull
+    in more heavy dependencies than in the baseline. Failed benchmarks, and
+    baseline entries of the benchmarks in names that are missing from the
+    results, are also returned as regressions (with metric 'error' or
+    'missing')'''
+    regressions = []
+    print('%60s %20s %12s %12s %8s' % ('benchmark', 'metric', 'baseline',
+                                       'current', 'ratio'))
+    for key in baseline:
+        if key.split('[')[0] in names and key not in results:
+            print('%60s %20s' % (key, 'missing'))
+            regressions.append((key, 'missing', None, None))
+    for key, metrics in results.items():
+        base_metrics = baseline.get(key, {})
+        if 'error' in metrics:
+            print('%60s %20s %s' % (key, 'error', metrics['error']))
+            if 'error' not in base_metrics:
+                regressions.append((key, 'error', None, metrics['error']))
+            continue
+        for metric, value in metrics.items():
+            base = base_metrics.get(metric)
+            if metric == 'heavy_imports' and base is not None:
+                # importing more heavy dependencies is always a regression
+                ratio = (value + 1.0)/(base + 1.0)
+                flag = ' <' if value > base else ''
+            elif metric.endswith('_time') and base:
+                ratio = value/base
+                flag = ' <' if ratio > 1 + tolerance else ''
+            else:
+                continue
+            print('%60s %20s %12.6f %12.6f %8.2f%s' % (
+                key, metric, base, value, ratio, flag))
+            if flag:
+                regressions.append((key, metric, base, value))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b', '--benchmarks', nargs='+', default=list(BENCHMARKS.keys()),
+        choices=list(BENCHMARKS.keys()), help='benchmarks to run')
+    parser.add_argument(
+        '--quick', action='store_true', help='run a reduced sweep')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='random seed. Default: 0')
+    parser.add_argument(
+        '--output', type=str, default=None,
+        help='where to save the results. Default: '
+             '$KUSANAGI_OUTPUT/benchmarks/benchmark_<timestamp>.json')
+    parser.add_argument(
+        '--baseline', type=str,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json'),
+        help='baseline results to compare against')
+    parser.add_argument(
+        '--save_baseline', action='store_true',
+        help='store the results as the new baseline')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='maximum allowed slowdown relative to the baseline. '
+             'Default: 0.2')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.benchmarks, args.quick, args.seed)
+    report = OrderedDict(machine=machine_info(), quick=args.quick,
+                         timestamp=time.time(), results=results)
+
+    output = args.output
+    if output is None:
+        output_dir = os.path.join(utils.get_output_dir(), 'benchmarks')
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        output = os.path.join(
+            output_dir, 'benchmark_%s.json' % (time.strftime('%Y%m%d%H%M%S')))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    utils.print_with_stamp('Saved results to [%s]' % (output), 'benchmark')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        utils.print_with_stamp(
+            'Saved baseline to [%s]' % (args.baseline), 'benchmark')
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['machine'] != report['machine']:
+            utils.print_with_stamp(
+                'Baseline was recorded on a different configuration: %s' % (
+                    baseline['machine']), 'benchmark')
+        # baseline entries can only be missing if it was recorded with the
+        # same sweeps
+        names = args.benchmarks if baseline['quick'] == args.quick else ()
+        regressions = compare(
+            results, baseline['results'], args.tolerance, names)
+        if regressions:
+            utils.print_with_stamp(
+                '%d benchmarks failed, are missing or regressed by more '
+                'than %d%%' % (len(regressions), 100*args.tolerance),
+                'benchmark')
+            sys.exit(1)
+    else:
+        utils.print_with_stamp(
+            'No baseline found at [%s]' % (args.baseline), 'benchmark')
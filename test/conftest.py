@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from kusanagi.base import ExperienceDataset
+
+# scripts that need hardware or a display, run them directly instead
+collect_ignore = ['test_serial_plant.py']
+
+
+@pytest.fixture
+def build_experience():
+    ''' returns a function that builds an ExperienceDataset with random
+    episodes'''
+    def build(n_episodes=3, H=20, D=4, U=1, seed=0):
+        rng = np.random.RandomState(seed)
+        exp = ExperienceDataset()
+        for i in range(n_episodes):
+            exp.new_episode(policy_params=[rng.randn(3)])
+            for t in range(H):
+                exp.add_sample(rng.randn(D), rng.randn(U), rng.randn(),
+                               t=t*0.1)
+        return exp
+    return build
@@ -75,7 +75,7 @@ def build_GP(idims=9, odims=6, reg_class='GP', profile=theano.config.profile):
 
 def write_profile_files(gp):
     d3viz.d3viz(gp.dnlml, 'dnlml.html')
-    d3viz.d3viz(gp.predict_fn, 'predict.html')
+    d3viz.d3viz(gp.predict_fn[1], 'predict.html')
 
 
 if __name__ == '__main__':
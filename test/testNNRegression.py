@@ -52,7 +52,7 @@ def build_dataset(idims=9,odims=6,angi=[],f=test_func1,n_train=500,n_test=50, in
 
 def write_profile_files(gp):
     d3viz.d3viz(gp.dnlml, 'dnlml.html')
-    d3viz.d3viz(gp.predict_fn, 'predict.html')
+    d3viz.d3viz(gp.predict_fn[1], 'predict.html')
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
@@ -0,0 +1,152 @@
+import importlib
+import os
+import numpy as np
+
+from kusanagi.base import ExperienceDataset
+
+# the module, not the class exported by kusanagi.base
+loadable = importlib.import_module('kusanagi.base.Loadable')
+
+
+def add_episode(exp, H, D=4, U=1):
+    exp.new_episode()
+    for t in range(H):
+        exp.add_sample(np.ones(D), np.ones(U), 1.0)
+
+
+def array_files(folder):
+    return set(os.listdir(os.path.join(folder, 'arrays')))
+
+
+def test_truncate_and_append_after_load(tmp_path, build_experience):
+    exp = build_experience(n_episodes=10, H=1000, D=3)
+    exp.save(str(tmp_path), 'exp', fmt='npy')
+
+    loaded = ExperienceDataset()
+    loaded.load(str(tmp_path), 'exp')
+    loaded.truncate(1)
+    loaded.add_sample(np.ones(3), np.ones(1), 1.0)
+    assert loaded.n_episodes() == 1
+    assert loaded.n_samples() == 1001
+    np.testing.assert_array_equal(loaded.states[0][:1000], exp.states[0])
+    np.testing.assert_array_equal(loaded.states[0][-1], np.ones(3))
+
+
+def test_save_load_truncate_append(tmp_path, build_experience):
+    exp = build_experience(n_episodes=4)
+    exp.truncate(2)
+    add_episode(exp, 5)
+    exp.save(str(tmp_path), 'exp', fmt='npy')
+
+    loaded = ExperienceDataset()
+    loaded.load(str(tmp_path), 'exp')
+    assert loaded.n_episodes() == 3
+    assert [len(s) for s in loaded.states] == [20, 20, 5]
+    np.testing.assert_array_equal(loaded.states[2], np.ones((5, 4)))
+    np.testing.assert_array_equal(loaded.actions[:2], exp.actions[:2])
+
+
+def test_full_blocks_hashed_once(tmp_path, monkeypatch, build_experience):
+    exp = build_experience(n_episodes=5, H=1000, D=3)
+    exp.save(str(tmp_path), 'exp', fmt='npy')
+
+    hashed = []
+    sha1 = loadable.hashlib.sha1
+
+    def counting_sha1(*args):
+        hashed.append(args)
+        return sha1(*args)
+    monkeypatch.setattr(loadable.hashlib, 'sha1', counting_sha1)
+    exp.add_sample(np.ones(3), np.ones(1), 1.0)
+    exp.save(str(tmp_path), 'exp', fmt='npy')
+    # the partial blocks are hashed again, but not the full ones
+    headers = [args[0].decode('utf-8') for args in hashed]
+    assert any('(905, 3)' in h for h in headers)
+    assert not any('(4096,' in h for h in headers)
+
+
+def test_unreferenced_arrays_are_pruned(tmp_path, build_experience):
+    exp = build_experience(n_episodes=2)
+    exp.save(str(tmp_path), 'exp', fmt='npy')
+    other = build_experience(n_episodes=1, seed=1)
+    other.save(str(tmp_path), 'other', fmt='npy')
+    before = array_files(str(tmp_path))
+
+    # make the old files look older than the next save
+    for name in before:
+        path = os.path.join(str(tmp_path), 'arrays', name)
+        os.utime(path, (0, 0))
+    exp.add_sample(np.ones(4), np.ones(1), 1.0)
+    exp.save(str(tmp_path), 'exp', fmt='npy')
+    after = array_files(str(tmp_path))
+    assert len(after - before) > 0
+    assert len(before - after) > 0
+
+    # the arrays of the other checkpoint are kept
+    loaded = ExperienceDataset()
+    loaded.load(str(tmp_path), 'other')
+    np.testing.assert_array_equal(loaded.states[0], other.states[0])
+    loaded.load(str(tmp_path), 'exp')
+    assert loaded.n_samples() == exp.n_samples()
+
+
+def test_episodes_to_bytes_round_trip(build_experience):
+    exp = build_experience(n_episodes=3)
+    copy = ExperienceDataset()
+    assert copy.append_episodes_from_bytes(exp.episodes_to_bytes()) == 3
+    for field in ['states', 'actions', 'costs', 'time_stamps']:
+        for ep1, ep2 in zip(exp.episodes(field), copy.episodes(field)):
+            np.testing.assert_array_equal(ep1, ep2)
+    np.testing.assert_array_equal(exp.policy_parameters[2][0],
+                                  copy.policy_parameters[2][0])
+
+
+def test_episodes_upload_retry_and_gaps(build_experience):
+    exp = build_experience(n_episodes=3)
+    server = ExperienceDataset()
+    data = exp.episodes_to_bytes()
+    assert server.append_episodes_from_bytes(data) == 3
+    # retrying an upload doesn't duplicate episodes
+    assert server.append_episodes_from_bytes(data) == 0
+    assert server.n_episodes() == 3
+
+    add_episode(exp, 5)
+    add_episode(exp, 5)
+    try:
+        server.append_episodes_from_bytes(exp.episodes_to_bytes(start=4))
+        assert False, 'expected a missing episodes error'
+    except ValueError:
+        pass
+    assert server.append_episodes_from_bytes(
+        exp.episodes_to_bytes(start=2)) == 2
+    assert server.n_episodes() == 5
+    assert server.n_samples() == exp.n_samples()
+
+
+def test_episodes_upload_unfinished_episode(build_experience):
+    exp = build_experience(n_episodes=1)
+    server = ExperienceDataset()
+    server.append_episodes_from_bytes(exp.episodes_to_bytes())
+    exp.new_episode()
+    for t in range(5):
+        exp.add_sample(np.ones(4), np.ones(1), 1.0)
+    partial = exp.episodes_to_bytes(start=1)
+    assert server.append_episodes_from_bytes(partial) == 1
+    for t in range(5):
+        exp.add_sample(np.ones(4), np.ones(1), 1.0)
+    # the finished episode replaces the partially uploaded one
+    assert server.append_episodes_from_bytes(
+        exp.episodes_to_bytes(start=1)) == 1
+    assert len(server.states[1]) == 10
+    # a stale upload of the unfinished episode is ignored
+    assert server.append_episodes_from_bytes(partial) == 0
+    assert server.n_samples() == exp.n_samples()
+    # but a mismatch in a finished episode is an error
+    add_episode(exp, 5)
+    add_episode(server, 3)
+    add_episode(server, 4)
+    try:
+        server.append_episodes_from_bytes(exp.episodes_to_bytes(start=1))
+        assert False, 'expected a mismatched episode error'
+    except ValueError:
+        pass
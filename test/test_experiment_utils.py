@@ -0,0 +1,91 @@
+import pickle
+import numpy as np
+import pytest
+
+pytest.importorskip('theano')
+pytest.importorskip('lasagne')
+
+from kusanagi.base import ExperienceDataset  # noqa: E402
+from kusanagi.shell import experiment_utils  # noqa: E402
+
+
+class NoisyIntegrator(object):
+    ''' cheap env with random initial states and transitions'''
+    dt = 0.1
+
+    def reset(self):
+        self.x = np.random.randn(2)
+        return self.x
+
+    def step(self, u):
+        self.x = self.x + self.dt*u.sum() + 0.01*np.random.randn(2)
+        return self.x, float((self.x**2).sum()), False, {}
+
+
+class LinearPolicy(object):
+    D = 2
+    maxU = np.array([1.0])
+
+    def __init__(self):
+        self.W = np.zeros((2, 1))
+
+    def set_params(self, params):
+        self.W = params[0]
+
+    def __call__(self, x, t=None):
+        return np.tanh(x.dot(self.W)), None, None
+
+
+def policy_experience(n_iterations, seed=0):
+    ''' experience with the policy parameters of every iteration. The first
+    iteration uses a random policy'''
+    rng = np.random.RandomState(seed)
+    exp = ExperienceDataset()
+    exp.new_episode()
+    for i in range(1, n_iterations):
+        exp.new_episode(policy_params=[rng.randn(2, 1)])
+    return exp
+
+
+def evaluate(exp, **kwargs):
+    params = dict(min_steps=10, angle_dims=[])
+    results = experiment_utils.evaluate_policy(
+        NoisyIntegrator(), LinearPolicy(), exp, params, n_tests=3, seed=1,
+        **kwargs)
+    return np.array([[trial[2] for trial in it] for it in results])
+
+
+def test_results_dont_depend_on_the_number_of_workers():
+    exp = policy_experience(3)
+    costs = evaluate(exp, n_workers=1)
+    assert costs.shape == (3, 3, 10)
+    np.testing.assert_array_equal(costs, evaluate(exp, n_workers=2))
+    # but they depend on the seed of every trial
+    assert not np.allclose(costs[1, 0], costs[1, 1])
+
+
+def test_saved_iterations_are_skipped(tmp_path, monkeypatch):
+    path = str(tmp_path/'results.pkl')
+    costs = evaluate(policy_experience(3), n_workers=1)
+    evaluate(policy_experience(2), n_workers=1, results_path=path)
+    with open(path, 'rb') as f:
+        assert len(pickle.load(f)) == 2
+
+    evaluated = []
+    worker = experiment_utils._evaluate_worker
+
+    def counting_worker(task):
+        evaluated.append(task)
+        return worker(task)
+    monkeypatch.setattr(experiment_utils, '_evaluate_worker',
+                        counting_worker)
+    resumed = evaluate(policy_experience(3), n_workers=1, results_path=path)
+    assert sorted(set(i for i, it in evaluated)) == [2]
+    np.testing.assert_array_equal(resumed, costs)
+    with open(path, 'rb') as f:
+        assert len(pickle.load(f)) == 3
+
+    # nothing left to evaluate
+    evaluated[:] = []
+    evaluate(policy_experience(3), n_workers=1, results_path=path)
+    assert evaluated == []
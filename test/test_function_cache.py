@@ -0,0 +1,43 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('theano')
+
+import theano  # noqa: E402
+import theano.tensor as tt  # noqa: E402
+from kusanagi.utils import function_cache  # noqa: E402
+
+
+def test_cache_is_opt_in(monkeypatch, tmp_path):
+    monkeypatch.delenv('KUSANAGI_FUNCTION_CACHE', raising=False)
+    assert not function_cache.get_function_cache_dir()
+    assert 'KUSANAGI_FUNCTION_CACHE' not in os.environ
+
+    cache_dir = str(tmp_path/'function_cache')
+    monkeypatch.setenv('KUSANAGI_FUNCTION_CACHE', cache_dir)
+    assert function_cache.get_function_cache_dir() == cache_dir
+    assert os.path.isdir(cache_dir)
+
+
+def test_cached_functions_keep_their_outputs(monkeypatch, tmp_path):
+    monkeypatch.setenv('KUSANAGI_FUNCTION_CACHE', str(tmp_path))
+    w = theano.shared(np.ones(3), name='w')
+    x = tt.vector('x')
+
+    def compile_all():
+        return [function_cache.cached_function([x], (w*x).sum()),
+                function_cache.cached_function([x], [(w*x).sum()]),
+                function_cache.cached_function([x], updates=[(w, w*x)])]
+    hits = function_cache.cache_stats['hits']
+    compiled = compile_all()
+    cached = compile_all()
+    assert function_cache.cache_stats['hits'] == hits + 3
+
+    x_ = np.arange(3.0)
+    for fn, fn_cached in zip(compiled, cached):
+        ret, ret_cached = fn(x_), fn_cached(x_)
+        assert type(ret) is type(ret_cached)
+        np.testing.assert_allclose(ret, ret_cached)
+    assert cached[0](x_).shape == ()
+    assert cached[2](x_) == []
@@ -0,0 +1,36 @@
+import sys
+import pytest
+
+from kusanagi.utils.lazy import LazyModule
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    ''' a package that loads its submodule lazily'''
+    pkg = tmp_path/'lazy_pkg'
+    pkg.mkdir()
+    (pkg/'__init__.py').write_text(
+        u"from kusanagi.utils.lazy import lazy_module\n"
+        u"value = 1\n"
+        u"lazy_module(__name__, submodules=['sub'],\n"
+        u"            attributes={'f': 'sub'})\n")
+    (pkg/'sub.py').write_text(u"def f():\n    return 2\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield 'lazy_pkg'
+    for name in ['lazy_pkg', 'lazy_pkg.sub']:
+        sys.modules.pop(name, None)
+
+
+def test_submodules_are_loaded_when_accessed(package):
+    import lazy_pkg
+    assert isinstance(lazy_pkg, LazyModule)
+    assert lazy_pkg.value == 1
+    assert 'lazy_pkg.sub' not in sys.modules
+    assert 'sub' in dir(lazy_pkg) and 'f' in dir(lazy_pkg)
+    assert lazy_pkg.f() == 2
+    assert 'lazy_pkg.sub' in sys.modules
+    assert lazy_pkg.sub.f is lazy_pkg.f
+    from lazy_pkg import sub
+    assert sub is lazy_pkg.sub
+    with pytest.raises(AttributeError):
+        lazy_pkg.missing
@@ -0,0 +1,42 @@
+import json
+import numpy as np
+
+from kusanagi import utils
+from kusanagi.base import ExperienceDataset
+
+
+def assert_same_episodes(exp1, exp2):
+    assert exp1.n_episodes() == exp2.n_episodes()
+    assert exp1.n_samples() == exp2.n_samples()
+    for field in ['states', 'actions', 'costs', 'time_stamps']:
+        for ep1, ep2 in zip(exp1.episodes(field), exp2.episodes(field)):
+            np.testing.assert_array_equal(ep1, ep2)
+
+
+def test_save_and_load_checkpoint(tmp_path, build_experience):
+    exp = build_experience()
+    exp.save(str(tmp_path), 'exp', fmt='npy')
+
+    loaded = ExperienceDataset()
+    assert loaded.load(str(tmp_path), 'exp')
+    assert_same_episodes(exp, loaded)
+    np.testing.assert_array_equal(exp.policy_parameters[1][0],
+                                  loaded.policy_parameters[1][0])
+
+
+def test_checkpoint_timing_span(tmp_path, monkeypatch, build_experience):
+    timings = str(tmp_path/'timings.jsonl')
+    monkeypatch.setenv('KUSANAGI_TIMINGS', timings)
+    exp = build_experience(n_episodes=1)
+    exp.save(str(tmp_path), 'exp', fmt='npy')
+    with utils.timing_span('span', name='counter', duration=-1):
+        pass
+    utils.flush_log()
+
+    records = [json.loads(line) for line in open(timings)]
+    checkpoint = [r for r in records if r['name'] == 'checkpoint'][0]
+    assert checkpoint['obj'] == exp.name
+    span = [r for r in records if r['name'] == 'span'][0]
+    assert span['counter_name'] == 'counter'
+    assert span['counter_duration'] == -1
+    assert span['duration'] >= 0
@@ -0,0 +1,58 @@
+import os
+import threading
+from kusanagi.utils.logger import LogWriter
+
+
+def read_lines(path):
+    with open(path, 'rb') as f:
+        return f.read().decode('utf-8').split(os.linesep)[:-1]
+
+
+def test_progress_records_are_overwritten(tmp_path):
+    path = str(tmp_path/'test.log')
+    writer = LogWriter()
+    writer.write(path, 'start')
+    for i in range(3):
+        writer.write(path, 'progress %d' % i, same_line=True)
+        writer.flush()
+    writer.close()
+    assert read_lines(path) == ['start', '\rprogress 2']
+
+
+def test_progress_records_keep_lines_from_other_writers(tmp_path):
+    path = str(tmp_path/'test.log')
+    writer = LogWriter()
+    writer.write(path, 'progress 0', same_line=True)
+    writer.flush()
+    # another process appends to the same log file
+    with open(path, 'ab') as f:
+        f.write(('other'+os.linesep).encode('utf-8'))
+    writer.write(path, 'progress 1', same_line=True)
+    writer.flush()
+    writer.write(path, 'progress 2', same_line=True)
+    writer.close()
+    assert read_lines(path) == ['\rprogress 0', 'other', '\rprogress 2']
+
+
+def test_writes_dont_wait_for_file_io(tmp_path):
+    path = str(tmp_path/'test.log')
+    writer = LogWriter(flush_interval=0)
+    opening, release = threading.Event(), threading.Event()
+    get_file = writer.get_file
+
+    def slow_get_file(path):
+        opening.set()
+        release.wait(10)
+        return get_file(path)
+    writer.get_file = slow_get_file
+    writer.write(path, 'first')
+    assert opening.wait(10)
+    # the writer thread is blocked on the file, but records are still
+    # buffered
+    t = threading.Thread(target=writer.write, args=(path, 'second'))
+    t.start()
+    t.join(5)
+    assert not t.is_alive()
+    release.set()
+    writer.close()
+    assert read_lines(path) == ['first', 'second']
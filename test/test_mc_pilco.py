@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('theano')
+
+import theano  # noqa: E402
+import theano.tensor as tt  # noqa: E402
+from kusanagi.ghost.algorithms import mc_pilco  # noqa: E402
+
+
+class TanhModel(object):
+    ''' deterministic stand-in for the policy and dynamics models'''
+    def __init__(self, W):
+        self.W = theano.shared(W)
+
+    def predict(self, x, iid_per_eval=False, return_samples=True):
+        y = tt.tanh(x.dot(self.W))
+        return y, 1e-2*tt.ones_like(y)
+
+    def get_intermediate_outputs(self):
+        return [self.W]
+
+
+def rollout_fn(**kwargs):
+    ''' compiles a function returning the costs, trajectories and loss
+    gradients of a rollout with 2D states and 1D controls'''
+    rng = np.random.RandomState(0)
+    pol = TanhModel(rng.randn(2, 1))
+    dyn = TanhModel(0.5*rng.randn(3, 2))
+    x0 = tt.matrix('x0')
+    H = tt.iscalar('H')
+    gamma = tt.scalar('gamma')
+    z = tt.tensor4('z')
+
+    def cost(x, s=None):
+        return (x**2).sum(1)
+    (costs, trajectories), updts = mc_pilco.rollout(
+        x0, H, gamma, pol, dyn, cost, z=z, mm_state=False, mm_cost=False,
+        noisy_policy_input=False, noisy_cost_input=False, **kwargs)
+    loss = costs.sum(1).mean()
+    grads = theano.grad(loss, [pol.W, dyn.W])
+    fn = theano.function([x0, H, gamma, z], [costs, trajectories] + grads,
+                         updates=updts, allow_input_downcast=True,
+                         on_unused_input='ignore')
+    x0_ = rng.randn(10, 2)
+    z_ = rng.randn(2, 21, 10, 2)
+    return lambda H: fn(x0_, H, 0.9, z_)
+
+
+class Resizable(object):
+    def __init__(self):
+        self.n_samples = None
+
+    def update(self, n_samples):
+        self.n_samples = n_samples
+
+
+def run_controller(controller, n_updates, noise, step, seed=0):
+    rng = np.random.RandomState(seed)
+    loss = 100.0
+    for i in range(n_updates):
+        n = int(controller.n_samples.get_value())
+        loss -= step
+        n = controller.update(loss, loss + noise*rng.randn(n))
+    return n
+
+
+def test_particle_controller_adapts_to_noise():
+    model = Resizable()
+    n_samples = theano.shared(np.array(100, dtype='int32'))
+    controller = mc_pilco.ParticleController(
+        n_samples, [model], None, min_samples=10, max_samples=1000,
+        interval=5)
+    # the loss changes much faster than the noise: fewer particles
+    n = run_controller(controller, 5, noise=1e-3, step=1.0)
+    assert n == 50
+    assert model.n_samples == 50
+
+    # the noise dominates: more particles, up to max_samples
+    controller.reset()
+    n = run_controller(controller, 50, noise=10.0, step=1e-3)
+    assert n == 1000
+    assert int(n_samples.get_value()) == 1000
+
+
+def test_adaptive_samples_with_shards_is_rejected():
+    with pytest.raises(ValueError):
+        mc_pilco.get_loss(None, None, None, n_shards=2,
+                          adaptive_samples=True)
+
+
+def test_common_random_numbers_are_resampled_every_period():
+    n_evals = theano.shared(0)
+    z, rng, updts = mc_pilco.common_random_numbers(
+        (4, 2), n_evals, period=3, seed=1)
+    updts[n_evals] = n_evals + 1
+    f = theano.function([], z, updates=updts)
+    samples = [f() for i in range(6)]
+    for i in (1, 2):
+        np.testing.assert_array_equal(samples[0], samples[i])
+    for i in (4, 5):
+        np.testing.assert_array_equal(samples[3], samples[i])
+    assert not np.allclose(samples[0], samples[3])
+
+    # the samples only depend on the seed of the stream
+    n_evals.set_value(0)
+    rng.seed(1)
+    np.testing.assert_array_equal(samples[0], f())
+    z2, rng2, updts2 = mc_pilco.common_random_numbers(
+        (4, 2), n_evals, period=3, seed=1)
+    np.testing.assert_array_equal(samples[0], z2.eval())
+    rng.seed(2)
+    assert not np.allclose(samples[0], f())
+
+
+def test_checkpointed_rollout_gradients():
+    costs, trajectories, dpol, ddyn = rollout_fn()(10)
+    for every in (3, 5, True):
+        ret = rollout_fn(checkpoint_every=every)(10)
+        for a, b in zip(ret, [costs, trajectories, dpol, ddyn]):
+            np.testing.assert_allclose(a, b, rtol=1e-6, atol=1e-9)
+
+
+def test_max_horizon_masking():
+    H = 10
+    costs, trajectories, dpol, ddyn = rollout_fn()(H)
+    for kwargs in [dict(max_H=15), dict(max_H=15, checkpoint_every=4)]:
+        masked = rollout_fn(**kwargs)(H)
+        assert masked[0].shape == (costs.shape[0], 15)
+        # the steps after H have zero cost and keep the state constant
+        np.testing.assert_allclose(masked[0][:, :H], costs, rtol=1e-6)
+        np.testing.assert_array_equal(masked[0][:, H:], 0)
+        np.testing.assert_allclose(
+            masked[1][:, :H+1], trajectories, rtol=1e-6)
+        for t in range(H+1, 16):
+            np.testing.assert_array_equal(masked[1][:, t], masked[1][:, H])
+        # so the gradients are the same as for the loss compiled for H
+        np.testing.assert_allclose(masked[2], dpol, rtol=1e-6, atol=1e-9)
+        np.testing.assert_allclose(masked[3], ddyn, rtol=1e-6, atol=1e-9)
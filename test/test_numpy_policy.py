@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from kusanagi.ghost.control.numpy_policy import (NumpyNNPolicy,
+                                                 load_numpy_policy, saturate)
+
+
+def build_policy(nonlinearity='linear', **kwargs):
+    rng = np.random.RandomState(0)
+    layers = [(rng.randn(3, 8), rng.randn(8), 'tanh', None),
+              (rng.randn(8, 2), rng.randn(2), nonlinearity, None)]
+    return NumpyNNPolicy(layers, **kwargs)
+
+
+def test_single_predictions_are_not_overwritten():
+    pol = build_policy()
+    x = np.random.RandomState(1).randn(4, 3)
+    U = pol.predict(x)
+    u = [pol.predict(xi) for xi in x]
+    for i in range(len(x)):
+        np.testing.assert_allclose(u[i], U[i])
+    u0, S, C = pol(x[0])
+    pol(x[1])
+    np.testing.assert_allclose(u0, U[0])
+
+
+def test_save_and_load(tmp_path):
+    pol = build_policy('rectify', sat_type='tanhSat', scale=np.array(2.0),
+                       offset=np.array(0.0))
+    path = str(tmp_path/'policy.npz')
+    pol.save(path)
+    pol2 = load_numpy_policy(path)
+    x = np.random.RandomState(1).randn(3)
+    np.testing.assert_allclose(pol(x)[0], pol2(x)[0])
+
+
+def test_rbf_policy_export():
+    pytest.importorskip('theano')
+    from kusanagi import utils
+    from kusanagi.ghost.control import RBFPolicy
+    rng = np.random.RandomState(2)
+    x0 = utils.distributions.Gaussian(np.zeros(3), 0.5*np.eye(3))
+    pol = RBFPolicy(state0_dist=x0, maxU=[3, 1], minU=[-1, 0],
+                    n_inducing=10)
+    # large targets, so the outputs reach the saturated region
+    pol.set_params({'Y': 5*rng.randn(10, 2).astype(pol.X.dtype)})
+    np_pol = pol.export_numpy()
+    x = rng.randn(5, 3)
+    U = pol(x)[0]
+    assert np.all(U <= [3, 1]) and np.all(U >= [-1, 0])
+    for i, xi in enumerate(x):
+        np.testing.assert_allclose(np_pol(xi)[0], U[i], rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(
+        saturate(np_pol.predict(x), np_pol.sat_type, np_pol.scale,
+                 np_pol.offset), U, rtol=1e-5, atol=1e-7)
+
+
+def test_nn_policy_export(tmp_path):
+    pytest.importorskip('theano')
+    lasagne = pytest.importorskip('lasagne')
+    from kusanagi.ghost.control import NNPolicy
+    L = lasagne.layers
+    spec = [(L.InputLayer, dict(shape=(None, 3), name='in')),
+            (L.DenseLayer, dict(num_units=8, name='h0',
+                                b=lasagne.init.Normal(),
+                                nonlinearity=lasagne.nonlinearities.tanh)),
+            (L.DropoutLayer, dict(p=0.5, name='drop')),
+            (L.DenseLayer, dict(num_units=2, name='out',
+                                b=lasagne.init.Normal(),
+                                nonlinearity=lasagne.nonlinearities.linear))]
+    pol = NNPolicy(3, maxU=[3, 1], minU=[-1, 0], network_spec=spec)
+    # whiten the inputs and rescale the outputs
+    rng = np.random.RandomState(2)
+    X = rng.randn(50, 3)*[1, 2, 3] + 1
+    Y = 5*rng.randn(50, 2) - 2
+    pol.update_dataset_statistics(X, Y)
+    np_pol = pol.export_numpy(str(tmp_path/'policy.npz'))
+    np_pol2 = load_numpy_policy(str(tmp_path/'policy.npz'))
+    x = rng.randn(5, 3)
+    U = pol(x, deterministic=True)[0]
+    assert np.all(U <= [3, 1]) and np.all(U >= [-1, 0])
+    for p in [np_pol, np_pol2]:
+        np.testing.assert_allclose(
+            saturate(p.predict(x), p.sat_type, p.scale, p.offset), U,
+            rtol=1e-5, atol=1e-7)
+        for i, xi in enumerate(x):
+            np.testing.assert_allclose(p(xi)[0], U[i], rtol=1e-5, atol=1e-7)
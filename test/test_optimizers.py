@@ -0,0 +1,69 @@
+import functools
+import numpy as np
+import pytest
+
+pytest.importorskip('theano')
+pytest.importorskip('lasagne')
+
+import theano  # noqa: E402
+from kusanagi.ghost.algorithms import mc_pilco  # noqa: E402
+from kusanagi.ghost.optimizers import SGDOptimizer  # noqa: E402
+
+
+def sharded_loss(n_shards=2):
+    ''' quadratic loss over common random numbers, split into shards'''
+    w = theano.shared(np.zeros(3), name='w')
+    n_evals = theano.shared(0)
+    z, rng, updts = mc_pilco.common_random_numbers(
+        (10, 3), n_evals, period=1000, seed=1)
+    updts[n_evals] = n_evals + 1
+    loss = ((w - z)**2).sum(-1).mean()
+    loss.tag.n_shards = n_shards
+    loss.tag.init_shard = functools.partial(mc_pilco.init_shard, [], rng)
+    return loss, w, updts
+
+
+def shard_losses(seed, n_evals=2):
+    loss, w, updts = sharded_loss()
+    opt = SGDOptimizer()
+    opt.set_objective(loss, [w], [], updts, shard_seed=seed)
+    try:
+        ret = [opt.loss_fn() for i in range(n_evals)]
+        ret.append(opt.update_params_fn()[0])
+    finally:
+        opt.close()
+    return ret
+
+
+def test_shards_are_deterministic():
+    losses = shard_losses(1234)
+    # the common random numbers are kept fixed between evaluations
+    np.testing.assert_allclose(losses[0], losses[1])
+    np.testing.assert_allclose(losses[0], losses[2])
+    # the same seed gives the same shards, different seeds different ones
+    np.testing.assert_allclose(losses, shard_losses(1234))
+    assert not np.allclose(losses, shard_losses(4321))
+
+
+def test_scipy_optimizer_rejects_sharded_loss():
+    pytest.importorskip('scipy')
+    from kusanagi.ghost.optimizers import ScipyOptimizer
+    loss, w, updts = sharded_loss()
+    with pytest.raises(ValueError):
+        ScipyOptimizer().set_objective(loss, [w], [], updts)
+
+
+@pytest.mark.parametrize('linker', ['cvm', 'vm', 'py'])
+def test_scipy_optimizer_linkers(linker):
+    pytest.importorskip('scipy')
+    from kusanagi.ghost.optimizers import ScipyOptimizer
+    w = theano.shared(np.zeros(3), name='w')
+    target = theano.tensor.vector('target')
+    loss = ((w - target)**2).sum()
+    opt = ScipyOptimizer()
+    opt.set_objective(loss, [w], [target],
+                      compilation_mode=theano.Mode(linker=linker))
+    target_ = np.arange(3.0)
+    assert np.isclose(opt.loss_fn(target_), 5.0)
+    opt.minimize(target_)
+    np.testing.assert_allclose(w.get_value(), target_, atol=1e-4)
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('gym')
+pytest.importorskip('scipy')
+pytest.importorskip('theano')
+
+from kusanagi import utils  # noqa: E402
+from kusanagi.shell.plant import BatchedODEPlant  # noqa: E402
+from kusanagi.shell.cartpole import Cartpole  # noqa: E402
+from kusanagi.shell.pendulum import Pendulum  # noqa: E402
+from kusanagi.shell.double_cartpole import DoubleCartpole  # noqa: E402
+
+
+def build_plant(plant_class, **kwargs):
+    ''' builds a plant without the (theano compiled) loss function'''
+    if plant_class is Pendulum:
+        kwargs['state0_dist'] = utils.distributions.Gaussian(
+            [np.pi, 0], (0.1**2)*np.eye(2))
+    return plant_class(loss_func=None, **kwargs)
+
+
+def random_states(plant, batch_size, seed=0):
+    ''' states around the initial state distribution, and random controls'''
+    rng = np.random.RandomState(seed)
+    D = plant.state0_dist.mean.size
+    x = plant.state0_dist.mean + rng.randn(batch_size, D)
+    u = 5*rng.randn(batch_size, 1)
+    return x, u
+
+
+PLANTS = [Cartpole, Pendulum, DoubleCartpole]
+
+
+@pytest.mark.parametrize('plant_class', PLANTS)
+def test_batch_dynamics(plant_class):
+    plant = build_plant(plant_class)
+    x, u = random_states(plant, 5)
+    dx = plant.batch_dynamics(0, x, u)
+    assert dx.shape == x.shape
+    for i in range(len(x)):
+        plant.apply_control(u[i])
+        np.testing.assert_allclose(
+            dx[i], plant.dynamics(0, x[i]).flatten(), rtol=1e-12,
+            atol=1e-12)
+
+
+@pytest.mark.parametrize('integrator', ['dopri5', 'rk4'])
+@pytest.mark.parametrize('plant_class', PLANTS)
+def test_batched_step(plant_class, integrator):
+    plant = build_plant(plant_class)
+    # tolerances below the default of 1e-12, so that the differences between
+    # the two integrators are not dominated by their own errors. rk4 uses a
+    # fixed step size, small enough to reach them
+    plant.solver.set_integrator('dopri5', atol=1e-14, rtol=1e-14)
+    batch = BatchedODEPlant(plant, batch_size=3, integrator=integrator,
+                            atol=1e-14, rtol=1e-14,
+                            n_substeps=10 if integrator == 'dopri5' else 1000)
+    x, u = random_states(plant, 3)
+    batch.set_state(x)
+    batch.step(u)
+    for i in range(len(x)):
+        plant.set_state(x[i])
+        plant.step(u[i])
+        np.testing.assert_allclose(batch.state[i], plant.state, rtol=0,
+                                   atol=1e-13)
+    assert np.isclose(batch.t, plant.dt)
+
+
+@pytest.mark.parametrize('plant_class', PLANTS)
+def test_batched_reset_and_step_shapes(plant_class):
+    plant = build_plant(plant_class, angle_dims=[1])
+    plant.loss_func = lambda x: (x**2).sum(-1)
+    batch = BatchedODEPlant(plant, batch_size=4)
+    D = plant.state0_dist.mean.size
+    assert batch.reset().shape == (4, D)
+    state, cost, done, info = batch.step(np.zeros((4, 1)))
+    # the angle is replaced by its sine and cosine
+    assert state.shape == (4, D + 1)
+    assert cost.shape == (4,)
+    assert done.shape == (4,) and not done.any()
+    np.testing.assert_allclose(cost, (batch.state**2).sum(-1))
+    assert np.isclose(info['t'], plant.dt)
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('theano')
+pytest.importorskip('scipy')
+
+import theano  # noqa: E402
+from kusanagi.ghost import regression  # noqa: E402
+
+
+def build_dataset(n=40, idims=3, odims=2, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.randn(n, idims)
+    Y = np.stack([np.sin(X.sum(1)*(i+1)) for i in range(odims)], 1)
+    Y += 0.01*rng.randn(n, odims)
+    return X.astype(theano.config.floatX), Y.astype(theano.config.floatX)
+
+
+def build_gp(X, Y, gp_class=regression.GP, hyp=None):
+    ''' builds a gp, computing the cached intermediate values (L, iK, beta)
+    for the given (unconstrained) hyperparameters'''
+    gp = gp_class(X, Y, name=gp_class.__name__)
+    if hyp is not None:
+        gp.set_params({'unconstrained_hyp': hyp})
+    loss, inps, updts = gp.get_loss()
+    theano.function(inps, loss, updates=updts)()
+    gp.trained = True
+    return gp
+
+
+def test_batched_predict():
+    X, Y = build_dataset()
+    gp = build_gp(X, Y)
+    x_test = build_dataset(5, seed=1)[0]
+    # single and batched inputs use functions compiled for their ndim
+    M, S = gp(x_test)
+    for i, x in enumerate(x_test):
+        m, s, v = gp(x)
+        np.testing.assert_allclose(M[i], m, rtol=1e-6, atol=1e-8)
+        np.testing.assert_allclose(S[i], np.diag(s), rtol=1e-6, atol=1e-8)
+    M2, S2 = gp(x_test)
+    np.testing.assert_allclose(M, M2)
+
+
+def test_incremental_cholesky_update():
+    X, Y = build_dataset(50)
+    gp = build_gp(X[:40], Y[:40])
+    hyp = gp.unconstrained_hyp.get_value()
+    assert gp.can_update_cholesky()
+    gp.append_dataset(X[40:], Y[40:])
+
+    # compare with refactorizing the full kernel matrix
+    gp_full = build_gp(X, Y, hyp=hyp)
+    for name in ['L', 'iK', 'beta']:
+        np.testing.assert_allclose(
+            getattr(gp, name).get_value(), getattr(gp_full, name).get_value(),
+            rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(gp.unconstrained_hyp.get_value(), hyp)
+    assert gp.N == 50
+
+
+def moment_matching_np(mx, Sx, X, hyp, beta, iK):
+    ''' moment matching for one pair of output dimensions at a time
+    (Deisenroth's thesis, Eqs 2.34-2.55)'''
+    D = X.shape[1]
+    E = hyp.shape[0]
+    sf2 = hyp[:, D]**2
+    Lambda = [np.diag(1.0/hyp[i, :D]**2) for i in range(E)]
+    zeta = X - mx
+    M = np.empty(E)
+    V = np.empty((D, E))
+    k = np.empty((E, X.shape[0]))
+    for i in range(E):
+        iLS = np.linalg.inv(Sx + np.linalg.inv(Lambda[i]))
+        c = sf2[i]/np.sqrt(np.linalg.det(Sx.dot(Lambda[i]) + np.eye(D)))
+        lb = np.exp(-0.5*np.sum(zeta.dot(iLS)*zeta, 1))*beta[i]
+        M[i] = c*lb.sum()
+        V[:, i] = c*iLS.dot(zeta.T.dot(lb))
+        k[i] = np.log(sf2[i]) - 0.5*np.sum(zeta.dot(Lambda[i])*zeta, 1)
+
+    M2 = np.empty((E, E))
+    for i in range(E):
+        for j in range(i, E):
+            R = Sx.dot(Lambda[i] + Lambda[j]) + np.eye(D)
+            iRSx = 0.5*np.linalg.solve(R, Sx)
+            zi = zeta.dot(Lambda[i])
+            zj = zeta.dot(Lambda[j])
+            n2 = k[i][:, None] + k[j][None, :]
+            n2 += np.sum(zi.dot(iRSx)*zi, 1)[:, None]
+            n2 += np.sum(zj.dot(iRSx)*zj, 1)[None, :]
+            n2 += 2*zi.dot(iRSx).dot(zj.T)
+            Q = np.exp(n2)/np.sqrt(np.linalg.det(R))
+            M2[i, j] = M2[j, i] = beta[i].dot(Q).dot(beta[j])
+            if i == j:
+                M2[i, i] += sf2[i] - np.sum(iK[i]*Q)
+    return M, M2 - np.outer(M, M), V
+
+
+def test_moment_matching():
+    X, Y = build_dataset(odims=3)
+    gp = build_gp(X, Y, regression.GP_UI)
+    rng = np.random.RandomState(2)
+    mx = rng.randn(X.shape[1]).astype(X.dtype)
+    A = rng.randn(X.shape[1], X.shape[1])
+    Sx = (0.1*A.dot(A.T)).astype(X.dtype)
+    M, S, V = gp(mx, Sx)
+    M_np, S_np, V_np = moment_matching_np(
+        mx, Sx, X, gp.hyp.eval(), gp.beta.get_value(), gp.iK.get_value())
+    np.testing.assert_allclose(M, M_np, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(S, S_np, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(V, V_np, rtol=1e-5, atol=1e-7)
+
+
+@pytest.mark.parametrize('D', [1, 2, 4])
+def test_batched_cholesky(D):
+    from kusanagi.utils import utils_
+    rng = np.random.RandomState(D)
+    X = rng.randn(3, D, D)
+    A_ = np.matmul(X, X.transpose(0, 2, 1)) + np.eye(D)
+    B_ = rng.randn(3, D, 2)
+    A, B = theano.tensor.tensor3('A'), theano.tensor.tensor3('B')
+    L = utils_.batched_cholesky(A, D)
+    f = theano.function([A, B], [L, utils_.batched_cho_solve(L, B, D),
+                                 utils_.batched_logdet(L, D)],
+                        allow_input_downcast=True)
+    L_, X_, logdet_ = f(A_, B_)
+    rtol = 1e-4 if theano.config.floatX == 'float32' else 1e-10
+    for i in range(3):
+        np.testing.assert_allclose(L_[i], np.linalg.cholesky(A_[i]),
+                                   rtol=rtol, atol=rtol)
+        np.testing.assert_allclose(X_[i], np.linalg.solve(A_[i], B_[i]),
+                                   rtol=rtol, atol=rtol)
+        np.testing.assert_allclose(logdet_[i], np.linalg.slogdet(A_[i])[1],
+                                   rtol=rtol)
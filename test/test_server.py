@@ -0,0 +1,178 @@
+import pickle
+import time
+import numpy as np
+import pytest
+
+pytest.importorskip('theano')
+pytest.importorskip('flask')
+
+import theano  # noqa: E402
+from kusanagi import server  # noqa: E402
+
+
+class ListPolicy(object):
+    '''
+    model whose get_all_shared_vars doesn't take the as_dict argument
+    '''
+    def __init__(self, *names):
+        self.params = [theano.shared(0.0, name=n) for n in names]
+
+    def get_all_shared_vars(self):
+        return list(self.params)
+
+
+class FakeOptimizer(object):
+    def __init__(self):
+        self.loss_fn = None
+        self.optimizer_state = [theano.shared(np.zeros(2), name='m')]
+
+
+def build_task(policy_values, dynamics_value):
+    ''' task spec whose models have the same structure for every task'''
+    pol = ListPolicy('a', 'b')
+    for p, v in zip(pol.params, policy_values):
+        p.set_value(v)
+    dyn = ListPolicy('c')
+    dyn.params[0].set_value(dynamics_value)
+    return dict(policy=pol, transition_model=dyn, optimizer=FakeOptimizer(),
+                extra_in=None, objective_key='key')
+
+
+def assert_values(values, expected):
+    assert len(values) == len(expected)
+    for v, e in zip(values, expected):
+        np.testing.assert_allclose(v, e)
+
+
+def fake_run_job(tasks, objectives, command, task_id, args, minimize_cb):
+    ''' stands in for server.run_job in the forked workers'''
+    if command == 'init':
+        # the spec stands in for its objective key
+        return pickle.dumps(args[0].decode('utf-8'))
+    if command == 'fail':
+        raise ValueError('job failed')
+    if command == 'loop':
+        # a long optimization, which checks for cancellation requests
+        for i in range(1000):
+            minimize_cb()
+            time.sleep(0.01)
+    return pickle.dumps((command, task_id, args))
+
+
+def wait_for(manager, job_id, timeout=10):
+    start = time.time()
+    while time.time() - start < timeout:
+        job = manager.get_job(job_id)
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError('job %s did not finish' % (job_id))
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    # the workers are forked, so they run the patched function
+    monkeypatch.setattr(server, 'run_job', fake_run_job)
+    manager = server.JobManager(n_workers=2)
+    yield manager
+    manager.shutdown()
+
+
+def test_named_shared_vars_without_as_dict():
+    pol = ListPolicy('b', 'a')
+    named = server.named_shared_vars(pol)
+    assert [name for name, v in named] == ['a', 'b']
+    assert server.model_shared_vars(pol) == [pol.params[1], pol.params[0]]
+    assert server.model_signature(pol)[0] == 'ListPolicy'
+
+
+def test_objectives_are_swapped_between_tasks():
+    tasks = dict(task0=build_task([1, 2], 3), task1=build_task([4, 5], 6))
+    objectives = {}
+    shared = server.objective_shared_vars(tasks['task0'])
+    # only compiled objectives are stored
+    server.store_objective(objectives, tasks, 'task0')
+    assert objectives == {}
+    tasks['task0']['optimizer'].loss_fn = 'compiled'
+    server.store_objective(objectives, tasks, 'task0')
+    assert objectives['key']['owner'] == 'task0'
+    shared[-1].set_value(np.array([7.0, 8.0]))
+    state0 = [1, 2, 3, [7, 8]]
+
+    # the first job of task1 uses its own model values, and a zeroed
+    # optimizer state. The state of task0 is saved in its spec
+    server.load_objective(objectives, tasks, 'task1')
+    assert objectives['key']['owner'] == 'task1'
+    for k in ['policy', 'transition_model', 'optimizer']:
+        assert tasks['task1'][k] is tasks['task0'][k]
+    assert_values([s.get_value() for s in shared], [4, 5, 6, [0, 0]])
+    assert_values(tasks['task0']['objective_state'], state0)
+    shared[0].set_value(9.0)
+    shared[-1].set_value(np.array([1.0, 1.0]))
+    state1 = [9, 5, 6, [1, 1]]
+
+    # swapping back and forth restores the state of each task
+    for task_id, state, other, other_state in [
+            ('task0', state0, 'task1', state1),
+            ('task1', state1, 'task0', state0)]:
+        server.load_objective(objectives, tasks, task_id)
+        assert objectives['key']['owner'] == task_id
+        assert 'objective_state' not in tasks[task_id]
+        assert_values([s.get_value() for s in shared], state)
+        assert_values(tasks[other]['objective_state'], other_state)
+
+    # loading the objective again, by its owner, doesn't change it
+    server.load_objective(objectives, tasks, 'task1')
+    assert_values([s.get_value() for s in shared], state1)
+    assert_values(tasks['task0']['objective_state'], state0)
+
+
+def test_tasks_with_same_objective_share_a_worker(manager):
+    w0 = manager.assign_worker('task0', objective_key='key0')
+    w1 = manager.assign_worker('task1', objective_key='key1')
+    assert w0 != w1
+    assert manager.assign_worker('task2', objective_key='key1') == w1
+    assert manager.assign_worker('task3', objective_key='key0') == w0
+    # the model id takes precedence over the structure of the objective
+    assert manager.assign_worker('task4', 'model', 'key1') == w1
+    assert manager.assign_worker('task5', 'model', 'key0') == w1
+    # tasks keep their worker
+    assert manager.assign_worker('task0', objective_key='key1') == w0
+
+
+def test_init_jobs_route_tasks_with_the_same_objective(manager):
+    w0 = manager.assign_worker('task0')
+    wait_for(manager, manager.submit('init', 'task0', b'key0'))
+    # the key computed by the worker of task0 is used for new tasks
+    assert manager.assign_worker('task1', objective_key='key0') == w0
+    assert manager.assign_worker('task2', objective_key='key2') != w0
+
+
+def test_job_lifecycle(manager):
+    assert manager.get_task_status('task') is None
+    job_id = manager.submit('init', 'task', b'spec')
+    job = wait_for(manager, job_id)
+    assert job['status'] == 'done'
+    assert pickle.loads(job['result']) == 'spec'
+    assert job['submitted'] <= job['started'] <= job['finished']
+    assert manager.get_task_status('task') == 'done'
+
+    job = wait_for(manager, manager.submit('fail', 'task'))
+    assert job['status'] == 'failed'
+    assert 'job failed' in job['error']
+    assert not manager.cancel(job['job_id'])
+
+
+def test_job_cancellation(manager):
+    running = manager.submit('loop', 'task')
+    queued = manager.submit('optimize', 'task')
+    while manager.get_job(running)['status'] != 'running':
+        time.sleep(0.01)
+    assert manager.cancel(queued)
+    assert manager.cancel(running)
+    assert wait_for(manager, running)['status'] == 'cancelled'
+    assert wait_for(manager, queued)['status'] == 'cancelled'
+
+    # the worker keeps running jobs after a cancellation
+    job = wait_for(manager, manager.submit('optimize', 'task'))
+    assert job['status'] == 'done'